@@ -3,13 +3,25 @@ from tkinter import ttk, messagebox, filedialog
 import pandas as pd
 import datetime
 
+import io
 import os
+import json
+import time
+import uuid
+import sqlite3
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import socketio
 import threading
+import heapq
+import unicodedata
+from concurrent.futures import ThreadPoolExecutor
+from itertools import islice
 
 import shutil
 import sys
+from collections import OrderedDict
 # Comprobar si la librería de imágenes (Pillow) está disponible
 try:
     from PIL import Image, ImageTk
@@ -17,6 +29,20 @@ try:
 except ImportError:
     PIL_AVAILABLE = False
 
+# openpyxl permite leer los .xlsx fila a fila (modo de solo lectura) sin cargar el libro entero
+try:
+    import openpyxl
+    OPENPYXL_AVAILABLE = True
+except ImportError:
+    OPENPYXL_AVAILABLE = False
+
+# Si la librería brotli está instalada, urllib3 sabe descomprimir respuestas 'br'
+try:
+    import brotli # noqa: F401
+    BROTLI_AVAILABLE = True
+except ImportError:
+    BROTLI_AVAILABLE = False
+
 # Paleta de colores actualizada, más suave y moderna
 COLOR_PALETTE = {
     "background": "#F0F0F0",
@@ -29,15 +55,136 @@ COLOR_PALETTE = {
     "row_salida": "#FFEBEE",   # Rosa claro para salidas
 }
 
+# Número máximo de sugerencias que se muestran en la lista desplegable
+MAX_SUGERENCIAS_VISIBLES = 50
+
+def normalizar_busqueda(texto):
+    """Pasa el texto a minúsculas y le quita los acentos (p. ej. 'Ubicación' -> 'ubicacion')."""
+    descompuesto = unicodedata.normalize('NFKD', texto.casefold())
+    return ''.join(c for c in descompuesto if not unicodedata.combining(c))
+
+def distancia_edicion(a, b, maximo):
+    """
+    Distancia de edición entre `a` y `b` (inserciones, borrados, sustituciones y
+    transposiciones de dos letras). Deja de calcular en cuanto supera `maximo` y entonces
+    devuelve maximo + 1.
+    """
+    if abs(len(a) - len(b)) > maximo:
+        return maximo + 1
+    anterior2 = None
+    anterior = list(range(len(b) + 1))
+    for i, ca in enumerate(a, 1):
+        actual = [i] + [0] * len(b)
+        for j, cb in enumerate(b, 1):
+            actual[j] = min(anterior[j] + 1, actual[j - 1] + 1, anterior[j - 1] + (ca != cb))
+            if i > 1 and j > 1 and ca == b[j - 2] and a[i - 2] == cb:
+                actual[j] = min(actual[j], anterior2[j - 2] + 1)
+        if min(actual) > maximo:
+            return maximo + 1
+        anterior2, anterior = anterior, actual
+    return anterior[-1]
+
+
+class IndiceSugerencias:
+    """
+    Índice de búsqueda de una lista de sugerencias. Las claves se precalculan una sola vez
+    (en minúsculas y sin acentos) junto con un índice de n-gramas (2 y 3 letras) que da los
+    candidatos de cada búsqueda sin recorrer toda la lista.
+
+    Los resultados se ordenan por relevancia: empieza por el texto > alguna palabra empieza
+    por el texto > lo contiene > se parece con alguna errata; a igualdad, se respeta el orden
+    original de la lista (las más usadas primero). Si el texto amplía el de la búsqueda
+    anterior, solo se revisan las coincidencias de esa búsqueda.
+    """
+
+    def __init__(self, valores=()):
+        self.valores = list(valores)
+        self.claves = [normalizar_busqueda(v) for v in self.valores]
+        # Posiciones donde empieza cada palabra de cada clave
+        self.inicios_palabra = [
+            [p for p, c in enumerate(clave) if c.isalnum() and (p == 0 or not clave[p - 1].isalnum())]
+            for clave in self.claves
+        ]
+        self.ngramas = {}
+        for indice, clave in enumerate(self.claves):
+            for n in (2, 3):
+                for p in range(len(clave) - n + 1):
+                    self.ngramas.setdefault(clave[p:p + n], set()).add(indice)
+        self.ultima_busqueda = None # (clave, índices de todas sus coincidencias)
+
+    def candidatos(self, clave):
+        """Índices que pueden contener `clave`: los que tienen todos sus n-gramas."""
+        if len(clave) < 2:
+            return range(len(self.claves))
+        n = min(len(clave), 3)
+        conjuntos = sorted((self.ngramas.get(clave[p:p + n], set()) for p in range(len(clave) - n + 1)), key=len)
+        return set.intersection(*conjuntos) if conjuntos else set()
+
+    def categoria(self, indice, clave):
+        """0 si la sugerencia empieza por `clave`, 1 si alguna palabra empieza por ella y 2 si solo la contiene."""
+        texto = self.claves[indice]
+        if texto.startswith(clave):
+            return 0
+        if any(texto.startswith(clave, p) for p in self.inicios_palabra[indice]):
+            return 1
+        return 2
+
+    def parecidos(self, clave, excluir, limite):
+        """
+        Sugerencias con alguna palabra cuyo comienzo se parece a `clave` salvo una errata
+        (dos si el texto es largo). Devuelve [(distancia, índice)] de las `limite` mejores.
+        """
+        tolerancia = 1 if len(clave) <= 5 else 2
+        # Candidatas: las que comparten al menos un trigrama con el texto
+        candidatas = set()
+        for p in range(len(clave) - 2):
+            candidatas |= self.ngramas.get(clave[p:p + 3], set())
+        resultado = []
+        for indice in candidatas - excluir:
+            texto = self.claves[indice]
+            distancia = min(
+                (distancia_edicion(clave, texto[p:p + largo], tolerancia)
+                 for p in self.inicios_palabra[indice] for largo in (len(clave) - 1, len(clave), len(clave) + 1)),
+                default=tolerancia + 1)
+            if distancia <= tolerancia:
+                resultado.append((distancia, indice))
+        return heapq.nsmallest(limite, resultado)
+
+    def buscar(self, texto, limite=MAX_SUGERENCIAS_VISIBLES):
+        """Devuelve hasta `limite` sugerencias para `texto`, de la más a la menos relevante."""
+        clave = normalizar_busqueda(texto.strip())
+        if not clave:
+            self.ultima_busqueda = None
+            return self.valores[:limite]
+
+        if self.ultima_busqueda and clave.startswith(self.ultima_busqueda[0]):
+            candidatos = self.ultima_busqueda[1]
+        else:
+            candidatos = self.candidatos(clave)
+        coincidencias = {indice for indice in candidatos if clave in self.claves[indice]}
+        self.ultima_busqueda = (clave, coincidencias)
+
+        mejores = heapq.nsmallest(limite, ((self.categoria(i, clave), i) for i in coincidencias))
+        indices = [indice for _, indice in mejores]
+        if len(indices) < limite and len(clave) >= 3:
+            indices += [indice for _, indice in self.parecidos(clave, coincidencias, limite - len(indices))]
+        return [self.valores[indice] for indice in indices]
+
+
 class AutocompleteEntry(ttk.Entry):
     """
     Un widget de entrada con autocompletado, lista desplegable y navegación por teclado.
+    Las sugerencias se buscan con un `IndiceSugerencias` y la lista desplegable se crea una
+    sola vez: después solo se oculta y se vuelve a mostrar con otros elementos.
     """
 
     def __init__(self, master, *args, **kwargs):
         super().__init__(master, *args, **kwargs)
         self.lista_sugerencias = []
+        self.indice_sugerencias = IndiceSugerencias()
         self.listbox = None
+        self.listbox_widget = None
+        self.listbox_visible = False
         self.autocompletado_id = None
         self.bind("<KeyRelease>", self.on_keyrelease)
         self.bind("<FocusOut>", self.on_focusout)
@@ -46,7 +193,9 @@ class AutocompleteEntry(ttk.Entry):
         self.bind("<Down>", self.mostrar_sugerencias_al_pulsar_abajo)
 
     def set_sugerencias(self, suggestions):
-        self.lista_sugerencias = sorted(suggestions)
+        """Cambia la lista de sugerencias. Su orden es el de preferencia a igual relevancia."""
+        self.lista_sugerencias = list(suggestions)
+        self.indice_sugerencias = IndiceSugerencias(self.lista_sugerencias)
 
     def on_keyrelease(self, event):
         """Maneja las pulsaciones de teclas para autocompletar y navegar."""
@@ -73,39 +222,51 @@ class AutocompleteEntry(ttk.Entry):
 
     def mostrar_sugerencias_al_pulsar_abajo(self, event):
         """Muestra todas las sugerencias si se pulsa la tecla Abajo y el campo está vacío."""
-        if not self.get() and not self.listbox:
-            self.mostrar_listbox(self.lista_sugerencias)
+        if not self.get() and not self.listbox_visible:
+            self.mostrar_listbox(self.indice_sugerencias.buscar(""))
         else:
             self.navegar_listbox(1)
 
     def realizar_autocompletado(self, event=None):
         """Realiza la búsqueda de sugerencias y muestra el listbox."""
-        termino = self.get().lower()
-        if not termino:
+        self.autocompletado_id = None
+        termino = self.get()
+        if not termino.strip():
             self.cerrar_listbox()
             return
 
-        coincidencias = [item for item in self.lista_sugerencias if termino in item.lower()]
+        coincidencias = self.indice_sugerencias.buscar(termino)
 
         if coincidencias:
             self.mostrar_listbox(coincidencias)
         else:
             self.cerrar_listbox()
 
-    def mostrar_listbox(self, items):
-        """Crea y muestra el widget de listbox con sugerencias, ajustando su tamaño."""
-        self.cerrar_listbox()
-
+    def crear_listbox(self):
+        """Crea (oculta) la ventana de la lista desplegable; se reutiliza en cada búsqueda."""
         self.listbox = tk.Toplevel(self.master)
+        self.listbox.withdraw()
         self.listbox.overrideredirect(True)
 
+        listbox_frame = tk.Frame(self.listbox, bd=1, relief="solid")
+        listbox_frame.pack(fill="both", expand=True)
+
+        listbox_widget = tk.Listbox(listbox_frame, background=COLOR_PALETTE["surface"], relief="flat")
+        listbox_widget.pack(fill="both", expand=True)
+        listbox_widget.bind("<<ListboxSelect>>", self.on_listbox_select)
+        listbox_widget.bind("<ButtonRelease-1>", self.on_listbox_select)
+        # Se ha quitado el binding de Return aquí, se maneja directamente en la clase principal
+        self.listbox_widget = listbox_widget
+
+    def mostrar_listbox(self, items):
+        """Muestra la lista desplegable con `items`, ajustando su tamaño y posición."""
+        if self.listbox is None or not self.listbox.winfo_exists():
+            self.crear_listbox()
+
         x = self.winfo_rootx()
         y = self.winfo_rooty() + self.winfo_height()
         self.listbox.geometry(f"+{x}+{y}")
 
-        listbox_frame = tk.Frame(self.listbox, bd=1, relief="solid")
-        listbox_frame.pack(fill="both", expand=True)
-
         # --- CÁLCULO DEL ANCHO ---
         # Calcular el ancho en caracteres basado en el ítem más largo para que se vea completo.
         max_len = 0
@@ -122,15 +283,14 @@ class AutocompleteEntry(ttk.Entry):
 
         # Ajustar la altura del listbox a la cantidad de elementos, con un máximo para no saturar
         altura_listbox = min(len(items), 10)
-        listbox_widget = tk.Listbox(listbox_frame, background=COLOR_PALETTE["surface"], relief="flat", height=altura_listbox, width=new_width)
-        for item in items:
-            listbox_widget.insert("end", item)
+        self.listbox_widget.config(height=altura_listbox, width=new_width)
+        self.listbox_widget.delete(0, "end")
+        self.listbox_widget.insert("end", *items)
 
-        listbox_widget.pack(fill="both", expand=True)
-        listbox_widget.bind("<<ListboxSelect>>", self.on_listbox_select)
-        listbox_widget.bind("<ButtonRelease-1>", self.on_listbox_select)
-        # Se ha quitado el binding de Return aquí, se maneja directamente en la clase principal
-        self.listbox_widget = listbox_widget
+        if not self.listbox_visible:
+            self.listbox.deiconify()
+            self.listbox.lift()
+            self.listbox_visible = True
 
     def on_listbox_select(self, event):
         """Maneja la selección de un ítem en el listbox."""
@@ -147,7 +307,7 @@ class AutocompleteEntry(ttk.Entry):
         Selecciona el ítem resaltado en la lista con la tecla Enter y luego
         genera el evento para pasar al siguiente campo.
         """
-        if self.listbox and self.listbox_widget:
+        if self.listbox_visible:
             indices_seleccionados = self.listbox_widget.curselection()
             if indices_seleccionados:
                 index = indices_seleccionados[0]
@@ -159,7 +319,7 @@ class AutocompleteEntry(ttk.Entry):
 
     def navegar_listbox(self, direccion):
         """Navega por la lista de sugerencias con las flechas del teclado."""
-        if not self.listbox or not self.listbox_widget:
+        if not self.listbox_visible:
             return
 
         current_selection = self.listbox_widget.curselection()
@@ -185,16 +345,802 @@ class AutocompleteEntry(ttk.Entry):
         self.after(200, self.cerrar_listbox)
 
     def cerrar_listbox(self, event=None):
-        """Destruye el widget de listbox si está abierto."""
-        if self.listbox:
-            self.listbox.destroy()
-            self.listbox = None
-            self.listbox_widget = None
+        """Oculta el listbox si está abierto (la ventana se conserva para la próxima búsqueda)."""
+        if self.listbox_visible:
+            self.listbox_visible = False
+            if self.listbox.winfo_exists():
+                self.listbox_widget.selection_clear(0, 'end')
+                self.listbox.withdraw()
             if self.autocompletado_id:
                 self.after_cancel(self.autocompletado_id)
                 self.autocompletado_id = None
 
 
+class ClienteAPI:
+    """
+    Cliente HTTP compartido para hablar con el servidor.
+
+    Usa una única `requests.Session` con un pool de conexiones persistentes (keep-alive), de modo
+    que las peticiones reutilizan la conexión TCP+TLS en lugar de abrir una nueva cada vez.
+    Pide las respuestas comprimidas, reintenta con espera exponencial las peticiones GET
+    (idempotentes) que fallan por errores transitorios y aplica un timeout a cada llamada.
+    Además guarda las últimas respuestas con ETag y las revalida con If-None-Match: si el
+    servidor responde 304, se reutiliza el contenido guardado sin volver a descargarlo.
+    """
+
+    def __init__(self, base_url, timeout=(10, 30), reintentos=3, tam_pool=8, max_respuestas_cache=64):
+        self.base_url = base_url.rstrip('/')
+        self.timeout = timeout # (conexión, lectura) en segundos
+        self.session = requests.Session()
+        codificaciones = "gzip, deflate, br" if BROTLI_AVAILABLE else "gzip, deflate"
+        self.session.headers.update({"Accept-Encoding": codificaciones, "Connection": "keep-alive"})
+
+        # Caché de respuestas validadas por ETag: (ruta, parámetros) -> (etag, json). Se usa desde
+        # varios hilos del pool, por eso se protege con un lock.
+        self.cache_respuestas = OrderedDict()
+        self.max_respuestas_cache = max_respuestas_cache
+        self.lock_cache = threading.Lock()
+
+        # Los errores de conexión se reintentan siempre (la petición no llegó a enviarse); los de
+        # lectura y los códigos 502/503/504 (p. ej. el servidor arrancando) solo en GET.
+        politica = Retry(
+            total=reintentos,
+            backoff_factor=0.5,
+            status_forcelist=(502, 503, 504),
+            allowed_methods=frozenset(["GET", "HEAD"]),
+            raise_on_status=False,
+        )
+        adaptador = HTTPAdapter(pool_connections=tam_pool, pool_maxsize=tam_pool, max_retries=politica)
+        self.session.mount("https://", adaptador)
+        self.session.mount("http://", adaptador)
+
+    def url(self, ruta):
+        return f"{self.base_url}{ruta}"
+
+    def get(self, ruta, params=None, timeout=None, **kwargs):
+        return self.session.get(self.url(ruta), params=params, timeout=timeout or self.timeout, **kwargs)
+
+    def post(self, ruta, json=None, timeout=None, **kwargs):
+        return self.session.post(self.url(ruta), json=json, timeout=timeout or self.timeout, **kwargs)
+
+    def get_json(self, ruta, params=None, timeout=None):
+        """
+        GET que devuelve el JSON de la respuesta y lanza una excepción si el código es de error.
+        Si hay una respuesta guardada para la misma ruta y parámetros, se envía su ETag y, ante
+        un 304 Not Modified, se devuelve el contenido guardado. Un 304 sin contenido guardado
+        (p. ej. la entrada se descartó) se repite una vez como petición completa.
+        """
+        clave = (ruta, tuple(sorted((params or {}).items())))
+        with self.lock_cache:
+            guardada = self.cache_respuestas.get(clave)
+        headers = {"If-None-Match": guardada[0]} if guardada else {}
+
+        response = self.get(ruta, params=params, timeout=timeout, headers=headers)
+        if response.status_code == 304:
+            if guardada:
+                return guardada[1]
+            with self.lock_cache:
+                self.cache_respuestas.pop(clave, None)
+            response = self.get(ruta, params=params, timeout=timeout, headers={"Cache-Control": "no-cache"})
+            if response.status_code == 304:
+                raise requests.HTTPError(f"304 Not Modified sin respuesta guardada para {ruta}", response=response)
+        response.raise_for_status()
+        datos = response.json()
+
+        etag = response.headers.get("ETag")
+        if etag:
+            with self.lock_cache:
+                self.cache_respuestas[clave] = (etag, datos)
+                self.cache_respuestas.move_to_end(clave)
+                while len(self.cache_respuestas) > self.max_respuestas_cache:
+                    self.cache_respuestas.popitem(last=False)
+        return datos
+
+    def descargar(self, ruta, destino, params=None, timeout=(10, 300), tam_trozo=64 * 1024):
+        """
+        Descarga la respuesta de `ruta` directamente a `destino`, por trozos y sin cargarla en
+        memoria. Se escribe en un archivo temporal que se renombra al terminar, para no dejar un
+        archivo incompleto si la descarga falla.
+        """
+        temporal = destino + ".part"
+        with self.get(ruta, params=params, timeout=timeout, stream=True) as response:
+            if response.status_code >= 400:
+                try:
+                    mensaje = response.json().get("message", response.reason)
+                except ValueError:
+                    mensaje = response.reason
+                raise RuntimeError(mensaje)
+            try:
+                with open(temporal, "wb") as f:
+                    for trozo in response.iter_content(chunk_size=tam_trozo):
+                        f.write(trozo)
+                os.replace(temporal, destino)
+            except BaseException:
+                if os.path.exists(temporal):
+                    os.remove(temporal)
+                raise
+
+    def cerrar(self):
+        self.session.close()
+
+
+class ProgramadorRecargas:
+    """
+    Agrupa las peticiones de recarga de las vistas que llegan en ráfagas.
+
+    Cada petición reinicia una ventana de silencio (`ventana_ms`); cuando pasa la ventana sin
+    nuevas peticiones se ejecuta una sola recarga por vista. Para que una ráfaga continua no
+    retrase la recarga indefinidamente, nunca se espera más de `max_espera_ms` desde la primera
+    petición pendiente. Las vistas que no están visibles quedan pendientes hasta que se muestran.
+    """
+
+    def __init__(self, root, acciones, es_visible, ventana_ms=300, max_espera_ms=2000):
+        self.root = root
+        self.acciones = acciones # Diccionario vista -> función de recarga (se ejecutan en este orden)
+        self.es_visible = es_visible # Función vista -> bool
+        self.ventana_ms = ventana_ms
+        self.max_espera_ms = max_espera_ms
+        self.pendientes = set()
+        self.after_id = None
+        self.primera_peticion = None
+
+    def solicitar(self, *vistas):
+        """Marca las vistas como pendientes y programa (o reprograma) la recarga."""
+        self.pendientes.update(vistas)
+        ahora = time.monotonic()
+        if self.primera_peticion is None:
+            self.primera_peticion = ahora
+
+        restante_ms = self.max_espera_ms - (ahora - self.primera_peticion) * 1000
+        espera_ms = int(max(0, min(self.ventana_ms, restante_ms)))
+        if self.after_id:
+            self.root.after_cancel(self.after_id)
+        self.after_id = self.root.after(espera_ms, self.ejecutar)
+
+    def ejecutar(self):
+        """Recarga una vez cada vista pendiente que esté visible."""
+        self.after_id = None
+        self.primera_peticion = None
+        for vista, accion in self.acciones.items():
+            if vista in self.pendientes and self.es_visible(vista):
+                self.pendientes.discard(vista)
+                accion()
+
+    def vista_mostrada(self, vista):
+        """Se llama al mostrar una vista: si tenía una recarga pendiente, se hace ahora."""
+        if vista in self.pendientes:
+            self.pendientes.discard(vista)
+            self.acciones[vista]()
+
+
+class CacheLocal:
+    """
+    Copia local, en un archivo SQLite, de los datos del servidor: el inventario y los materiales
+    completos, la primera página del historial sin filtros (con el total de movimientos) y la
+    secuencia de cambios con la que esos datos son coherentes. También guarda la cola de
+    movimientos pendientes de enviar al servidor (ver `encolar_pendiente`).
+
+    Al arrancar, las pestañas se pintan desde aquí sin esperar al servidor, y con la secuencia
+    guardada basta con pedir a /cambios lo ocurrido desde entonces. Si el servidor no responde,
+    los datos guardados siguen visibles. La conexión se comparte entre hilos con un lock.
+    """
+
+    def __init__(self, ruta, servidor):
+        self.conexion = sqlite3.connect(ruta, check_same_thread=False)
+        self.lock = threading.Lock()
+        with self.lock:
+            self.conexion.executescript("""
+                PRAGMA journal_mode=WAL;
+                CREATE TABLE IF NOT EXISTS filas (
+                    vista TEXT NOT NULL, id INTEGER NOT NULL, posicion INTEGER NOT NULL, datos TEXT NOT NULL,
+                    PRIMARY KEY (vista, id)
+                );
+                CREATE TABLE IF NOT EXISTS meta (clave TEXT PRIMARY KEY, valor TEXT);
+                CREATE TABLE IF NOT EXISTS pendientes (
+                    orden INTEGER PRIMARY KEY AUTOINCREMENT, clave TEXT NOT NULL UNIQUE,
+                    tipo TEXT NOT NULL, datos TEXT NOT NULL, creado TEXT NOT NULL
+                );
+            """)
+        # Los datos de otro servidor no sirven (otra base de datos, otras secuencias)
+        if self.leer_meta("servidor") != servidor:
+            self.vaciar()
+            self.escribir_meta("servidor", servidor)
+
+    def leer(self, vista):
+        """Filas guardadas de una vista, en el orden en que se guardaron."""
+        with self.lock:
+            filas = self.conexion.execute(
+                "SELECT datos FROM filas WHERE vista = ? ORDER BY posicion, id", (vista,)).fetchall()
+        return [json.loads(datos) for (datos,) in filas]
+
+    def reemplazar(self, vista, filas):
+        """Sustituye todas las filas guardadas de una vista."""
+        with self.lock, self.conexion:
+            self.conexion.execute("DELETE FROM filas WHERE vista = ?", (vista,))
+            self.conexion.executemany(
+                "INSERT INTO filas (vista, id, posicion, datos) VALUES (?, ?, ?, ?)",
+                ((vista, fila['id'], posicion, json.dumps(fila)) for posicion, fila in enumerate(filas)))
+
+    def aplicar(self, vista, id_fila, datos):
+        """Inserta o actualiza una fila (o la elimina si `datos` es None)."""
+        with self.lock, self.conexion:
+            if datos is None:
+                self.conexion.execute("DELETE FROM filas WHERE vista = ? AND id = ?", (vista, id_fila))
+            else:
+                self.conexion.execute(
+                    "INSERT INTO filas (vista, id, posicion, datos) VALUES (?, ?, 0, ?) "
+                    "ON CONFLICT (vista, id) DO UPDATE SET datos = excluded.datos",
+                    (vista, id_fila, json.dumps(datos)))
+
+    def leer_meta(self, clave):
+        with self.lock:
+            fila = self.conexion.execute("SELECT valor FROM meta WHERE clave = ?", (clave,)).fetchone()
+        return json.loads(fila[0]) if fila else None
+
+    def escribir_meta(self, clave, valor):
+        with self.lock, self.conexion:
+            self.conexion.execute(
+                "INSERT INTO meta (clave, valor) VALUES (?, ?) ON CONFLICT (clave) DO UPDATE SET valor = excluded.valor",
+                (clave, json.dumps(valor)))
+
+    def encolar_pendiente(self, clave, tipo, datos, creado):
+        """Guarda en disco un movimiento pendiente de enviar, con su clave de idempotencia."""
+        with self.lock, self.conexion:
+            self.conexion.execute(
+                "INSERT INTO pendientes (clave, tipo, datos, creado) VALUES (?, ?, ?, ?)",
+                (clave, tipo, json.dumps(datos), creado))
+
+    def leer_pendientes(self):
+        """Movimientos pendientes, en el orden en que se registraron: (clave, tipo, datos, creado)."""
+        with self.lock:
+            filas = self.conexion.execute("SELECT clave, tipo, datos, creado FROM pendientes ORDER BY orden").fetchall()
+        return [(clave, tipo, json.loads(datos), creado) for clave, tipo, datos, creado in filas]
+
+    def quitar_pendientes(self, claves):
+        with self.lock, self.conexion:
+            self.conexion.executemany("DELETE FROM pendientes WHERE clave = ?", [(clave,) for clave in claves])
+
+    def vaciar(self):
+        """Borra los datos guardados del servidor (no los movimientos pendientes de enviar)."""
+        with self.lock, self.conexion:
+            self.conexion.execute("DELETE FROM filas")
+            self.conexion.execute("DELETE FROM meta")
+
+    def cerrar(self):
+        with self.lock:
+            self.conexion.close()
+
+
+class CacheImagenes:
+    """
+    Caché de dos niveles para las imágenes de los materiales.
+
+    1. En memoria: un LRU de `PhotoImage` ya decodificadas, limitado en bytes (ancho x alto x 4).
+    2. En disco: los archivos descargados, limitados en bytes; al pasarse se borran los usados
+       hace más tiempo (según su fecha de modificación, que se actualiza al leerlos).
+
+    Las entradas se identifican por el nombre de la imagen que envía el servidor (el hash de su
+    contenido, del que sale también su ETag), así que nunca quedan obsoletas: si la imagen de un
+    material cambia, cambia su nombre. La descarga, la decodificación y el redimensionado se
+    hacen en segundo plano (`en_segundo_plano`); en el hilo de Tk solo se crea la `PhotoImage`.
+    """
+
+    def __init__(self, api, directorio, en_segundo_plano, max_bytes_memoria=32 * 1024 * 1024,
+                 max_bytes_disco=200 * 1024 * 1024):
+        self.api = api
+        self.directorio = directorio
+        self.en_segundo_plano = en_segundo_plano
+        self.max_bytes_memoria = max_bytes_memoria
+        self.max_bytes_disco = max_bytes_disco
+        self.memoria = OrderedDict() # (imagen, tamaño) -> (PhotoImage, bytes)
+        self.bytes_memoria = 0
+        self.en_curso = {} # (imagen, tamaño) -> funciones que esperan la imagen
+        self.lock_disco = threading.Lock()
+        os.makedirs(directorio, exist_ok=True)
+
+    def ruta_disco(self, imagen, tamano):
+        contenido, _, extension = imagen.partition('.')
+        return os.path.join(self.directorio, f"{contenido}-{tamano}.{'jpg' if tamano == 'thumb' else extension}")
+
+    def en_memoria(self, imagen, tamano):
+        """Devuelve la PhotoImage si ya está decodificada en memoria (y la marca como recién usada), o None."""
+        entrada = self.memoria.get((imagen, tamano))
+        if entrada is None:
+            return None
+        self.memoria.move_to_end((imagen, tamano))
+        return entrada[0]
+
+    def guardar_en_memoria(self, clave, foto, tam_bytes):
+        anterior = self.memoria.pop(clave, None)
+        if anterior:
+            self.bytes_memoria -= anterior[1]
+        self.memoria[clave] = (foto, tam_bytes)
+        self.bytes_memoria += tam_bytes
+        # Se conserva siempre la última, aunque por sí sola supere el presupuesto
+        while self.bytes_memoria > self.max_bytes_memoria and len(self.memoria) > 1:
+            _, (_, liberados) = self.memoria.popitem(last=False)
+            self.bytes_memoria -= liberados
+
+    def obtener(self, material_id, imagen, tamano='thumb', al_terminar=None, maximo=None, al_fallar=None):
+        """
+        Entrega a `al_terminar` (en el hilo de Tk) la PhotoImage de la imagen `imagen` del material,
+        reducida para caber en `maximo` (ancho, alto) si se indica, o el error a `al_fallar`.
+        Busca primero en memoria, luego en disco y por último la descarga. Varias peticiones
+        de la misma imagen comparten la carga.
+        """
+        clave = (imagen, tamano)
+        foto = self.en_memoria(imagen, tamano)
+        if foto is not None:
+            if al_terminar:
+                al_terminar(foto)
+            return
+        if clave in self.en_curso:
+            self.en_curso[clave].append((al_terminar, al_fallar))
+            return
+        self.en_curso[clave] = [(al_terminar, al_fallar)]
+
+        def cargar():
+            pil_imagen = self.decodificar(self.leer_o_descargar(material_id, imagen, tamano), maximo)
+            if pil_imagen is None:
+                # El archivo del disco estaba dañado: se descarga de nuevo
+                self.borrar_de_disco(imagen, tamano)
+                pil_imagen = self.decodificar(self.leer_o_descargar(material_id, imagen, tamano), maximo)
+                if pil_imagen is None:
+                    raise ValueError("El servidor no devolvió una imagen válida.")
+            return pil_imagen
+
+        def al_cargar(pil_imagen):
+            foto = ImageTk.PhotoImage(pil_imagen)
+            self.guardar_en_memoria(clave, foto, pil_imagen.width * pil_imagen.height * 4)
+            for funcion, _ in self.en_curso.pop(clave, []):
+                if funcion:
+                    funcion(foto)
+
+        def al_fallar_carga(error):
+            print(f"No se pudo cargar la imagen {imagen} ({tamano}): {error}")
+            for _, funcion in self.en_curso.pop(clave, []):
+                if funcion:
+                    funcion(error)
+
+        self.en_segundo_plano(cargar, al_cargar, al_fallar_carga)
+
+    @staticmethod
+    def decodificar(datos, maximo):
+        """Decodifica (y reduce) la imagen. Devuelve None si los datos no son una imagen válida."""
+        try:
+            with Image.open(io.BytesIO(datos)) as original:
+                original.load()
+                if maximo:
+                    original.thumbnail(maximo)
+                return original.copy()
+        except (OSError, ValueError):
+            return None
+
+    def leer_o_descargar(self, material_id, imagen, tamano):
+        """Bytes de la imagen desde el disco o, si no está, desde el servidor (y se guardan en disco)."""
+        ruta = self.ruta_disco(imagen, tamano)
+        try:
+            with open(ruta, 'rb') as archivo:
+                datos = archivo.read()
+            os.utime(ruta) # Marca de uso para el LRU del disco
+            return datos
+        except FileNotFoundError:
+            pass
+
+        # Con v=<imagen> el servidor la sirve como inmutable
+        response = self.api.get(f"/materiales/{material_id}/imagen", params={'size': tamano, 'v': imagen}, timeout=(10, 120))
+        response.raise_for_status()
+        # El ETag es '<hash>-<tamaño>': si no coincide, el material ya tiene otra imagen y esta
+        # respuesta no se guarda con el nombre antiguo (llegará la nueva con el cambio del servidor)
+        if response.headers.get('ETag', '').strip('"') != f"{imagen.partition('.')[0]}-{tamano}":
+            raise ValueError("La imagen del material ha cambiado en el servidor.")
+        datos = response.content
+        with self.lock_disco:
+            temporal = f"{ruta}.{threading.get_ident()}.part"
+            with open(temporal, 'wb') as archivo:
+                archivo.write(datos)
+            os.replace(temporal, ruta)
+            self.recortar_disco()
+        return datos
+
+    def borrar_de_disco(self, imagen, tamano):
+        try:
+            os.remove(self.ruta_disco(imagen, tamano))
+        except FileNotFoundError:
+            pass
+
+    def recortar_disco(self):
+        """Borra los archivos usados hace más tiempo hasta no superar `max_bytes_disco`. Llamar con `lock_disco`."""
+        archivos = []
+        for entrada in os.scandir(self.directorio):
+            if entrada.is_file() and not entrada.name.endswith('.part'):
+                info = entrada.stat()
+                archivos.append((info.st_mtime, info.st_size, entrada.path))
+        total = sum(tam for _, tam, _ in archivos)
+        for _, tam, ruta in sorted(archivos):
+            if total <= self.max_bytes_disco:
+                break
+            try:
+                os.remove(ruta)
+                total -= tam
+            except OSError:
+                pass
+
+
+class ReconciliadorTreeview:
+    """
+    Mantiene un Treeview sincronizado con una lista de filas identificadas por un id estable
+    (el iid de cada elemento), en lugar de borrarlo y volver a llenarlo en cada recarga.
+
+    Solo se eliminan las filas que ya no están, se insertan las nuevas y se actualizan las que
+    han cambiado; el orden se corrige con una sola llamada a `set_children`. Así se conservan la
+    selección y la posición de desplazamiento y el coste en llamadas a Tk depende de lo que
+    cambia, no del tamaño de la lista. Todas las modificaciones del Treeview deben pasar por
+    aquí para que la copia de lo pintado (`pintadas`) siga siendo válida.
+    """
+
+    def __init__(self, tree):
+        self.tree = tree
+        self.pintadas = {} # iid -> (values, tags) tal como están en el Treeview
+
+    def reconciliar(self, filas):
+        """Deja el Treeview con exactamente `filas` (iterable de (iid, values, tags)) y en ese orden."""
+        filas = list(filas)
+        deseados = tuple(iid for iid, _, _ in filas)
+        conjunto = set(deseados)
+        sobrantes = [iid for iid in self.tree.get_children() if iid not in conjunto]
+        if sobrantes:
+            self.tree.delete(*sobrantes)
+            for iid in sobrantes:
+                self.pintadas.pop(iid, None)
+
+        for iid, values, tags in filas:
+            self.pintar(iid, values, tags)
+        if self.tree.get_children() != deseados:
+            self.tree.set_children('', *deseados)
+
+    def pintar(self, iid, values, tags=(), indice='end'):
+        """Inserta la fila en `indice` si no existe o actualiza sus valores si han cambiado."""
+        nuevo = (tuple(values), tuple(tags))
+        anterior = self.pintadas.get(iid)
+        if anterior is None:
+            self.tree.insert('', indice, iid=iid, values=nuevo[0], tags=nuevo[1])
+        elif anterior != nuevo:
+            self.tree.item(iid, values=nuevo[0], tags=nuevo[1])
+        self.pintadas[iid] = nuevo
+
+    def eliminar(self, iid):
+        if self.pintadas.pop(iid, None) is not None:
+            self.tree.delete(iid)
+
+    def posicion_ordenada(self, texto, columna=0):
+        """Índice en el que insertar `texto` para mantener el Treeview ordenado por `columna`."""
+        for indice, iid in enumerate(self.tree.get_children()):
+            if str(self.pintadas[iid][0][columna]) > texto:
+                return indice
+        return 'end'
+
+
+class ModeloListaVirtual:
+    """
+    Modelo de datos de una lista virtual: conoce el total de filas del servidor pero solo
+    guarda en memoria algunas páginas (las últimas usadas, hasta `max_paginas`).
+
+    La vista pide las filas de la ventana visible con `filas`; las que aún no están cargadas
+    vuelven como None y `paginas_faltantes` indica qué páginas hay que pedir. Cada `reiniciar`
+    cambia la generación, de modo que las páginas pedidas con filtros anteriores se descartan.
+    Además recuerda el cursor (keyset) con el que empieza cada página ya vista, para pedir las
+    siguientes sin OFFSET; los cursores ocupan poco y no se descartan con las páginas.
+    """
+
+    def __init__(self, tam_pagina=200, max_paginas=25):
+        self.tam_pagina = tam_pagina
+        self.max_paginas = max_paginas
+        self.total = 0
+        self.generacion = 0
+        self.paginas = OrderedDict() # número de página -> lista de filas
+        self.pedidas = set() # páginas solicitadas al servidor que aún no han llegado
+        self.cursores = {0: ""} # número de página -> cursor con el que empieza
+
+    def reiniciar(self, total):
+        """Descarta las páginas guardadas y fija el nuevo total de filas."""
+        self.total = total
+        self.generacion += 1
+        self.paginas.clear()
+        self.pedidas.clear()
+        self.cursores = {0: ""}
+
+    def guardar_pagina(self, generacion, numero, filas, cursor_siguiente=None):
+        """
+        Guarda una página recibida del servidor y, si se indica, el cursor de la página siguiente.
+        Devuelve False si es de una generación anterior.
+        """
+        if generacion != self.generacion:
+            return False
+        self.pedidas.discard(numero)
+        if cursor_siguiente:
+            self.cursores[numero + 1] = cursor_siguiente
+        self.paginas[numero] = filas
+        self.paginas.move_to_end(numero)
+        while len(self.paginas) > self.max_paginas:
+            self.paginas.popitem(last=False)
+        return True
+
+    def descartar_pedida(self, generacion, numero):
+        """Olvida una petición fallida para que pueda volver a pedirse."""
+        if generacion == self.generacion:
+            self.pedidas.discard(numero)
+
+    def filas(self, inicio, cantidad):
+        """Filas [inicio, inicio + cantidad) limitadas al total; las no cargadas son None."""
+        resultado = []
+        for indice in range(max(inicio, 0), min(inicio + cantidad, self.total)):
+            pagina = self.paginas.get(indice // self.tam_pagina)
+            posicion = indice % self.tam_pagina
+            resultado.append(pagina[posicion] if pagina is not None and posicion < len(pagina) else None)
+        return resultado
+
+    def paginas_faltantes(self, inicio, cantidad, margen=0):
+        """
+        Páginas que cubren [inicio - margen, inicio + cantidad + margen) y no están cargadas ni
+        pedidas. Las de la ventana visible van primero. Marca como usadas las ya cargadas.
+        """
+        if self.total <= 0:
+            return []
+        primera = max(inicio, 0) // self.tam_pagina
+        ultima = (min(inicio + cantidad, self.total) - 1) // self.tam_pagina
+        con_margen = range(max(inicio - margen, 0) // self.tam_pagina,
+                           (min(inicio + cantidad + margen, self.total) - 1) // self.tam_pagina + 1)
+        orden = list(range(primera, ultima + 1)) + [n for n in con_margen if not primera <= n <= ultima]
+        faltantes = []
+        for numero in orden:
+            if numero in self.paginas:
+                self.paginas.move_to_end(numero)
+            elif numero not in self.pedidas:
+                faltantes.append(numero)
+        return faltantes
+
+    def actualizar_fila(self, id_fila, fila):
+        """Sustituye en las páginas guardadas la fila con ese id. Devuelve True si estaba cargada."""
+        for pagina in self.paginas.values():
+            for posicion, actual in enumerate(pagina):
+                if actual['id'] == id_fila:
+                    pagina[posicion] = fila
+                    return True
+        return False
+
+
+# Formatos que el servidor puede exportar (la extensión del archivo elige el formato)
+# Columnas del historial cuyos valores de filtro se piden a /sugerencias/<columna>
+COLUMNAS_SUGERENCIAS_HISTORIAL = {"Ubicación": "destino", "Proveedor": "proveedor"}
+# Número de opciones (las más usadas) que se muestran en el menú de filtro
+MAX_OPCIONES_FILTRO = 30
+
+FORMATOS_EXPORTACION = [("Excel files", "*.xlsx"), ("CSV files", "*.csv"), ("Parquet files", "*.parquet")]
+
+
+def formato_de_archivo(ruta):
+    """Devuelve el formato de exportación ('xlsx', 'csv' o 'parquet') según la extensión de `ruta`."""
+    extension = os.path.splitext(ruta)[1].lower().lstrip(".")
+    return extension if extension in ("csv", "parquet") else "xlsx"
+
+
+# Columnas de cada tipo de importación: columna -> nombres aceptados en la cabecera del archivo
+COLUMNAS_IMPORTACION = {
+    "historial": {
+        "Articulo": ("articulo", "artículo", "nombre"), "Tipo": ("tipo",), "Cantidad": ("cantidad",),
+        "Ubicacion": ("ubicacion", "ubicación", "destino"), "Proveedor": ("proveedor",), "Fecha": ("fecha",),
+    },
+    "inventario": {
+        "Nombre": ("nombre", "articulo", "artículo"), "Cantidad": ("cantidad",), "Proveedor": ("proveedor",),
+    },
+    "materiales": {
+        "Nombre": ("nombre", "material"),
+        "Unidad": ("unidad", "unidad_medicion", "unidad de medición", "unidad de medicion"),
+    },
+}
+COLUMNAS_OBLIGATORIAS = {
+    "historial": ("Articulo", "Tipo", "Cantidad"),
+    "inventario": ("Nombre", "Cantidad"),
+    "materiales": ("Nombre",),
+}
+RUTAS_IMPORTACION = {
+    "historial": "/historial/importar",
+    "inventario": "/inventario/importar",
+    "materiales": "/materiales/importar",
+}
+
+
+class ImportadorPorLotes:
+    """
+    Importa un archivo CSV o Excel al servidor por lotes, sin cargarlo entero en memoria.
+
+    El CSV se lee por bloques (`chunksize` de pandas) y el .xlsx con el iterador de filas del modo
+    de solo lectura de openpyxl, así que la memoria no crece con el tamaño del archivo. Cada lote de
+    `tam_lote` filas se normaliza y se envía al endpoint de importación del servidor. Tras cada lote
+    confirmado se guarda el avance en `ruta_progreso`; si la importación se cancela o falla, puede
+    reanudarse desde el último lote confirmado del mismo archivo. Cada lote se envía con una
+    clave de idempotencia (importación + número de lote): si el servidor confirmó un lote pero la
+    respuesta se perdió, al reanudar ese lote no se importa dos veces. Está pensado para ejecutarse en
+    un hilo propio: `al_progresar(fraccion, resumen)` se llama desde ese hilo.
+    """
+
+    def __init__(self, api, tipo, ruta_archivo, ruta_progreso, tam_lote=500, al_progresar=None):
+        self.api = api
+        self.tipo = tipo
+        self.ruta_archivo = ruta_archivo
+        self.ruta_progreso = ruta_progreso
+        self.tam_lote = tam_lote
+        self.al_progresar = al_progresar
+        self.cancelado = threading.Event()
+        estado = os.stat(ruta_archivo)
+        # Identifica el archivo para no reanudar con el progreso de otro archivo (o de otra versión)
+        self.firma = {
+            "tipo": tipo, "archivo": os.path.abspath(ruta_archivo), "tamano": estado.st_size,
+            "modificado": estado.st_mtime, "tam_lote": tam_lote,
+        }
+
+    def cancelar(self):
+        """Pide que la importación se detenga al terminar el lote en curso."""
+        self.cancelado.set()
+
+    def progreso_guardado(self):
+        """
+        Devuelve (lotes_confirmados, resumen, id_importacion) de una importación anterior del mismo
+        archivo, o (0, {}, None).
+        """
+        try:
+            with open(self.ruta_progreso, encoding="utf-8") as f:
+                progreso = json.load(f)
+        except (OSError, ValueError):
+            return 0, {}, None
+        if progreso.get("firma") != self.firma:
+            return 0, {}, None
+        return progreso.get("lotes", 0), progreso.get("resumen", {}), progreso.get("id")
+
+    def guardar_progreso(self, lotes, resumen, id_importacion):
+        # Se escribe en un temporal y se renombra para no dejar un archivo a medias
+        temporal = self.ruta_progreso + ".tmp"
+        with open(temporal, "w", encoding="utf-8") as f:
+            json.dump({"firma": self.firma, "lotes": lotes, "resumen": resumen, "id": id_importacion}, f)
+        os.replace(temporal, self.ruta_progreso)
+
+    def borrar_progreso(self):
+        try:
+            os.remove(self.ruta_progreso)
+        except OSError:
+            pass
+
+    def leer_bloques(self, saltar):
+        """
+        Genera (cabecera, filas, fraccion_leida) con bloques de `tam_lote` filas del archivo,
+        omitiendo las `saltar` primeras filas de datos.
+        """
+        if self.ruta_archivo.lower().endswith(".csv"):
+            tamano = max(self.firma["tamano"], 1)
+            with open(self.ruta_archivo, "rb") as f:
+                lector = pd.read_csv(f, chunksize=self.tam_lote, dtype=str, keep_default_na=False, encoding="utf-8-sig")
+                # Los bloques ya confirmados se leen y se descartan: así los lotes coinciden con los
+                # de la primera vez aunque haya líneas en blanco o campos con saltos de línea.
+                for bloque in islice(lector, saltar // self.tam_lote, None):
+                    yield list(bloque.columns), bloque.values.tolist(), min(f.tell() / tamano, 1.0)
+            return
+
+        if not OPENPYXL_AVAILABLE:
+            raise RuntimeError("Para importar archivos Excel se necesita la librería openpyxl.")
+        libro = openpyxl.load_workbook(self.ruta_archivo, read_only=True, data_only=True)
+        try:
+            hoja = libro.active
+            cabecera = next(hoja.iter_rows(max_row=1, values_only=True), ())
+            total = max((hoja.max_row or 0) - 1, 1)
+            filas = hoja.iter_rows(min_row=2 + saltar, values_only=True)
+            leidas = saltar
+            while True:
+                bloque = list(islice(filas, self.tam_lote))
+                if not bloque:
+                    break
+                leidas += len(bloque)
+                yield list(cabecera), bloque, min(leidas / total, 1.0)
+        finally:
+            libro.close()
+
+    def mapear_cabecera(self, cabecera):
+        """Devuelve, para cada columna del archivo, su columna de importación (o None si se ignora)."""
+        alias = {nombre: columna for columna, nombres in COLUMNAS_IMPORTACION[self.tipo].items() for nombre in nombres}
+        columnas = [alias.get(str(c or "").strip().lower()) for c in cabecera]
+        faltan = [c for c in COLUMNAS_OBLIGATORIAS[self.tipo] if c not in columnas]
+        if faltan:
+            raise ValueError(f"Faltan columnas en el archivo: {', '.join(faltan)}")
+        return columnas
+
+    @staticmethod
+    def normalizar_valor(valor):
+        """Convierte un valor de celda en algo serializable a JSON (fechas en ISO, enteros sin '.0')."""
+        if valor is None or (isinstance(valor, float) and pd.isna(valor)):
+            return None
+        if isinstance(valor, (datetime.datetime, datetime.date)):
+            return valor.isoformat(sep=" ") if isinstance(valor, datetime.datetime) else valor.isoformat()
+        if isinstance(valor, float) and valor.is_integer():
+            return int(valor)
+        if isinstance(valor, str):
+            valor = valor.strip()
+            return valor or None
+        return valor
+
+    def normalizar_fila(self, columnas, valores):
+        """Convierte una fila en un diccionario para el servidor. Devuelve None si no es válida."""
+        fila = {}
+        for columna, valor in zip(columnas, valores):
+            if columna is not None:
+                valor = self.normalizar_valor(valor)
+                if valor is not None:
+                    fila[columna] = valor
+        if any(fila.get(c) is None for c in COLUMNAS_OBLIGATORIAS[self.tipo]):
+            return None
+        if "Cantidad" in fila:
+            try:
+                float(fila["Cantidad"])
+            except (TypeError, ValueError):
+                return None
+        for columna in ("Articulo", "Nombre", "Ubicacion", "Proveedor", "Unidad"):
+            if isinstance(fila.get(columna), str):
+                fila[columna] = fila[columna].upper()
+        return fila
+
+    def ejecutar(self, reanudar=True):
+        """
+        Importa el archivo y devuelve el resumen acumulado (filas importadas, rechazadas, etc.).
+        Si `reanudar` es True, continúa desde el último lote confirmado. Si se cancela, el resumen
+        incluye 'cancelado' y el progreso queda guardado para reanudar más tarde.
+        """
+        lotes, resumen, id_importacion = self.progreso_guardado() if reanudar else (0, {}, None)
+        if id_importacion is None:
+            # Una importación nueva tiene su propio id (volver a importar el mismo archivo desde el
+            # principio no debe tomarse por un reintento). Se guarda antes de enviar el primer lote
+            # para que también ese lote pueda reanudarse sin duplicarse.
+            id_importacion = uuid.uuid4().hex
+            self.guardar_progreso(lotes, resumen, id_importacion)
+        ruta = RUTAS_IMPORTACION[self.tipo]
+        columnas = None
+
+        for cabecera, filas, fraccion in self.leer_bloques(lotes * self.tam_lote):
+            if self.cancelado.is_set():
+                return dict(resumen, cancelado=True)
+            if columnas is None:
+                columnas = self.mapear_cabecera(cabecera)
+
+            lote = []
+            for valores in filas:
+                if not any(v not in (None, "") for v in valores):
+                    continue # Fila vacía
+                fila = self.normalizar_fila(columnas, valores)
+                if fila is None:
+                    resumen["invalidas"] = resumen.get("invalidas", 0) + 1
+                else:
+                    lote.append(fila)
+
+            if lote:
+                headers = {"Idempotency-Key": f"importacion:{id_importacion}:{lotes}"}
+                response = self.api.post(ruta, json=lote, timeout=(10, 300), headers=headers)
+                if response.status_code >= 400:
+                    try:
+                        mensaje = response.json().get("message", response.text)
+                    except ValueError:
+                        mensaje = response.text
+                    raise RuntimeError(f"El servidor rechazó el lote {lotes + 1}: {mensaje}")
+                for clave, valor in response.json().items():
+                    if isinstance(valor, int):
+                        resumen[clave] = resumen.get(clave, 0) + valor
+
+            lotes += 1
+            self.guardar_progreso(lotes, resumen, id_importacion)
+            if self.al_progresar:
+                self.al_progresar(fraccion, dict(resumen))
+
+        self.borrar_progreso()
+        return resumen
+
+
 class InventarioApp:
     def __init__(self, root):
         self.root = root
@@ -217,26 +1163,100 @@ class InventarioApp:
         # --- CONFIGURACIÓN CLIENTE-SERVIDOR ---
         # Apunta a nuestro servidor en la nube, que está siempre activo.
         self.server_url = "https://inventario-server-zlvy.onrender.com"
-        self.sio = socketio.Client()
+        # Todas las peticiones HTTP comparten el pool de conexiones de este cliente
+        self.api = ClienteAPI(self.server_url)
+        # Imágenes de los materiales: LRU de imágenes decodificadas en memoria y copia en disco
+        self.cache_imagenes = CacheImagenes(self.api, os.path.join(self.image_dir, "cache"), self.en_segundo_plano)
+        self.tam_miniatura = (256, 256)
+        self.after_precarga_imagenes = None
+        self.sio = socketio.Client(http_session=self.api.session)
         self.setup_socketio_handlers()
 
-        # Listas para autocompletado (se cargarán desde el servidor)
+        # Listas para autocompletado (se cargan desde /sugerencias, las más usadas primero)
+        self.nombres_articulos = []
         self.nombres_proveedores = []
         self.nombres_destinos = []
+        self.max_sugerencias = 500
 
         # --- ESTADO PARA LA INTERFAZ ---
         self.filtros_activos = {} # Para los filtros de columna en el historial
+        self.ultima_seq = None # Última secuencia de cambios del servidor aplicada en las vistas
+        # Lista virtual del historial: el Treeview solo contiene las filas visibles y en memoria
+        # se guardan unas pocas páginas; el resto se pide al servidor al desplazarse.
+        self.modelo_historial = ModeloListaVirtual(tam_pagina=200, max_paginas=25)
+        self.historial_inicio = 0 # Índice (en el historial filtrado) de la primera fila visible
+        self.historial_params = None # Filtros con los que se cargó el modelo
+        self.historial_after_carga = None
+        # Ventana de silencio y espera máxima (ms) para agrupar recargas en ráfagas de cambios
+        self.ventana_recarga_ms = 300
+        self.max_espera_recarga_ms = 2000
+
+        # --- CACHÉ LOCAL ---
+        # Copia en disco de los datos del servidor para pintar las pestañas al instante al arrancar.
+        # Las escrituras van a un hilo propio, de una en una y en el mismo orden en que se piden.
+        self.cache_local = CacheLocal(os.path.join(self.base_path, "cache_inventario.sqlite3"), self.server_url)
+        self.executor_cache = ThreadPoolExecutor(max_workers=1, thread_name_prefix="inventario-cache")
+        # Vistas cuya copia local aún no es coherente con `ultima_seq` (tras una recarga completa,
+        # hasta que se descargan de nuevo sin filtros); mientras haya alguna no se guarda la secuencia.
+        self.vistas_sin_cache = set()
+
+        # --- MOVIMIENTOS PENDIENTES (BANDEJA DE SALIDA) ---
+        # Las entradas y salidas se guardan primero en disco y se envían después, en orden y por
+        # lotes, con una clave de idempotencia: si no hay conexión no se pierden, y un reintento
+        # nunca cuenta dos veces el mismo movimiento. Mientras tanto se muestran como pendientes.
+        self.pendientes = OrderedDict(
+            (clave, {'tipo': tipo, 'datos': datos, 'creado': creado})
+            for clave, tipo, datos, creado in self.cache_local.leer_pendientes())
+        self.enviando_pendientes = False
+        self.tam_lote_pendientes = 20
+        self.reintento_pendientes_ms = 30000
+        self.after_pendientes = None
+        self.aviso_sin_conexion = False
+        self.filas_inventario = {} # iid -> fila de /inventario mostrada (para sumarle lo pendiente)
+        self.filas_materiales = {} # iid -> fila de /materiales mostrada (con el nombre de su imagen)
+        self.deltas_pendientes = {} # nombre de artículo -> variación de stock pendiente de enviar
+        self.actualizar_deltas_pendientes()
+
+        # --- E/S DE RED EN SEGUNDO PLANO ---
+        # Las peticiones HTTP se ejecutan en este pool y sus resultados vuelven al hilo de Tk con `root.after`.
+        self.executor = ThreadPoolExecutor(max_workers=4, thread_name_prefix="inventario-http")
+        self.generaciones = {} # clave -> número de la última petición lanzada con esa clave
+        self.futuros = {} # clave -> futuro de la última petición lanzada con esa clave
+        self.tareas_en_curso = 0
 
         self.configurar_gui()
+
+        # Las recargas pedidas por los eventos del servidor se agrupan aquí. 'cambios' no depende
+        # de ninguna pestaña; las demás solo se recargan cuando su pestaña está visible.
+        self.pestanas = {"inventario": self.inventario_tab, "historial": self.historial_tab, "materiales": self.materiales_tab}
+        self.programador = ProgramadorRecargas(
+            self.root,
+            {
+                "cambios": self.sincronizar_cambios,
+                "inventario": self.mostrar_inventario_gui,
+                "historial": lambda: self.mostrar_historial_gui(filtro_articulo=self.articulo_entry_historial.get().strip()),
+                "materiales": self.mostrar_materiales_gui,
+            },
+            self.pestana_visible,
+            ventana_ms=self.ventana_recarga_ms,
+            max_espera_ms=self.max_espera_recarga_ms,
+        )
+        self.notebook.bind("<<NotebookTabChanged>>", self.on_tab_changed)
+
+        # Primero se pinta lo guardado en disco; después se reconcilia con el servidor en segundo plano
+        self.mostrar_desde_cache()
+        self.sincronizar_cambios()
+        self._recargar_datos_y_sugerencias()
+        self.programador.solicitar("historial")
+        self.enviar_pendientes()
         self.conectar_al_servidor()
 
     def conectar_al_servidor(self):
         """Intenta conectar con el servidor Socket.IO en un hilo separado."""
         def run():
             try:
+                # Al conectar (y al reconectar) se piden los cambios perdidos; ver `on_connect`
                 self.sio.connect(self.server_url)
-                # Una vez conectado, carga los datos iniciales
-                self.root.after(0, self.recargar_todo)
             except socketio.exceptions.ConnectionError as e:
                 self.root.after(0, lambda: self.mostrar_notificacion(f"Error de conexión: No se pudo conectar al servidor en {self.server_url}", "error"))
         
@@ -247,26 +1267,319 @@ class InventarioApp:
         @self.sio.on('connect')
         def on_connect():
             print("Conectado al servidor!")
+            # Se recuperan los cambios ocurridos mientras no había conexión y se envían los pendientes
+            self.root.after(0, lambda: self.programador.solicitar("cambios"))
+            self.root.after(0, self.enviar_pendientes)
 
         @self.sio.on('actualizacion_servidor')
         def on_server_update(data):
-            print(f"Recibida actualización del servidor: {data}")
-            # El servidor nos dice que algo cambió, así que recargamos las vistas.
+            print(f"Recibida actualización del servidor: seq={data.get('seq')}")
+            # El evento trae las filas que cambiaron; solo se parchean esas filas.
             # Usamos `root.after` para asegurar que la actualización de GUI se ejecute en el hilo principal.
-            self.root.after(0, self.recargar_todo)
+            self.root.after(0, lambda: self.procesar_notificacion(data))
 
         @self.sio.on('disconnect')
         def on_disconnect():
             print("Desconectado del servidor.")
             self.root.after(0, lambda: self.mostrar_notificacion("Desconectado del servidor.", "error"))
 
+    def en_segundo_plano(self, funcion, al_terminar=None, al_fallar=None, clave=None):
+        """
+        Ejecuta `funcion` (que hace la E/S de red) en el pool de hilos y entrega su resultado
+        a `al_terminar` (o la excepción a `al_fallar`) en el hilo principal de Tk.
+        Las peticiones con la misma `clave` se sustituyen entre sí: al lanzar una nueva se
+        cancela la anterior si aún no ha empezado, y su resultado se descarta si llega tarde.
+        """
+        generacion = None
+        if clave is not None:
+            generacion = self.generaciones[clave] = self.generaciones.get(clave, 0) + 1
+            anterior = self.futuros.get(clave)
+            if anterior is not None and anterior.cancel():
+                self.cambiar_tareas_en_curso(-1)
+
+        def entregar(resultado, error):
+            self.cambiar_tareas_en_curso(-1)
+            if clave is not None:
+                if self.generaciones.get(clave) != generacion:
+                    return # Hay una petición más reciente con la misma clave
+                self.futuros.pop(clave, None)
+            if error is None:
+                if al_terminar:
+                    al_terminar(resultado)
+            elif al_fallar:
+                al_fallar(error)
+            else:
+                self.mostrar_notificacion(f"Error al comunicarse con el servidor: {error}", "error")
+
+        def trabajo():
+            try:
+                resultado, error = funcion(), None
+            except Exception as e:
+                resultado, error = None, e
+            self.root.after(0, lambda: entregar(resultado, error))
+
+        self.cambiar_tareas_en_curso(1)
+        futuro = self.executor.submit(trabajo)
+        if clave is not None:
+            self.futuros[clave] = futuro
+
+    def cambiar_tareas_en_curso(self, delta):
+        """Lleva la cuenta de las peticiones en curso y muestra u oculta el indicador de carga."""
+        self.tareas_en_curso += delta
+        if self.tareas_en_curso > 0:
+            self.indicador_carga.place(relx=0.0, rely=1.0, x=10, y=-10, anchor="sw")
+            self.indicador_carga.lift()
+        else:
+            self.indicador_carga.place_forget()
+
+    def get_json(self, ruta, params=None):
+        """Petición GET al servidor que devuelve el JSON de la respuesta. Pensada para `en_segundo_plano`."""
+        return self.api.get_json(ruta, params)
+
+    def pestana_visible(self, vista):
+        """Indica si la pestaña de una vista es la seleccionada (las demás vistas siempre cuentan como visibles)."""
+        pestana = self.pestanas.get(vista)
+        return pestana is None or self.notebook.select() == str(pestana)
+
+    def on_tab_changed(self, event=None):
+        """Al cambiar de pestaña, hace la recarga que estuviera pendiente para esa vista."""
+        seleccionada = self.notebook.select()
+        for vista, pestana in self.pestanas.items():
+            if seleccionada == str(pestana):
+                self.programador.vista_mostrada(vista)
+
     def recargar_todo(self):
         """Función central para recargar todos los datos y vistas desde el servidor."""
-        self.mostrar_inventario_gui()
-        self.mostrar_historial_gui()
-        # self.mostrar_materiales_gui() # Descomentar cuando implementes la API de materiales
-        # self._recargar_datos_y_sugerencias() # Descomentar cuando implementes la API de sugerencias
+        # La secuencia se consulta antes de la carga completa: lo que cambie durante la carga
+        # llegará después por /cambios y se aplicará de nuevo sin efectos (son upserts).
+        def al_terminar(data):
+            self.ultima_seq = data['seq']
+            # La copia local deja de ser coherente hasta que se vuelvan a descargar las vistas
+            self.vistas_sin_cache = {"inventario", "materiales"}
+            self.guardar_en_cache(self.cache_local.escribir_meta, "seq", None)
+            # Las pestañas no visibles se recargarán cuando se seleccionen
+            self.programador.solicitar("inventario", "historial", "materiales")
+
+        def al_fallar(error):
+            self.ultima_seq = None
+            self.programador.solicitar("inventario", "historial", "materiales")
+
+        self.en_segundo_plano(lambda: self.get_json("/cambios"), al_terminar, al_fallar, clave="cambios")
+        self._recargar_datos_y_sugerencias()
+
+    def _recargar_datos_y_sugerencias(self):
+        """Descarga de /sugerencias las listas de autocompletado de artículos, proveedores y destinos."""
+        def cargar():
+            params = {'limite': self.max_sugerencias}
+            return [self.get_json(f"/sugerencias/{columna}", params) for columna in ("articulo", "proveedor", "destino")]
+
+        def al_terminar(listas):
+            self.nombres_articulos, self.nombres_proveedores, self.nombres_destinos = listas
+            self.actualizar_autocompletado()
+
+        self.en_segundo_plano(cargar, al_terminar, lambda e: print(f"No se pudieron cargar las sugerencias: {e}"),
+                              clave="sugerencias")
+
+    def agregar_sugerencias(self, movimiento):
+        """Añade a las listas de autocompletado los valores nuevos de un movimiento recibido del servidor."""
+        nuevos = False
+        for lista, valor in ((self.nombres_articulos, movimiento.get('Articulo')),
+                             (self.nombres_proveedores, movimiento.get('Proveedor')),
+                             (self.nombres_destinos, movimiento.get('Ubicacion'))):
+            if valor and valor not in lista:
+                lista.append(valor)
+                nuevos = True
+        if nuevos:
+            self.actualizar_autocompletado()
+
+    def actualizar_autocompletado(self):
+        self.articulo_entry_historial.set_sugerencias(self.nombres_articulos)
+        self.proveedor_entry.set_sugerencias(self.nombres_proveedores)
+        self.destino_entry.set_sugerencias(self.nombres_destinos)
 
+    def sincronizar_cambios(self):
+        """
+        Descarga solo los cambios posteriores a `self.ultima_seq` y los aplica en las vistas.
+        Si no hay una secuencia de partida o el servidor pide resincronizar, recarga todo.
+        """
+        if self.ultima_seq is None:
+            self.recargar_todo()
+            return
+
+        def al_terminar(data):
+            if data.get('resync'):
+                self.recargar_todo()
+                return
+            if self.ultima_seq is not None and data['seq'] <= self.ultima_seq:
+                return # Mientras tanto ya se aplicaron notificaciones iguales o más recientes
+            self.aplicar_cambios(data['cambios'])
+            self.ultima_seq = data['seq']
+            self.guardar_seq_en_cache()
+
+        since = self.ultima_seq
+        self.en_segundo_plano(
+            lambda: self.get_json("/cambios", {'since': since}), al_terminar,
+            lambda e: self.mostrar_notificacion(f"Error al sincronizar con el servidor: {e}", "error"),
+            clave="cambios")
+
+    def procesar_notificacion(self, data):
+        """
+        Aplica los cambios que llegan en una notificación del servidor. Solo se aplican
+        directamente si son los siguientes a la última secuencia conocida; si falta alguna
+        secuencia intermedia, o el servidor pide resincronizar, se consulta /cambios.
+        """
+        seq = data.get('seq')
+        if self.ultima_seq is not None and seq is not None and seq <= self.ultima_seq:
+            return # Ya aplicado (p. ej. por una sincronización anterior)
+
+        if data.get('resync') or 'cambios' not in data or self.ultima_seq is None or seq != self.ultima_seq + 1:
+            # Una ráfaga de eventos fuera de secuencia se resuelve con una sola consulta a /cambios
+            self.programador.solicitar("cambios")
+            return
+        self.aplicar_cambios(data['cambios'])
+        self.ultima_seq = seq
+        self.guardar_seq_en_cache()
+
+    def aplicar_cambios(self, cambios):
+        """Aplica en los Treeviews una lista de cambios (formato de /cambios), fila a fila."""
+        recargar_historial = False
+        for cambio in cambios:
+            entidad = cambio['entidad']
+            if entidad in ('articulo', 'material'):
+                # La copia local tiene las tablas completas, así que el cambio se aplica aunque
+                # la fila no se vea (p. ej. por la búsqueda activa)
+                vista = 'inventario' if entidad == 'articulo' else 'materiales'
+                self.guardar_en_cache(self.cache_local.aplicar, vista, cambio['id'], cambio.get('datos'))
+            if entidad == 'articulo':
+                self.aplicar_cambio_inventario(cambio)
+            elif entidad == 'movimiento':
+                if cambio.get('datos'):
+                    self.agregar_sugerencias(cambio['datos'])
+                recargar_historial |= not self.aplicar_cambio_historial(cambio)
+            elif entidad == 'material':
+                self.aplicar_cambio_material(cambio)
+                # La unidad de medida aparece en las filas del historial
+                recargar_historial = True
+
+        if recargar_historial:
+            self.programador.solicitar("historial")
+
+    def guardar_en_cache(self, funcion, *args):
+        """Ejecuta una escritura de la caché local en su hilo (en orden); los errores solo se registran."""
+        def escribir():
+            try:
+                funcion(*args)
+            except sqlite3.Error as e:
+                print(f"No se pudo actualizar la caché local: {e}")
+        self.executor_cache.submit(escribir)
+
+    def guardar_seq_en_cache(self):
+        """Guarda `ultima_seq` si todas las vistas de la copia local son coherentes con ella."""
+        if self.ultima_seq is not None and not self.vistas_sin_cache:
+            self.guardar_en_cache(self.cache_local.escribir_meta, "seq", self.ultima_seq)
+
+    def vista_guardada_en_cache(self, vista, filas):
+        """Guarda una descarga completa (sin filtros) de una vista en la copia local."""
+        self.guardar_en_cache(self.cache_local.reemplazar, vista, filas)
+        if vista in self.vistas_sin_cache:
+            self.vistas_sin_cache.discard(vista)
+            self.guardar_seq_en_cache()
+
+    def mostrar_desde_cache(self):
+        """Pinta las pestañas con los datos de la copia local y recupera la secuencia guardada."""
+        try:
+            inventario = self.cache_local.leer('inventario')
+            materiales = self.cache_local.leer('materiales')
+            historial = self.cache_local.leer('historial')
+            total_historial = self.cache_local.leer_meta('historial_total')
+            self.ultima_seq = self.cache_local.leer_meta('seq')
+        except (sqlite3.Error, ValueError) as e:
+            print(f"No se pudo leer la caché local: {e}")
+            return
+
+        if self.ultima_seq is None:
+            self.vistas_sin_cache = {"inventario", "materiales"}
+        self.filas_inventario = {str(fila['id']): fila for fila in inventario}
+        # Las filas aplicadas desde /cambios se añaden al final: se ordenan como lo hace el servidor
+        self.reconciliador_inventario.reconciliar(
+            (str(fila['id']),) + self.valores_inventario(fila) for fila in sorted(inventario, key=lambda f: f['nombre']))
+        self.filas_materiales = {str(fila['id']): fila for fila in materiales}
+        self.reconciliador_materiales.reconciliar(
+            (str(fila['id']),) + self.valores_material(fila) for fila in sorted(materiales, key=lambda f: f['nombre']))
+        if historial:
+            self.historial_params = {}
+            self.modelo_historial.reiniciar(max(total_historial or 0, len(historial)))
+            self.modelo_historial.guardar_pagina(self.modelo_historial.generacion, 0, historial)
+            self.pintar_historial()
+
+    def aplicar_cambio_inventario(self, cambio):
+        """Inserta, actualiza o elimina una fila del inventario según un cambio del servidor."""
+        iid = str(cambio['id'])
+        fila = cambio.get('datos')
+        termino = self.busqueda_inventario_entry.get().strip().lower()
+        if cambio['operacion'] == 'delete' or (termino and termino not in fila['nombre'].lower()):
+            self.filas_inventario.pop(iid, None)
+            self.reconciliador_inventario.eliminar(iid)
+            return
+
+        self.filas_inventario[iid] = fila
+        values, tags = self.valores_inventario(fila)
+        self.reconciliador_inventario.pintar(iid, values, tags,
+                                             indice=self.reconciliador_inventario.posicion_ordenada(fila['nombre']))
+
+    def aplicar_cambio_historial(self, cambio):
+        """
+        Aplica un cambio de movimiento en el historial. Devuelve False si no se puede aplicar
+        en el sitio y hay que volver a pedir la ventana visible al servidor: altas y bajas
+        desplazan las posiciones de la lista virtual, y con filtros activos la fila podría dejar
+        de coincidir.
+        """
+        if cambio['operacion'] == 'delete' or self.filtros_activos or self.articulo_entry_historial.get().strip():
+            return False
+        if self.modelo_historial.actualizar_fila(cambio['id'], cambio['datos']):
+            self.pintar_historial()
+            return True
+        return False
+
+    def aplicar_cambio_material(self, cambio):
+        """Inserta, actualiza o elimina una fila de materiales según un cambio del servidor."""
+        iid = str(cambio['id'])
+        if cambio['operacion'] == 'delete':
+            self.filas_materiales.pop(iid, None)
+            self.reconciliador_materiales.eliminar(iid)
+            return
+
+        self.filas_materiales[iid] = cambio['datos']
+        values, tags = self.valores_material(cambio['datos'])
+        self.reconciliador_materiales.pintar(
+            iid, values, tags, indice=self.reconciliador_materiales.posicion_ordenada(cambio['datos']['nombre'], columna=1))
+        if iid in self.tree_materiales.selection():
+            self.mostrar_vista_previa_material()
+        self.programar_precarga_imagenes()
+
+    def valores_inventario(self, fila):
+        """
+        Convierte una fila de /inventario en los valores y las etiquetas del Treeview.
+        A la cantidad se le suman los movimientos pendientes de enviar de ese artículo.
+        """
+        # El servidor nos da la unidad de medida directamente
+        delta = self.deltas_pendientes.get(fila['nombre'], 0)
+        return (fila['nombre'], fila['cantidad'] + delta, fila['unidad_medicion'] or ''), (('pendiente',) if delta else ())
+
+    def valores_historial(self, fila):
+        """Convierte una fila de /historial en los valores y la etiqueta (tag) del Treeview."""
+        fecha = datetime.datetime.fromisoformat(fila['fecha']).strftime('%Y-%m-%d %H:%M:%S')
+        values = (fila['Articulo'], fila['Tipo'], fila['cantidad'], fila['Unidad'] or '',
+                  fila['Ubicacion'] or '', fila['Proveedor'] or '', fecha)
+        # Determinar la etiqueta (tag) según el tipo de movimiento para colorear la fila
+        tag = 'entrada' if fila['Tipo'] == 'Entrada' else 'salida'
+        return values, tag
+
+    def valores_material(self, fila):
+        """Convierte una fila de /materiales en los valores y las etiquetas del Treeview."""
+        con_imagen = bool(fila.get('imagen_path'))
+        values = ("✔" if con_imagen else "", fila['nombre'], fila['unidad_medicion'] or '')
+        return values, (('con_imagen',) if con_imagen else ())
 
     def configurar_gui(self):
         """
@@ -286,6 +1599,9 @@ class InventarioApp:
         self.notificacion_frame = tk.Frame(self.root, bg=COLOR_PALETTE["background"])
         self.notificacion_frame.pack(side="bottom", padx=10, pady=10, anchor="e")
 
+        # Indicador de carga: se muestra mientras haya peticiones al servidor en curso
+        self.indicador_carga = ttk.Label(self.root, text="⟳ Cargando...")
+
         self.notebook = ttk.Notebook(self.root)
         self.notebook.pack(expand=True, fill="both", padx=10, pady=10)
 
@@ -328,6 +1644,8 @@ class InventarioApp:
 
         # Se ha eliminado la columna de "Proveedor" a petición del usuario.
         self.tree_inventario = ttk.Treeview(tree_frame, columns=("Nombre", "Cantidad", "Unidad"), show="headings")
+        self.reconciliador_inventario = ReconciliadorTreeview(self.tree_inventario)
+        self.tree_inventario.tag_configure('pendiente', foreground=COLOR_PALETTE["primary"])
         self.tree_inventario.heading("Nombre", text="Nombre")
         self.tree_inventario.heading("Cantidad", text="Cantidad")
         self.tree_inventario.heading("Unidad", text="Unidad")
@@ -347,8 +1665,6 @@ class InventarioApp:
         self.menu_contextual.add_command(label="Eliminar Artículo", command=self.eliminar_articulo_gui)
         self.tree_inventario.bind("<Button-3>", self.mostrar_menu_contextual)
 
-        self.mostrar_inventario_gui()
-
     def mostrar_menu_contextual(self, event):
         """
         Muestra el menú contextual al hacer clic derecho en un ítem de la tabla del inventario.
@@ -496,64 +1812,56 @@ class InventarioApp:
         """
         Actualiza y muestra la lista de artículos en el Treeview del inventario.
         """
-        for item in self.tree_inventario.get_children():
-            self.tree_inventario.delete(item)
-
-        try:
-            response = requests.get(f"{self.server_url}/inventario")
-            response.raise_for_status()  # Lanza una excepción para códigos de error HTTP
-            inventario = response.json() # Espera una lista de diccionarios
-
-            for item in inventario:
-                # Adaptar los datos recibidos a las columnas del Treeview
-                # El servidor ahora nos da la unidad de medida directamente
-                values = (item['nombre'], item['cantidad'], item['unidad_medicion'])
-                self.tree_inventario.insert('', 'end', values=values)
-
-        except requests.exceptions.RequestException as e:
-            self.mostrar_notificacion(f"Error al conectar con el servidor: {e}", "error")
-        except Exception as e:
-            self.mostrar_notificacion(f"Error al procesar la respuesta del servidor: {e}", "error")
+        # El filtrado se hace en el servidor: solo se descargan los artículos que coinciden con la búsqueda
+        params = {}
+        termino_busqueda = self.busqueda_inventario_entry.get().strip()
+        if termino_busqueda:
+            params['q'] = termino_busqueda
+
+        def al_terminar(inventario): # Espera una lista de diccionarios
+            if not params:
+                self.vista_guardada_en_cache('inventario', inventario)
+            self.filas_inventario = {str(item['id']): item for item in inventario}
+            # El id del artículo se usa como iid: solo se tocan las filas que han cambiado
+            self.reconciliador_inventario.reconciliar(
+                (str(item['id']),) + self.valores_inventario(item) for item in inventario)
+
+        # Si se pide otra recarga (p. ej. al seguir escribiendo en la búsqueda), esta se descarta
+        self.en_segundo_plano(
+            lambda: self.get_json("/inventario", params), al_terminar,
+            lambda e: self.mostrar_notificacion(f"Error al conectar con el servidor: {e}", "error"),
+            clave="inventario")
 
     def filtrar_inventario(self, event=None):
         """
         Filtra el Treeview del inventario basándose en el término de búsqueda.
         """
-        termino_busqueda = self.busqueda_inventario_entry.get().lower().strip()
-        # NOTA: El filtrado ahora debería hacerse en el lado del cliente sobre los datos ya cargados,
-        # o el servidor debería proporcionar un endpoint de búsqueda (ej. /inventario?q=termino)
-        self.mostrar_inventario_gui() # Por ahora, solo recargamos todo
-        self.mostrar_notificacion("El filtrado en vivo aún no está implementado para el modo servidor.", "info")
+        # `mostrar_inventario_gui` envía el término de búsqueda al servidor (/inventario?q=termino)
+        self.mostrar_inventario_gui()
 
     def importar_inventario(self):
-        """Importa datos de artículos desde un archivo Excel."""
-        filepath = filedialog.askopenfilename(
-            defaultextension=".xlsx",
-            filetypes=[("Excel files", "*.xlsx"), ("CSV files", "*.csv")]
-        )
-        if not filepath:
-            return
-
-        # NOTA: La importación masiva requeriría una API específica en el servidor.
-        self.mostrar_notificacion("La importación masiva debe hacerse a través de la API del servidor.", "info")
+        """
+        Importa datos de artículos desde un archivo Excel o CSV con las columnas
+        'Nombre', 'Cantidad' y opcionalmente 'Proveedor'. La cantidad sustituye al stock actual.
+        """
+        self.importar_archivo("inventario", "Importando inventario")
 
     def exportar_inventario(self):
-        """Exporta los datos del inventario a un archivo Excel."""
+        """Exporta los datos del inventario a un archivo Excel, CSV o Parquet generado por el servidor."""
         filepath = filedialog.asksaveasfilename(
             defaultextension=".xlsx",
-            filetypes=[("Excel files", "*.xlsx")]
+            filetypes=FORMATOS_EXPORTACION
         )
         if not filepath:
             return
 
-        try:
-            response = requests.get(f"{self.server_url}/inventario")
-            response.raise_for_status()
-            df = pd.DataFrame(response.json())
-            df.to_excel(filepath, index=False, header=["Nombre", "Cantidad", "Unidad"])
-            self.mostrar_notificacion(f"Inventario exportado a: {filepath}", "exito")
-        except Exception as e:
-            self.mostrar_notificacion(f"Error al exportar el inventario: {e}", "error")
+        def exportar():
+            self.api.descargar("/inventario/export", filepath, params={"format": formato_de_archivo(filepath)})
+
+        self.en_segundo_plano(
+            exportar,
+            lambda _: self.mostrar_notificacion(f"Inventario exportado a: {filepath}", "exito"),
+            lambda e: self.mostrar_notificacion(f"Error al exportar el inventario: {e}", "error"))
 
     def configurar_materiales_tab(self):
         """
@@ -582,6 +1890,7 @@ class InventarioApp:
 
         # Se elimina la columna de ID
         self.tree_materiales = ttk.Treeview(tree_frame_mat, columns=("Imagen", "Nombre", "Unidad"), show="headings")
+        self.reconciliador_materiales = ReconciliadorTreeview(self.tree_materiales)
         self.tree_materiales.heading("Imagen", text="Img")
         self.tree_materiales.heading("Nombre", text="Nombre del Material")
         self.tree_materiales.heading("Unidad", text="Unidad de Medición")
@@ -593,10 +1902,23 @@ class InventarioApp:
         # Tag para colorear el indicador de imagen
         self.tree_materiales.tag_configure('con_imagen', foreground='green')
 
+        # Vista previa de la miniatura del material seleccionado
+        frame_vista_previa = ttk.LabelFrame(tree_frame_mat, text="Imagen", padding=5)
+        frame_vista_previa.pack(side="right", fill="y", padx=(10, 0))
+        self.vista_previa_material = ttk.Label(frame_vista_previa, text="Sin imagen", anchor="center",
+                                               width=self.tam_miniatura[0] // 7)
+        self.vista_previa_material.pack(fill="both", expand=True)
+
+        def al_desplazar(*args):
+            scrollbar_mat.set(*args)
+            self.programar_precarga_imagenes()
+
         scrollbar_mat = ttk.Scrollbar(tree_frame_mat, orient="vertical", command=self.tree_materiales.yview)
-        self.tree_materiales.configure(yscrollcommand=scrollbar_mat.set)
+        self.tree_materiales.configure(yscrollcommand=al_desplazar)
         scrollbar_mat.pack(side="right", fill="y")
         self.tree_materiales.pack(side="left", fill="both", expand=True)
+        self.tree_materiales.bind("<<TreeviewSelect>>", self.mostrar_vista_previa_material)
+        self.tree_materiales.bind("<Configure>", lambda e: self.programar_precarga_imagenes())
 
         # Código para el menú contextual de materiales
         self.menu_contextual_materiales = tk.Menu(self.root, tearoff=0)
@@ -606,8 +1928,6 @@ class InventarioApp:
         self.tree_materiales.bind("<Button-3>", self.mostrar_menu_contextual_materiales)
         self.tree_materiales.bind("<Double-1>", self.visualizar_imagen_material)
 
-        self.mostrar_materiales_gui()
-
     def mostrar_menu_contextual_materiales(self, event):
         """
         Muestra el menú contextual al hacer clic derecho en un ítem de la tabla de materiales.
@@ -636,11 +1956,17 @@ class InventarioApp:
         """
         Actualiza y muestra la lista de materiales predefinidos en el Treeview.
         """
-        for item in self.tree_materiales.get_children():
-            self.tree_materiales.delete(item)
+        def al_terminar(materiales):
+            self.vista_guardada_en_cache('materiales', materiales)
+            self.filas_materiales = {str(material['id']): material for material in materiales}
+            self.reconciliador_materiales.reconciliar(
+                (str(material['id']),) + self.valores_material(material) for material in materiales)
+            self.programar_precarga_imagenes()
 
-        # NOTA: Implementar API GET /materiales en el servidor
-        self.mostrar_notificacion("La carga de materiales no está implementada para el modo servidor.", "info")
+        self.en_segundo_plano(
+            lambda: self.get_json("/materiales"), al_terminar,
+            lambda e: self.mostrar_notificacion(f"Error al cargar los materiales: {e}", "error"),
+            clave="materiales")
 
     def agregar_material_gui(self):
         """
@@ -736,16 +2062,8 @@ class InventarioApp:
             self.mostrar_notificacion("La eliminación de materiales no está implementada para el modo servidor.", "info")
 
     def importar_materiales(self):
-        """Importa datos de materiales desde un archivo Excel."""
-        filepath = filedialog.askopenfilename(
-            defaultextension=".xlsx",
-            filetypes=[("Excel files", "*.xlsx"), ("CSV files", "*.csv")]
-        )
-        if not filepath:
-            return
-
-        # NOTA: Implementar API POST /materiales/importar en el servidor
-        self.mostrar_notificacion("La importación de materiales no está implementada para el modo servidor.", "info")
+        """Importa datos de materiales desde un archivo Excel o CSV con las columnas 'Nombre' y 'Unidad'."""
+        self.importar_archivo("materiales", "Importando materiales")
 
     def exportar_materiales(self):
         """Exporta los datos de los materiales a un archivo Excel."""
@@ -764,30 +2082,48 @@ class InventarioApp:
 
     def agregar_imagen_material_gui(self):
         """
-        Abre un diálogo para seleccionar una imagen y asociarla a un material.
+        Abre un diálogo para seleccionar una imagen y la sube al servidor para el material
+        seleccionado (POST /materiales/<id>/imagen). El servidor genera la miniatura.
         """
         seleccion = self.tree_materiales.selection()
         if not seleccion:
             self.mostrar_notificacion("Por favor, seleccione un material.", "error")
             return
 
-        item = self.tree_materiales.item(seleccion[0])
+        material_id = seleccion[0]
+        item = self.tree_materiales.item(material_id)
         nombre_material = item['values'][1]
 
         filepath = filedialog.askopenfilename(
             title="Seleccionar imagen para el material",
-            filetypes=[("Archivos de Imagen", "*.png *.jpg *.jpeg *.gif *.bmp"), ("Todos los archivos", "*.*")]
+            filetypes=[("Archivos de Imagen", "*.png *.jpg *.jpeg *.gif *.bmp *.webp"), ("Todos los archivos", "*.*")]
         )
 
         if not filepath:
             return
 
-        # NOTA: Implementar API POST /material/<id>/imagen en el servidor
-        self.mostrar_notificacion("La carga de imágenes no está implementada para el modo servidor.", "info")
+        def subir():
+            with open(filepath, 'rb') as archivo:
+                response = self.api.post(f"/materiales/{material_id}/imagen", timeout=(10, 120),
+                                         files={'imagen': (os.path.basename(filepath), archivo)})
+            if not response.ok:
+                try:
+                    mensaje = response.json().get('message', response.reason)
+                except ValueError:
+                    mensaje = response.reason
+                raise RuntimeError(mensaje)
+            return response.json()
+
+        # La fila se actualizará con el evento de WebSocket del servidor
+        self.en_segundo_plano(
+            subir,
+            lambda data: self.mostrar_notificacion(f"Imagen de '{nombre_material}' guardada.", "exito"),
+            lambda e: self.mostrar_notificacion(f"Error al subir la imagen: {e}", "error"))
 
     def visualizar_imagen_material(self, event):
         """
-        Muestra la imagen asociada a un material al hacer doble clic.
+        Muestra la imagen asociada a un material al hacer doble clic. La imagen a tamaño
+        completo solo se descarga aquí, nunca al navegar por la lista de materiales.
         """
         if not PIL_AVAILABLE:
             self.mostrar_notificacion("La librería 'Pillow' es necesaria para ver imágenes.\nInstálala con: pip install Pillow", "error")
@@ -799,9 +2135,71 @@ class InventarioApp:
 
         item = self.tree_materiales.item(item_id)
         nombre_material = item['values'][1]
+        imagen = (self.filas_materiales.get(item_id) or {}).get('imagen_path')
+        if not imagen:
+            self.mostrar_notificacion(f"El material '{nombre_material}' no tiene imagen.", "info")
+            return
+
+        # Tamaño máximo para que quepa en la pantalla (Tk solo se consulta desde su hilo)
+        maximo = (int(self.root.winfo_screenwidth() * 0.8), int(self.root.winfo_screenheight() * 0.8))
+
+        def mostrar(foto):
+            ventana = tk.Toplevel(self.root)
+            ventana.title(f"Imagen de {nombre_material}")
+            etiqueta = ttk.Label(ventana, image=foto)
+            etiqueta.image = foto # Se guarda una referencia para que no la libere el recolector
+            etiqueta.pack(padx=10, pady=10)
+
+        self.cache_imagenes.obtener(
+            item_id, imagen, 'full', mostrar, maximo=maximo,
+            al_fallar=lambda e: self.mostrar_notificacion(f"Error al cargar la imagen: {e}", "error"))
+
+    def mostrar_vista_previa_material(self, event=None):
+        """Muestra la miniatura del material seleccionado (de la caché o descargándola en segundo plano)."""
+        seleccion = self.tree_materiales.selection()
+        iid = seleccion[0] if seleccion else None
+        imagen = (self.filas_materiales.get(iid) or {}).get('imagen_path')
+        self.vista_previa_material.config(image="", text="Sin imagen" if iid else "")
+        self.vista_previa_material.image = None
+        if not imagen or not PIL_AVAILABLE:
+            return
 
-        # NOTA: La visualización de imágenes requeriría que el servidor también sirva los archivos de imagen.
-        self.mostrar_notificacion("La visualización de imágenes no está implementada para el modo servidor.", "info")
+        def mostrar(foto):
+            # Solo si el material sigue seleccionado y con la misma imagen
+            if self.tree_materiales.selection()[:1] == (iid,) and (self.filas_materiales.get(iid) or {}).get('imagen_path') == imagen:
+                self.vista_previa_material.config(image=foto, text="")
+                # Referencia propia: la caché puede descartar la imagen mientras se muestra
+                self.vista_previa_material.image = foto
+
+        def al_fallar(error):
+            if self.tree_materiales.selection()[:1] == (iid,):
+                self.vista_previa_material.config(text="Imagen no disponible")
+
+        self.vista_previa_material.config(text="Cargando...")
+        self.cache_imagenes.obtener(iid, imagen, 'thumb', mostrar, maximo=self.tam_miniatura, al_fallar=al_fallar)
+
+    def programar_precarga_imagenes(self):
+        """Agrupa las peticiones de precarga (desplazamiento, cambios) en una sola tras una breve pausa."""
+        if self.after_precarga_imagenes:
+            self.root.after_cancel(self.after_precarga_imagenes)
+        self.after_precarga_imagenes = self.root.after(150, self.precargar_imagenes_visibles)
+
+    def precargar_imagenes_visibles(self):
+        """Carga en la caché las miniaturas de las filas de materiales visibles en pantalla."""
+        self.after_precarga_imagenes = None
+        if not PIL_AVAILABLE or not self.tree_materiales.winfo_ismapped():
+            return
+        filas = self.tree_materiales.get_children()
+        primera = self.tree_materiales.identify_row(1)
+        if not filas or not primera:
+            return
+        inicio = self.tree_materiales.index(primera)
+        ultima = self.tree_materiales.identify_row(self.tree_materiales.winfo_height() - 2)
+        fin = self.tree_materiales.index(ultima) if ultima else len(filas) - 1
+        for iid in filas[inicio:fin + 1]:
+            imagen = (self.filas_materiales.get(iid) or {}).get('imagen_path')
+            if imagen:
+                self.cache_imagenes.obtener(iid, imagen, 'thumb', maximo=self.tam_miniatura)
 
     def configurar_historial_tab(self):
         """
@@ -843,6 +2241,7 @@ class InventarioApp:
 
         ttk.Button(frame_botones, text="Registrar Entrada", command=self.registrar_entrada).pack(side="left", padx=5)
         ttk.Button(frame_botones, text="Registrar Salida", command=self.registrar_salida).pack(side="left", padx=5)
+        ttk.Button(frame_botones, text="Registrar Varios", command=self.registrar_lote_gui).pack(side="left", padx=5)
         # Se agrega el nuevo botón para importar historial
         ttk.Button(frame_botones, text="Importar Historial", command=self.importar_historial).pack(side="left", padx=5)
         ttk.Button(frame_botones, text="Exportar Historial", command=self.exportar_historial).pack(side="left", padx=5)
@@ -861,6 +2260,7 @@ class InventarioApp:
 
         # Se elimina la columna de ID y se añade la de unidad
         self.tree_historial = ttk.Treeview(tree_frame_hist, columns=("Artículo", "Tipo", "Cantidad", "Unidad", "Ubicación", "Proveedor", "Fecha"), show="headings")
+        self.reconciliador_historial = ReconciliadorTreeview(self.tree_historial)
         self.tree_historial.heading("Artículo", text="Artículo")
         self.tree_historial.heading("Tipo", text="Tipo")
         self.tree_historial.heading("Cantidad", text="Cantidad")
@@ -881,12 +2281,19 @@ class InventarioApp:
         self.tree_historial.column("Proveedor", stretch=tk.YES)
         self.tree_historial.column("Fecha", stretch=tk.YES)
 
-        scrollbar_hist = ttk.Scrollbar(tree_frame_hist, orient="vertical", command=self.tree_historial.yview)
-        self.tree_historial.configure(yscrollcommand=scrollbar_hist.set)
-        scrollbar_hist.pack(side="right", fill="y")
-        self.tree_historial.pack(side="left", fill="both", expand=True)
+        self.tree_historial.tag_configure('cargando', foreground=COLOR_PALETTE["accent"])
+        self.tree_historial.tag_configure('pendiente', foreground=COLOR_PALETTE["primary"], font=("Arial", 9, "italic"))
 
-        self.mostrar_historial_gui()
+        # La barra de desplazamiento representa la posición en el historial completo, no en las
+        # filas del Treeview (que solo contiene las visibles); ver `pintar_historial`.
+        self.scrollbar_historial = ttk.Scrollbar(tree_frame_hist, orient="vertical", command=self.desplazar_historial)
+        self.scrollbar_historial.pack(side="right", fill="y")
+        self.tree_historial.pack(side="left", fill="both", expand=True)
+        self.tree_historial.bind("<Configure>", lambda e: self.pintar_historial())
+        for evento in ("<MouseWheel>", "<Button-4>", "<Button-5>"):
+            self.tree_historial.bind(evento, self.rueda_historial)
+        for tecla in ("<Up>", "<Down>", "<Prior>", "<Next>", "<Home>", "<End>"):
+            self.tree_historial.bind(tecla, self.tecla_historial)
 
         self.menu_contextual_historial = tk.Menu(self.root, tearoff=0)
         # El menú contextual ahora también llama al método de selección múltiple, pero solo para un item.
@@ -1014,88 +2421,332 @@ class InventarioApp:
         Registra una entrada de artículo en la base de datos y actualiza el inventario.
         Ahora registra el proveedor y el destino.
         """
-        nombre = self.articulo_entry_historial.get().strip().upper()  # Convertir a mayúsculas
-        cantidad_str = self.cantidad_entry.get().strip()
-        proveedor = self.proveedor_entry.get().strip().upper()  # Convertir a mayúsculas
-        destino = self.destino_entry.get().strip().upper()  # Convertir a mayúsculas
+        self.registrar_movimiento("Entrada")
 
-        if not nombre or not cantidad_str or not proveedor or not destino:
-            self.mostrar_notificacion("Los campos Artículo, Cantidad, Proveedor y Destino son obligatorios para una entrada.", "error")
-            return
+    def registrar_salida(self):
+        """
+        Registra una salida de artículo en la base de datos y actualiza el inventario.
+        """
+        self.registrar_movimiento("Salida")
 
+    def registrar_movimiento(self, tipo):
+        """Valida los campos de la pestaña Historial y encola la entrada o salida."""
         try:
-            cantidad = int(cantidad_str)
-            if cantidad <= 0:
-                raise ValueError
-        except ValueError:
-            self.mostrar_notificacion("La cantidad debe ser un número entero positivo.", "error")
+            payload = self.validar_movimiento(tipo, self.articulo_entry_historial.get(), self.cantidad_entry.get(),
+                                              self.proveedor_entry.get(), self.destino_entry.get())
+        except ValueError as e:
+            self.mostrar_notificacion(str(e), "error")
             return
+        self.encolar_movimiento(tipo, payload)
 
-        try:
-            payload = {
-                "nombre": nombre,
-                "cantidad": cantidad,
-                "proveedor": proveedor,
-                "destino": destino
-            }
-            response = requests.post(f"{self.server_url}/registrar_entrada", json=payload)
-            response.raise_for_status()
-
-            self.mostrar_notificacion(f"Entrada de {cantidad} de '{nombre}' enviada al servidor.", "exito")
-            
-            # Limpiamos los campos. La GUI se actualizará automáticamente por el evento de WebSocket.
-            for entry in [self.articulo_entry_historial, self.cantidad_entry, self.proveedor_entry, self.destino_entry]:
-                entry.delete(0, 'end')
-            self.articulo_entry_historial.focus_set()
-
-        except requests.exceptions.RequestException as e:
-            self.mostrar_notificacion(f"Error al registrar entrada: {e}", "error")
+        # Limpiamos los campos. La GUI se actualizará automáticamente por el evento de WebSocket.
+        for entry in [self.articulo_entry_historial, self.cantidad_entry, self.proveedor_entry, self.destino_entry]:
+            entry.delete(0, 'end')
+        self.articulo_entry_historial.focus_set()
 
-    def registrar_salida(self):
+    def validar_movimiento(self, tipo, nombre, cantidad_str, proveedor, destino):
         """
-        Registra una salida de artículo en la base de datos y actualiza el inventario.
+        Valida y normaliza (a mayúsculas) los campos de una entrada o salida.
+        Devuelve el payload para el servidor o lanza ValueError con el mensaje para el usuario.
         """
-        nombre = self.articulo_entry_historial.get().strip().upper()  # Convertir a mayúsculas
-        cantidad_str = self.cantidad_entry.get().strip()
-        destino = self.destino_entry.get().strip().upper()  # Convertir a mayúsculas
-        proveedor = self.proveedor_entry.get().strip()
-
-        if not nombre or not cantidad_str or not destino:
-            self.mostrar_notificacion("Los campos Artículo, Cantidad y Destino son obligatorios para una salida.", "error")
-            return
+        nombre = nombre.strip().upper()
+        cantidad_str = cantidad_str.strip()
+        proveedor = proveedor.strip().upper()
+        destino = destino.strip().upper()
 
-        if proveedor:
-            self.mostrar_notificacion("Para registrar una salida, el campo 'Proveedor' debe estar vacío.", "error")
-            return
+        if tipo == "Entrada":
+            if not nombre or not cantidad_str or not proveedor or not destino:
+                raise ValueError("Los campos Artículo, Cantidad, Proveedor y Destino son obligatorios para una entrada.")
+        else:
+            if not nombre or not cantidad_str or not destino:
+                raise ValueError("Los campos Artículo, Cantidad y Destino son obligatorios para una salida.")
+            if proveedor:
+                raise ValueError("Para registrar una salida, el campo 'Proveedor' debe estar vacío.")
 
         try:
             cantidad = int(cantidad_str)
             if cantidad <= 0:
                 raise ValueError
         except ValueError:
-            self.mostrar_notificacion("La cantidad debe ser un número entero positivo.", "error")
-            return
+            raise ValueError("La cantidad debe ser un número entero positivo.")
+
+        payload = {"nombre": nombre, "cantidad": cantidad, "destino": destino}
+        if tipo == "Entrada":
+            payload["proveedor"] = proveedor
+        return payload
+
+    def registrar_lote_gui(self):
+        """
+        Abre un formulario de varias líneas (p. ej. un albarán con muchos artículos) que se
+        registra con una sola petición a /movimientos/lote: o se registran todas las líneas o
+        ninguna. Cada línea lleva su clave de idempotencia, así que reintentar tras un error
+        de conexión no duplica nada.
+        """
+        ventana = tk.Toplevel(self.root)
+        ventana.title("Registrar Varios Movimientos")
+        ventana.transient(self.root)
+        ventana.grab_set()
+
+        frame_lineas = ttk.Frame(ventana, padding="10")
+        frame_lineas.pack(fill="both", expand=True)
+        for columna, titulo in enumerate(("Tipo", "Artículo", "Cantidad", "Proveedor", "Destino")):
+            ttk.Label(frame_lineas, text=titulo).grid(row=0, column=columna, sticky="w", padx=2)
+
+        lineas = []
+        nombres_articulos = set(self.nombres_articulos).union(fila['nombre'] for fila in self.filas_inventario.values())
+        siguiente_fila = [1]
+
+        def quitar_linea(linea):
+            if len(lineas) > 1:
+                lineas.remove(linea)
+                for widget in linea['widgets']:
+                    widget.destroy()
+
+        def agregar_linea():
+            # Las líneas nuevas heredan tipo, proveedor y destino de la anterior
+            anterior = lineas[-1] if lineas else None
+            fila = siguiente_fila[0]
+            siguiente_fila[0] += 1
+
+            tipo = ttk.Combobox(frame_lineas, values=("Entrada", "Salida"), state="readonly", width=9)
+            tipo.set(anterior['tipo'].get() if anterior else "Entrada")
+            articulo = AutocompleteEntry(frame_lineas, width=30)
+            articulo.set_sugerencias(sorted(nombres_articulos))
+            cantidad = ttk.Entry(frame_lineas, width=8)
+            proveedor = AutocompleteEntry(frame_lineas)
+            proveedor.set_sugerencias(self.nombres_proveedores)
+            destino = AutocompleteEntry(frame_lineas)
+            destino.set_sugerencias(self.nombres_destinos)
+            if anterior:
+                proveedor.insert(0, anterior['proveedor'].get())
+                destino.insert(0, anterior['destino'].get())
+            error = ttk.Label(frame_lineas, foreground="red")
+
+            linea = {'clave': uuid.uuid4().hex, 'tipo': tipo, 'articulo': articulo, 'cantidad': cantidad,
+                     'proveedor': proveedor, 'destino': destino, 'error': error}
+            quitar = ttk.Button(frame_lineas, text="✕", width=3, command=lambda: quitar_linea(linea))
+            linea['widgets'] = (tipo, articulo, cantidad, proveedor, destino, quitar, error)
+
+            def cambiar_tipo(event=None):
+                # Las salidas no llevan proveedor
+                if tipo.get() == "Salida":
+                    proveedor.delete(0, 'end')
+                    proveedor.config(state="disabled")
+                else:
+                    proveedor.config(state="normal")
+            tipo.bind("<<ComboboxSelected>>", cambiar_tipo)
+            cambiar_tipo()
+            # Enter en la cantidad de la última línea añade otra
+            cantidad.bind('<Return>', lambda e: agregar_linea() if lineas[-1] is linea else None)
+
+            for columna, widget in enumerate(linea['widgets']):
+                widget.grid(row=fila, column=columna, sticky="ew", padx=2, pady=2)
+            lineas.append(linea)
+            articulo.focus_set()
+
+        def registrar():
+            validas = []
+            hay_errores = False
+            for linea in lineas:
+                linea['error'].config(text="")
+                campos = [linea[c].get() for c in ('articulo', 'cantidad', 'proveedor', 'destino')]
+                if not campos[0].strip() and not campos[1].strip():
+                    continue # Las líneas sin artículo ni cantidad se ignoran
+                try:
+                    payload = self.validar_movimiento(linea['tipo'].get(), *campos)
+                except ValueError as e:
+                    linea['error'].config(text=str(e))
+                    hay_errores = True
+                    continue
+                validas.append((linea, dict(payload, tipo=linea['tipo'].get(), clave=linea['clave'])))
+            if hay_errores:
+                self.mostrar_notificacion("Corrija las líneas marcadas antes de registrar.", "error")
+                return
+            if not validas:
+                self.mostrar_notificacion("No hay ninguna línea que registrar.", "info")
+                return
 
+            boton_registrar.config(state="disabled")
+            cuerpo = [movimiento for _, movimiento in validas]
+
+            def enviar():
+                response = self.api.post("/movimientos/lote", json=cuerpo)
+                try:
+                    datos = response.json()
+                except ValueError:
+                    datos = {}
+                return response.status_code, datos
+
+            def al_terminar(resultado):
+                codigo, datos = resultado
+                if codigo < 300:
+                    self.mostrar_notificacion(f"{len(cuerpo)} movimientos registrados en el servidor.", "exito")
+                    if ventana.winfo_exists():
+                        ventana.destroy()
+                    return
+                if ventana.winfo_exists():
+                    boton_registrar.config(state="normal")
+                    for error in datos.get('errores', []):
+                        if error.get('linea') is not None and error['linea'] < len(validas):
+                            validas[error['linea']][0]['error'].config(text=error['message'])
+                self.mostrar_notificacion(datos.get('message', f"Error del servidor (HTTP {codigo})."), "error")
+
+            def al_fallar(error):
+                if ventana.winfo_exists():
+                    boton_registrar.config(state="normal")
+                self.mostrar_notificacion(f"No se pudo registrar el lote: {error}. Puede reintentarlo sin duplicar movimientos.", "error")
+
+            self.en_segundo_plano(enviar, al_terminar, al_fallar)
+
+        frame_botones = ttk.Frame(ventana, padding=(10, 0, 10, 10))
+        frame_botones.pack(fill="x")
+        ttk.Button(frame_botones, text="Añadir Línea", command=agregar_linea).pack(side="left", padx=5)
+        boton_registrar = ttk.Button(frame_botones, text="Registrar", command=registrar)
+        boton_registrar.pack(side="right", padx=5)
+        ttk.Button(frame_botones, text="Cancelar", command=ventana.destroy).pack(side="right", padx=5)
+
+        agregar_linea()
+
+    def encolar_movimiento(self, tipo, datos):
+        """
+        Guarda una entrada o salida en la bandeja de salida local con una clave de idempotencia
+        nueva, la muestra como pendiente y lanza el envío. Si falla la escritura en disco, el
+        movimiento se envía igualmente (solo se pierde la garantía de reintento tras cerrar).
+        """
+        clave = uuid.uuid4().hex
+        creado = datetime.datetime.now().isoformat(timespec='seconds')
         try:
-            payload = {
-                "nombre": nombre,
-                "cantidad": cantidad,
-                "destino": destino
-            }
-            response = requests.post(f"{self.server_url}/registrar_salida", json=payload)
-            
-            if response.status_code == 400:
-                self.mostrar_notificacion(f"Error del servidor: {response.json().get('message')}", "error")
+            self.cache_local.encolar_pendiente(clave, tipo, datos, creado)
+        except sqlite3.Error as e:
+            print(f"No se pudo guardar el movimiento pendiente: {e}")
+        self.pendientes[clave] = {'tipo': tipo, 'datos': datos, 'creado': creado}
+        self.mostrar_pendientes([datos['nombre']])
+        self.enviar_pendientes()
+
+    def actualizar_deltas_pendientes(self):
+        """Recalcula, por artículo, la variación de stock que suman los movimientos pendientes."""
+        self.deltas_pendientes = {}
+        for pendiente in self.pendientes.values():
+            signo = 1 if pendiente['tipo'] == 'Entrada' else -1
+            nombre = pendiente['datos']['nombre']
+            self.deltas_pendientes[nombre] = self.deltas_pendientes.get(nombre, 0) + signo * pendiente['datos']['cantidad']
+
+    def mostrar_pendientes(self, nombres):
+        """Repinta las filas afectadas por movimientos pendientes (cantidades del inventario e historial)."""
+        self.actualizar_deltas_pendientes()
+        for iid, fila in self.filas_inventario.items():
+            if fila['nombre'] in nombres and iid in self.reconciliador_inventario.pintadas:
+                self.reconciliador_inventario.pintar(iid, *self.valores_inventario(fila))
+        self.pintar_historial()
+
+    def filas_pendientes_historial(self):
+        """Filas (iid, values, tags) del historial para los movimientos pendientes, el más reciente arriba."""
+        filas = []
+        for clave, pendiente in reversed(self.pendientes.items()):
+            datos = pendiente['datos']
+            fecha = pendiente['creado'].replace('T', ' ')
+            values = (datos['nombre'], pendiente['tipo'], datos['cantidad'], '', datos.get('destino') or '',
+                      datos.get('proveedor') or '', f"{fecha} (pendiente)")
+            filas.append((f"pendiente-{clave}", values, ('pendiente',)))
+        return filas
+
+    def enviar_pendientes(self):
+        """
+        Envía al servidor un lote de movimientos pendientes en una sola petición a
+        /movimientos/lote, cada uno con su clave de idempotencia y la fecha en que se registró. Si el servidor rechaza el lote
+        (p. ej. por falta de stock en una salida), se reenvía línea a línea, en orden, para
+        registrar las válidas y descartar solo las rechazadas. Cada movimiento terminado se
+        quita de la bandeja; ante un error de conexión se detiene y se reintenta más tarde.
+        Si quedan pendientes tras un lote correcto, se envía el siguiente.
+        """
+        if self.after_pendientes:
+            self.root.after_cancel(self.after_pendientes)
+            self.after_pendientes = None
+        if self.enviando_pendientes or not self.pendientes:
+            return
+        self.enviando_pendientes = True
+        lote = list(self.pendientes.items())[:self.tam_lote_pendientes]
+
+        def publicar(items):
+            """POST de los items a /movimientos/lote. Devuelve la respuesta o lanza si el fallo es transitorio."""
+            # 'creado' (hora local del equipo) se envía en UTC: el servidor la usa como fecha del
+            # movimiento, así lo registrado sin conexión no toma la hora del reenvío
+            response = self.api.post("/movimientos/lote", json=[
+                dict(pendiente['datos'], tipo=pendiente['tipo'], clave=clave,
+                     creado=datetime.datetime.fromisoformat(pendiente['creado']).astimezone(datetime.timezone.utc).isoformat())
+                for clave, pendiente in items
+            ])
+            if response.status_code >= 500 or response.status_code in (408, 429):
+                raise requests.HTTPError(f"HTTP {response.status_code}", response=response)
+            return response
+
+        def mensaje_de(response):
+            try:
+                datos = response.json()
+            except ValueError:
+                return response.reason
+            errores = datos.get('errores') or [{}]
+            return errores[0].get('message') or datos.get('message', response.reason)
+
+        def enviar():
+            confirmados, rechazados = [], []
+            try:
+                response = publicar(lote)
+                if response.ok:
+                    confirmados = [clave for clave, _ in lote]
+                    self.cache_local.quitar_pendientes(confirmados)
+                    return confirmados, rechazados, None
+                # Lote rechazado entero (no se registró nada): se reintenta línea a línea
+                for clave, pendiente in lote:
+                    response = publicar([(clave, pendiente)])
+                    if response.ok:
+                        confirmados.append(clave)
+                    else:
+                        rechazados.append((clave, mensaje_de(response)))
+                    # Se confirma en disco antes de seguir: si la aplicación se cierra, no se reenvía
+                    # (y si se reenviara, la clave de idempotencia evitaría el duplicado)
+                    self.cache_local.quitar_pendientes([clave])
+            except requests.RequestException as e:
+                return confirmados, rechazados, e
+            return confirmados, rechazados, None
+
+        def al_terminar(resultado):
+            self.enviando_pendientes = False
+            confirmados, rechazados, error = resultado
+            terminados = [self.pendientes.pop(clave) for clave in confirmados]
+            for clave, mensaje in rechazados:
+                pendiente = self.pendientes.pop(clave)
+                terminados.append(pendiente)
+                datos = pendiente['datos']
+                self.mostrar_notificacion(
+                    f"{pendiente['tipo']} de {datos['cantidad']} de '{datos['nombre']}' rechazada por el servidor: {mensaje}", "error")
+            if terminados:
+                self.mostrar_pendientes({p['datos']['nombre'] for p in terminados})
+            if len(confirmados) == 1 and not self.pendientes:
+                pendiente = terminados[0]
+                self.mostrar_notificacion(
+                    f"{pendiente['tipo']} de {pendiente['datos']['cantidad']} de '{pendiente['datos']['nombre']}' registrada en el servidor.", "exito")
+            elif confirmados and not self.pendientes:
+                self.mostrar_notificacion(f"{len(confirmados)} movimientos pendientes enviados al servidor.", "exito")
+
+            if error is None:
+                self.aviso_sin_conexion = False
+                if self.pendientes:
+                    self.enviar_pendientes()
                 return
-            response.raise_for_status()
+            if not self.aviso_sin_conexion:
+                self.aviso_sin_conexion = True
+                self.mostrar_notificacion(
+                    f"Sin conexión con el servidor: {len(self.pendientes)} movimiento(s) se enviarán al reconectar.", "info")
+            self.after_pendientes = self.root.after(self.reintento_pendientes_ms, self.enviar_pendientes)
 
-            self.mostrar_notificacion(f"Salida de {cantidad} de '{nombre}' enviada al servidor.", "exito")
-            
-            for entry in [self.articulo_entry_historial, self.cantidad_entry, self.proveedor_entry, self.destino_entry]:
-                entry.delete(0, 'end')
-            self.articulo_entry_historial.focus_set()
-        except requests.exceptions.RequestException as e:
-            self.mostrar_notificacion(f"Error al registrar salida: {e}", "error")
+        def al_fallar(error):
+            # Error inesperado (p. ej. al escribir en la caché local): se reintenta más tarde
+            self.enviando_pendientes = False
+            print(f"Error al enviar los movimientos pendientes: {error}")
+            self.after_pendientes = self.root.after(self.reintento_pendientes_ms, self.enviar_pendientes)
+
+        self.en_segundo_plano(enviar, al_terminar, al_fallar)
 
     def importar_historial(self):
         """
@@ -1104,19 +2755,79 @@ class InventarioApp:
         El archivo de Excel debe tener las siguientes columnas:
         'Articulo', 'Tipo', 'Cantidad', 'Ubicacion', 'Proveedor', 'Fecha'
         - El campo 'Tipo' debe ser 'Entrada' o 'Salida'.
-        - Para las entradas, se actualizará el stock y se registrará en la tabla 'entradas'.
-        - Para las salidas, se restará del stock y se registrará en la tabla 'salidas'.
+        - Para las entradas, se sumará al stock; para las salidas, se restará.
         - Si el artículo no existe, se creará un nuevo registro en el inventario.
         """
+        self.importar_archivo("historial", "Importando historial")
+
+    def importar_archivo(self, tipo, titulo):
+        """
+        Pide un archivo y lo importa por lotes con un `ImportadorPorLotes` en un hilo propio (no en
+        el pool, para no ocupar un trabajador durante minutos), mostrando una ventana de progreso
+        con opción de cancelar. Si hay una importación anterior del mismo archivo sin terminar,
+        ofrece reanudarla desde el último lote confirmado por el servidor.
+        """
         filepath = filedialog.askopenfilename(
             defaultextension=".xlsx",
             filetypes=[("Excel files", "*.xlsx"), ("CSV files", "*.csv")]
         )
         if not filepath:
             return
+        if not filepath.lower().endswith(".csv") and not OPENPYXL_AVAILABLE:
+            self.mostrar_notificacion("Para importar archivos Excel se necesita la librería openpyxl.", "error")
+            return
 
-        # NOTA: Implementar API POST /historial/importar en el servidor
-        self.mostrar_notificacion("La importación de historial no está implementada para el modo servidor.", "info")
+        ruta_progreso = os.path.join(self.base_path, f"importacion_{tipo}.json")
+        importador = ImportadorPorLotes(self.api, tipo, filepath, ruta_progreso)
+        lotes_previos, _, _ = importador.progreso_guardado()
+        reanudar = bool(lotes_previos) and messagebox.askyesno(
+            "Reanudar Importación",
+            f"Este archivo ya se importó parcialmente ({lotes_previos} lote(s) confirmados).\n"
+            "¿Desea continuar desde donde se quedó? (No: empezar desde el principio)")
+
+        ventana = tk.Toplevel(self.root)
+        ventana.title(titulo)
+        ventana.transient(self.root)
+        ventana.resizable(False, False)
+        frame = ttk.Frame(ventana, padding="10")
+        frame.pack(fill="both", expand=True)
+        estado = ttk.Label(frame, text="Leyendo archivo...", width=50)
+        estado.pack(fill="x", pady=(0, 5))
+        barra = ttk.Progressbar(frame, mode="determinate", maximum=100, length=350)
+        barra.pack(fill="x", pady=5)
+        boton_cancelar = ttk.Button(frame, text="Cancelar", command=importador.cancelar)
+        boton_cancelar.pack(pady=(5, 0))
+        ventana.protocol("WM_DELETE_WINDOW", importador.cancelar)
+
+        def describir(resumen):
+            return ", ".join(f"{clave}: {valor}" for clave, valor in resumen.items() if isinstance(valor, int) and clave != "cancelado")
+
+        def mostrar_progreso(fraccion, resumen):
+            if ventana.winfo_exists():
+                barra["value"] = fraccion * 100
+                estado.config(text=describir(resumen) or "Importando...")
+
+        def terminar(resumen=None, error=None):
+            if ventana.winfo_exists():
+                ventana.destroy()
+            if error is not None:
+                self.mostrar_notificacion(f"Error al importar ({error}). Puede reanudar la importación más tarde.", "error")
+            elif resumen.get("cancelado"):
+                self.mostrar_notificacion("Importación cancelada. Puede reanudarla más tarde.", "info")
+            else:
+                self.mostrar_notificacion(f"Importación completada. {describir(resumen)}", "exito")
+
+        importador.al_progresar = lambda fraccion, resumen: self.root.after(0, lambda: mostrar_progreso(fraccion, resumen))
+
+        def trabajo():
+            try:
+                resumen = importador.ejecutar(reanudar=reanudar)
+            except Exception as e:
+                self.root.after(0, lambda error=e: terminar(error=error))
+                return
+            self.root.after(0, lambda: terminar(resumen))
+
+        threading.Thread(target=trabajo, daemon=True).start()
 
     def on_historial_header_click(self, event):
         """
@@ -1135,12 +2846,24 @@ class InventarioApp:
     def mostrar_menu_filtro(self, event, column_name):
         """
         Crea y muestra un menú contextual con opciones de filtro para una columna específica.
-        """
+        Las opciones de Ubicación y Proveedor (las más usadas) se piden a /sugerencias/<columna>.
+        """
+        x, y = event.x_root, event.y_root
+        if column_name in COLUMNAS_SUGERENCIAS_HISTORIAL:
+            columna = COLUMNAS_SUGERENCIAS_HISTORIAL[column_name]
+            self.en_segundo_plano(
+                lambda: self.get_json(f"/sugerencias/{columna}", {'limite': MAX_OPCIONES_FILTRO}),
+                lambda valores: self.abrir_menu_filtro(x, y, column_name, valores),
+                lambda e: self.mostrar_notificacion(f"Error al cargar las opciones de filtro: {e}", "error"),
+                clave="menu_filtro")
+        elif column_name == "Tipo":
+            self.abrir_menu_filtro(x, y, column_name, ["Entrada", "Salida"])
+        else:
+            self.abrir_menu_filtro(x, y, column_name, [])
+
+    def abrir_menu_filtro(self, x, y, column_name, valores_unicos):
+        """Muestra en la posición (x, y) de la pantalla el menú de filtro con los valores dados."""
         menu = tk.Menu(self.root, tearoff=0)
-        
-        valores_unicos = []
-        # NOTA: Implementar API GET /sugerencias/<columna> en el servidor
-        self.mostrar_notificacion("Los filtros de columna no están implementados para el modo servidor.", "info")
 
         if valores_unicos:
             menu.add_command(label=f"Todos ({column_name})", command=lambda: self.aplicar_filtro_historial(column_name, None))
@@ -1151,7 +2874,7 @@ class InventarioApp:
             menu.add_command(label="No hay opciones para filtrar", state="disabled")
 
         try:
-            menu.tk_popup(event.x_root, event.y_root)
+            menu.tk_popup(x, y)
         finally:
             menu.grab_release()
 
@@ -1184,86 +2907,253 @@ class InventarioApp:
         termino_busqueda = self.articulo_entry_historial.get().strip()
         self.mostrar_historial_gui(filtro_articulo=termino_busqueda)
 
+    def parametros_historial(self, filtro_articulo=None):
+        """
+        Traduce los filtros activos del historial a los parámetros de consulta de /historial,
+        para que el servidor devuelva solo las filas que coinciden.
+        """
+        params = {}
+        for col, val in self.filtros_activos.items():
+            if col == "Tipo":
+                params['tipo'] = val
+            elif col == "Ubicación":
+                params['destino'] = val
+            elif col == "Proveedor":
+                params['proveedor'] = val
+            elif col == "Fecha":  # Filtro "empieza por" (Año, Año-Mes o Año-Mes-Día)
+                params['desde'] = val
+                params['hasta'] = val
+        if filtro_articulo:
+            params['q'] = filtro_articulo
+        return params
+
     def mostrar_historial_gui(self, filtro_articulo=None):
         """
         Actualiza y muestra la lista de movimientos en el Treeview del historial.
         Ahora incluye la unidad de medición.
-        """
-        for item in self.tree_historial.get_children():
-            self.tree_historial.delete(item)
-
-        try:
-            response = requests.get(f"{self.server_url}/historial")
-            response.raise_for_status()
-            historial_df = pd.DataFrame(response.json())
-            if not historial_df.empty:
-                historial_df['fecha'] = pd.to_datetime(historial_df['fecha'])
-                historial_df = historial_df.sort_values(by='fecha', ascending=False)
-
-                # --- APLICAR FILTROS ACTIVOS ---
-                if self.filtros_activos:
-                    df_filtrado = historial_df.copy()
-                    for col, val in self.filtros_activos.items():
-                        if col == "Tipo":
-                            df_filtrado = df_filtrado[df_filtrado['Tipo'].str.lower() == val.lower()]
-                        elif col == "Ubicación":
-                            df_filtrado = df_filtrado[df_filtrado['Ubicacion'].str.lower() == val.lower()]
-                        elif col == "Proveedor":
-                            df_filtrado = df_filtrado[df_filtrado['Proveedor'].str.lower() == val.lower()]
-                        elif col == "Fecha":  # Filtro "empieza por" para Año-Mes
-                            df_filtrado = df_filtrado[df_filtrado['fecha'].dt.strftime('%Y-%m-%d').str.startswith(val)]
-                    historial_df = df_filtrado
-
-                # --- APLICAR FILTRO EN TIEMPO REAL (del Entry) ---
-                if filtro_articulo:
-                    historial_df = historial_df[historial_df['Articulo'].str.contains(filtro_articulo, case=False, na=False)]
-
-                # --- FIN DE FILTROS ---
-
-                # Actualizar cabeceras para mostrar qué filtros están activos
-                column_map = {
-                    "Artículo": "Artículo", "Tipo": "Tipo", "Cantidad": "Cantidad", 
-                    "Unidad": "Unidad", "Ubicación": "Ubicación", "Proveedor": "Proveedor", "Fecha": "Fecha"
-                }
-                for col_key in column_map:
-                    original_text = column_map[col_key]
-                    if col_key in self.filtros_activos:
-                        # Añade un indicador visual al texto de la cabecera
-                        self.tree_historial.heading(col_key, text=f"{original_text} ▼")
-                    else:
-                        self.tree_historial.heading(col_key, text=original_text)
-
-                historial_df['fecha'] = historial_df['fecha'].dt.strftime('%Y-%m-%d %H:%M:%S')
-                historial_df.fillna('', inplace=True)
-
-                for _, row in historial_df.iterrows():
-                    # Determinar la etiqueta (tag) según el tipo de movimiento para colorear la fila
-                    tag = 'entrada' if row['Tipo'] == 'Entrada' else 'salida'
-                    self.tree_historial.insert('', 'end', values=list(row), tags=(tag,))
-
-        except Exception as e:
-            self.mostrar_notificacion(f"Error al cargar el historial: {e}", "error")
+        ---
+        El historial es una lista virtual: se pide al servidor el total de movimientos y la página
+        de la posición actual, y solo se pintan las filas visibles (ver `pintar_historial`). Si los
+        filtros no han cambiado (recarga por cambios del servidor) se conserva la posición.
+        """
+        # Los filtros se aplican en el servidor; el historial llega ya ordenado por fecha.
+        params = self.parametros_historial(filtro_articulo)
+        inicio = self.historial_inicio if params == self.historial_params else 0
+        tam_pagina = self.modelo_historial.tam_pagina
+        pagina = inicio // tam_pagina
+
+        def cargar():
+            total = self.get_json("/historial/total", params)['total']
+            if not total:
+                return total, [], None
+            pagina_cursor = self.get_json("/historial", dict(params, after="", page=pagina + 1, per_page=tam_pagina))
+            return total, pagina_cursor['items'], pagina_cursor['next_cursor']
+
+        def al_terminar(resultado):
+            total, filas, cursor_siguiente = resultado
+
+            # Actualizar cabeceras para mostrar qué filtros están activos
+            column_map = {
+                "Artículo": "Artículo", "Tipo": "Tipo", "Cantidad": "Cantidad",
+                "Unidad": "Unidad", "Ubicación": "Ubicación", "Proveedor": "Proveedor", "Fecha": "Fecha"
+            }
+            for col_key in column_map:
+                original_text = column_map[col_key]
+                if col_key in self.filtros_activos:
+                    # Añade un indicador visual al texto de la cabecera
+                    self.tree_historial.heading(col_key, text=f"{original_text} ▼")
+                else:
+                    self.tree_historial.heading(col_key, text=original_text)
+
+            if not params and pagina == 0:
+                # La primera página sin filtros es la que se muestra al arrancar
+                self.guardar_en_cache(self.cache_local.reemplazar, 'historial', filas)
+                self.guardar_en_cache(self.cache_local.escribir_meta, 'historial_total', total)
+            self.historial_params = params
+            self.historial_inicio = inicio
+            self.modelo_historial.reiniciar(total)
+            self.modelo_historial.guardar_pagina(self.modelo_historial.generacion, pagina, filas, cursor_siguiente)
+            self.pintar_historial()
+
+        # Cada pulsación en el filtro en tiempo real sustituye a la petición anterior
+        self.en_segundo_plano(
+            cargar, al_terminar,
+            lambda e: self.mostrar_notificacion(f"Error al cargar el historial: {e}", "error"),
+            clave="historial")
+
+    def filas_visibles_historial(self):
+        """Número de filas que caben en el Treeview del historial con su altura actual."""
+        hijos = self.tree_historial.get_children()
+        caja = self.tree_historial.bbox(hijos[0]) if hijos else None
+        if caja:
+            cabecera, alto_fila = caja[1], caja[3]
+        else:
+            alto_fila = 20
+            cabecera = alto_fila + 4
+        return max(1, (self.tree_historial.winfo_height() - cabecera) // alto_fila)
+
+    def pintar_historial(self):
+        """
+        Pinta en el Treeview solo las filas visibles del historial, a partir de `historial_inicio`.
+        Las filas de páginas aún no cargadas se muestran como 'Cargando...' y se piden al servidor.
+        El número de elementos del Treeview no depende del tamaño del historial.
+        """
+        modelo = self.modelo_historial
+        visibles = self.filas_visibles_historial()
+        self.historial_inicio = max(0, min(self.historial_inicio, modelo.total - visibles))
+
+        # Los movimientos pendientes de enviar se muestran arriba del historial sin filtros
+        deseadas = []
+        if self.historial_inicio == 0 and not self.historial_params:
+            deseadas = self.filas_pendientes_historial()[:visibles]
+        for desplazamiento, fila in enumerate(modelo.filas(self.historial_inicio, visibles - len(deseadas))):
+            if fila is None:
+                iid = f"cargando-{self.historial_inicio + desplazamiento}"
+                deseadas.append((iid, ("Cargando...",) + ("",) * 6, ('cargando',)))
+            else:
+                # El id del movimiento se usa como iid: la selección se conserva al desplazarse
+                values, tag = self.valores_historial(fila)
+                deseadas.append((str(fila['id']), values, (tag,)))
+        self.reconciliador_historial.reconciliar(deseadas)
+
+        if modelo.total:
+            self.scrollbar_historial.set(self.historial_inicio / modelo.total,
+                                         min(1.0, (self.historial_inicio + visibles) / modelo.total))
+        else:
+            self.scrollbar_historial.set(0.0, 1.0)
+
+        if modelo.paginas_faltantes(self.historial_inicio, visibles):
+            self.programar_carga_historial()
+
+    def programar_carga_historial(self):
+        """
+        Pide las páginas que faltan cuando el desplazamiento se detiene: mientras se arrastra la
+        barra solo se pintan marcadores, sin lanzar una petición por cada posición intermedia.
+        """
+        if self.historial_after_carga:
+            self.root.after_cancel(self.historial_after_carga)
+        self.historial_after_carga = self.root.after(80, self.cargar_paginas_historial)
+
+    def cargar_paginas_historial(self):
+        """
+        Pide al servidor las páginas de la ventana visible y media página de margen a cada lado.
+        Las páginas consecutivas se piden en orden con el cursor (keyset) de la anterior, así el
+        coste no depende de la profundidad; solo la primera de un tramo sin cursor conocido salta
+        con `page` (OFFSET).
+        """
+        self.historial_after_carga = None
+        modelo = self.modelo_historial
+        generacion = modelo.generacion
+        params = dict(self.historial_params or {})
+        faltantes = sorted(modelo.paginas_faltantes(self.historial_inicio, self.filas_visibles_historial(),
+                                                    margen=modelo.tam_pagina // 2))
+        # Tramos de páginas consecutivas: cada uno se pide en una tarea, página a página
+        tramos = []
+        for numero in faltantes:
+            if tramos and tramos[-1][-1] == numero - 1:
+                tramos[-1].append(numero)
+            else:
+                tramos.append([numero])
+
+        def cargar(tramo, cursor):
+            paginas = []
+            for numero in tramo:
+                if cursor is None:
+                    consulta = dict(params, after="", page=numero + 1, per_page=modelo.tam_pagina)
+                else:
+                    consulta = dict(params, after=cursor, per_page=modelo.tam_pagina)
+                pagina = self.get_json("/historial", consulta)
+                cursor = pagina['next_cursor']
+                paginas.append((numero, pagina['items'], cursor))
+                if cursor is None:
+                    break # No hay más filas
+            return paginas
+
+        def al_terminar(tramo, paginas):
+            guardadas = [modelo.guardar_pagina(generacion, numero, filas, cursor) for numero, filas, cursor in paginas]
+            for numero in tramo[len(paginas):]:
+                modelo.descartar_pedida(generacion, numero)
+            if any(guardadas):
+                self.pintar_historial()
+
+        def al_fallar(tramo, error):
+            for numero in tramo:
+                modelo.descartar_pedida(generacion, numero)
+            self.mostrar_notificacion(f"Error al cargar el historial: {error}", "error")
+
+        for tramo in tramos:
+            modelo.pedidas.update(tramo)
+            cursor = modelo.cursores.get(tramo[0])
+            self.en_segundo_plano(
+                lambda tramo=tramo, cursor=cursor: cargar(tramo, cursor),
+                lambda paginas, tramo=tramo: al_terminar(tramo, paginas),
+                lambda e, tramo=tramo: al_fallar(tramo, e))
+
+    def desplazar_historial(self, accion, cantidad, unidades=None):
+        """Comando de la barra de desplazamiento del historial ('moveto' o 'scroll')."""
+        if accion == "moveto":
+            self.historial_inicio = int(float(cantidad) * self.modelo_historial.total)
+        elif accion == "scroll":
+            paso = self.filas_visibles_historial() if unidades == "pages" else 1
+            self.historial_inicio += int(cantidad) * paso
+        self.pintar_historial()
+
+    def rueda_historial(self, event):
+        """Desplaza el historial con la rueda del ratón (Windows/macOS: <MouseWheel>; Linux: botones 4 y 5)."""
+        if event.num in (4, 5):
+            sentido = -1 if event.num == 4 else 1
+        else:
+            sentido = -1 if event.delta > 0 else 1
+        self.desplazar_historial("scroll", sentido * 3, "units")
+        return "break"
+
+    def tecla_historial(self, event):
+        """Mueve la selección con el teclado y desplaza la ventana virtual al llegar a un borde."""
+        total = self.modelo_historial.total
+        if not total:
+            return "break"
+        visibles = self.filas_visibles_historial()
+        hijos = self.tree_historial.get_children()
+        foco = self.tree_historial.focus()
+        actual = self.historial_inicio + (hijos.index(foco) if foco in hijos else 0)
+        saltos = {"Up": actual - 1, "Down": actual + 1, "Prior": actual - visibles, "Next": actual + visibles,
+                  "Home": 0, "End": total - 1}
+        destino = max(0, min(saltos.get(event.keysym, actual), total - 1))
+        if destino < self.historial_inicio:
+            self.historial_inicio = destino
+        elif destino >= self.historial_inicio + visibles:
+            self.historial_inicio = destino - visibles + 1
+        self.pintar_historial()
+
+        hijos = self.tree_historial.get_children()
+        posicion = destino - self.historial_inicio
+        if 0 <= posicion < len(hijos):
+            self.tree_historial.focus(hijos[posicion])
+            self.tree_historial.selection_set(hijos[posicion])
+        return "break"
 
     def exportar_historial(self):
-        """Exporta el historial completo a un archivo Excel.
+        """Exporta el historial completo (con los filtros activos) a un archivo Excel, CSV o Parquet.
         Ahora incluye la columna de unidad de medición.
         """
         filepath = filedialog.asksaveasfilename(
             defaultextension=".xlsx",
-            filetypes=[("Excel files", "*.xlsx")]
+            filetypes=FORMATOS_EXPORTACION
         )
         if not filepath:
             return
 
-        try:
-            response = requests.get(f"{self.server_url}/historial")
-            response.raise_for_status()
-            historial_df = pd.DataFrame(response.json())
-            historial_df.to_excel(filepath, index=False)
-            self.mostrar_notificacion(f"Historial exportado a: {filepath}", "exito")
+        # El servidor genera el archivo sin paginar y el cliente lo guarda tal cual llega
+        params = self.parametros_historial(self.articulo_entry_historial.get().strip())
+        params["format"] = formato_de_archivo(filepath)
 
-        except Exception as e:
-            self.mostrar_notificacion(f"Error al exportar el historial: {e}", "error")
+        def exportar():
+            self.api.descargar("/historial/export", filepath, params=params)
+
+        self.en_segundo_plano(
+            exportar,
+            lambda _: self.mostrar_notificacion(f"Historial exportado a: {filepath}", "exito"),
+            lambda e: self.mostrar_notificacion(f"Error al exportar el historial: {e}", "error"))
 
     def mostrar_notificacion(self, mensaje, tipo="info"):
         """
@@ -1293,6 +3183,11 @@ if __name__ == "__main__":
     def on_closing():
         if app.sio.connected:
             app.sio.disconnect()
+        app.executor.shutdown(wait=False, cancel_futures=True)
+        # Las escrituras pendientes de la caché local se terminan antes de cerrarla
+        app.executor_cache.shutdown(wait=True)
+        app.cache_local.cerrar()
+        app.api.cerrar()
         root.destroy()
     root.protocol("WM_DELETE_WINDOW", on_closing)
     app = InventarioApp(root)
@@ -1,13 +1,65 @@
 # c:\Users\ypalomino\Documents\Estudia\Inventario\server.py
 # c:\Users\ypalomino\Documents\Estudia\Inventario\server.py
+import io
 import os
+import re
+import csv
+import json
+import gzip
+import base64
+import zlib
+import hashlib
+import tempfile
 import datetime
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+from functools import wraps
 
-from flask import Flask, jsonify, request
+from flask import Flask, Response, g, jsonify, request, send_file, stream_with_context
+from werkzeug.exceptions import RequestEntityTooLarge
 from flask_sqlalchemy import SQLAlchemy
 from flask_socketio import SocketIO, emit
 from flask_cors import CORS
-from sqlalchemy import union_all, literal_column, func
+from sqlalchemy import union_all, literal_column, func, select, insert, update, delete, cast, case, or_, and_, inspect, text, bindparam
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.exc import IntegrityError
+
+# La compresión brotli es opcional: si la librería no está instalada se usa solo gzip
+try:
+    import brotli
+    BROTLI_AVAILABLE = True
+except ImportError:
+    BROTLI_AVAILABLE = False
+
+# Formatos de exportación opcionales: xlsx (openpyxl) y parquet (pyarrow)
+try:
+    import openpyxl
+    OPENPYXL_AVAILABLE = True
+except ImportError:
+    OPENPYXL_AVAILABLE = False
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+    PYARROW_AVAILABLE = True
+except ImportError:
+    PYARROW_AVAILABLE = False
+
+# Redis es opcional: permite compartir la caché de respuestas entre varios workers de gunicorn
+try:
+    import redis
+    REDIS_AVAILABLE = True
+except ImportError:
+    REDIS_AVAILABLE = False
+
+# Pillow es necesario para validar las imágenes de los materiales y generar sus miniaturas
+try:
+    from PIL import Image, ImageOps
+    PIL_AVAILABLE = True
+except ImportError:
+    PIL_AVAILABLE = False
 
 # --- CONFIGURACIÓN ---
 app = Flask(__name__)
@@ -28,10 +80,17 @@ socketio = SocketIO(app)
 
 # --- MODELOS DE LA BASE DE DATOS ---
 class Articulo(db.Model):
+    # Índice de cobertura para el listado de inventario: lleva todas las columnas que lee
+    # `consulta_inventario` (también `id`, que en PostgreSQL no está implícito en los índices
+    # como el rowid de SQLite), así el listado puede resolverse con un index-only scan.
+    # El ORDER BY por nombre lo sirve el índice único de `nombre`, no este.
+    __table_args__ = (db.Index('ix_articulo_material_nombre_cantidad_id', 'material_id', 'nombre', 'cantidad', 'id'),)
     id = db.Column(db.Integer, primary_key=True)
     nombre = db.Column(db.String(100), unique=True, nullable=False)
     cantidad = db.Column(db.Integer, default=0)
     proveedor = db.Column(db.String(100))
+    material_id = db.Column(db.Integer, db.ForeignKey('material.id', ondelete='SET NULL'))
+    material = db.relationship('Material', backref=db.backref('articulos', lazy=True))
 
 class Material(db.Model):
     id = db.Column(db.Integer, primary_key=True)
@@ -39,6 +98,77 @@ class Material(db.Model):
     unidad_medicion = db.Column(db.String(50))
     imagen_path = db.Column(db.String(255))
 
+class Movimiento(db.Model):
+    """
+    Libro de movimientos de solo inserción. La cantidad lleva signo:
+    positiva para las entradas y negativa para las salidas.
+    """
+    __table_args__ = (
+        # Índice para recorrer el historial por fecha (y paginar por cursor)
+        db.Index('ix_movimiento_fecha_id', 'fecha', 'id'),
+        # Índice para consultar los movimientos de un artículo
+        db.Index('ix_movimiento_articulo_fecha', 'articulo_id', 'fecha'),
+        # Índices para los filtros del historial (tipo, destino, proveedor) ordenados por fecha
+        db.Index('ix_movimiento_tipo_fecha', 'tipo', 'fecha'),
+        db.Index('ix_movimiento_destino_fecha', 'destino', 'fecha'),
+        db.Index('ix_movimiento_proveedor_fecha', 'proveedor', 'fecha'),
+        # Una clave de idempotencia solo puede registrar un movimiento (las NULL no cuentan)
+        db.Index('ux_movimiento_clave_idempotencia', 'clave_idempotencia', unique=True),
+    )
+    id = db.Column(db.Integer, primary_key=True)
+    tipo = db.Column(db.Enum('Entrada', 'Salida', name='tipo_movimiento'), nullable=False)
+    articulo_id = db.Column(db.Integer, db.ForeignKey('articulo.id'), nullable=False)
+    cantidad = db.Column(db.Integer, nullable=False)
+    destino = db.Column(db.String(100))
+    proveedor = db.Column(db.String(100))
+    fecha = db.Column(db.DateTime, default=datetime.datetime.utcnow, nullable=False)
+    # Clave enviada por el cliente en la cabecera Idempotency-Key: si reintenta el envío con la
+    # misma clave, el movimiento no se registra dos veces
+    clave_idempotencia = db.Column(db.String(64))
+    articulo = db.relationship('Articulo', backref=db.backref('movimientos', lazy=True))
+
+class Secuencia(db.Model):
+    """Contador global de cambios. Hay una sola fila ('cambios') que se incrementa en cada escritura."""
+    nombre = db.Column(db.String(50), primary_key=True)
+    valor = db.Column(db.Integer, nullable=False, default=0)
+
+class Cambio(db.Model):
+    """
+    Registro de cambios para la sincronización incremental de los clientes.
+    Todas las filas de una misma transacción comparten su número de secuencia (`seq`).
+    """
+    __table_args__ = (
+        db.Index('ix_cambio_seq', 'seq'),
+        # Índice para obtener la versión de cada tabla (último seq por entidad)
+        db.Index('ix_cambio_entidad_seq', 'entidad', 'seq'),
+        # Índice para podar los cambios antiguos sin recorrer la tabla
+        db.Index('ix_cambio_fecha', 'fecha'),
+    )
+    id = db.Column(db.Integer, primary_key=True)
+    seq = db.Column(db.Integer, nullable=False)
+    entidad = db.Column(db.String(20), nullable=False)   # 'articulo', 'material' o 'movimiento'
+    entidad_id = db.Column(db.Integer, nullable=False)
+    # 'upsert', 'delete' o 'resync' (cambios masivos: los clientes deben recargar la tabla completa)
+    operacion = db.Column(db.String(10), nullable=False)
+    fecha = db.Column(db.DateTime, default=datetime.datetime.utcnow)
+
+class Sugerencia(db.Model):
+    """
+    Valores distintos de artículo, proveedor y destino usados en los movimientos, con cuántas
+    veces se han usado y cuándo por última vez. Sirve el autocompletado (/sugerencias/<columna>)
+    sin recorrer el historial: se actualiza al registrar cada movimiento.
+    """
+    __table_args__ = (
+        # Índice para las sugerencias más usadas de una columna (búsqueda sin texto)
+        db.Index('ix_sugerencia_columna_frecuencia', 'columna', 'frecuencia'),
+    )
+    columna = db.Column(db.String(20), primary_key=True)  # 'articulo', 'proveedor' o 'destino'
+    valor = db.Column(db.String(100), primary_key=True)
+    frecuencia = db.Column(db.Integer, nullable=False, default=0)
+    ultimo_uso = db.Column(db.DateTime)
+
+# --- TABLAS HEREDADAS ---
+# Entrada y Salida ya no se escriben; se mantienen solo para migrar sus datos a Movimiento.
 class Entrada(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     articulo_id = db.Column(db.Integer, db.ForeignKey('articulo.id'), nullable=False)
@@ -56,10 +186,355 @@ class Salida(db.Model):
     fecha = db.Column(db.DateTime, default=datetime.datetime.utcnow)
     articulo = db.relationship('Articulo', backref=db.backref('salidas', lazy=True))
 
+# --- REGISTRO DE CAMBIOS ---
+# Número máximo de entidades distintas que devuelve /cambios; si hay más, el cliente debe recargar todo.
+LIMITE_CAMBIOS = 500
+# Días que se conservan los cambios; un cliente con una secuencia más antigua recarga todo
+DIAS_RETENCION_CAMBIOS = int(os.environ.get('DIAS_RETENCION_CAMBIOS', 30))
+
+def registrar_cambios(cambios):
+    """
+    Asigna el siguiente número de secuencia global y registra los cambios de la transacción
+    en curso. `cambios` es una lista de tuplas (entidad, entidad_id, operacion).
+    Debe llamarse justo antes del commit: el UPDATE bloquea la fila del contador hasta el
+    commit, así los números de secuencia quedan en el mismo orden en que se confirman.
+    """
+    seq = db.session.execute(
+        update(Secuencia).where(Secuencia.nombre == 'cambios')
+        .values(valor=Secuencia.valor + 1).returning(Secuencia.valor)
+    ).scalar()
+    if seq is None:
+        # Primera escritura en una base de datos sin contador
+        seq = 1
+        db.session.add(Secuencia(nombre='cambios', valor=seq))
+    # Un solo INSERT con executemany aunque la transacción afecte a miles de filas
+    db.session.execute(insert(Cambio.__table__), [
+        {'seq': seq, 'entidad': entidad, 'entidad_id': entidad_id, 'operacion': operacion}
+        for entidad, entidad_id, operacion in cambios
+    ])
+    return seq
+
+def secuencia_actual():
+    """Devuelve el último número de secuencia confirmado (0 si aún no hay cambios)."""
+    return db.session.query(Secuencia.valor).filter_by(nombre='cambios').scalar() or 0
+
+def secuencia_podada():
+    """Última secuencia cuyos cambios se han eliminado (0 si nunca se ha podado el registro)."""
+    return db.session.query(Secuencia.valor).filter_by(nombre='cambios_podados').scalar() or 0
+
+def podar_cambios(dias=DIAS_RETENCION_CAMBIOS):
+    """
+    Elimina los cambios de más de `dias` días y guarda en la fila 'cambios_podados' de
+    Secuencia la última secuencia eliminada. Se borran transacciones completas (por `seq`),
+    nunca parte de una. Hace commit. Devuelve el número de filas eliminadas.
+    """
+    limite = datetime.datetime.utcnow() - datetime.timedelta(days=dias)
+    hasta = db.session.query(func.max(Cambio.seq)).filter(Cambio.fecha < limite).scalar()
+    if hasta is None or hasta <= secuencia_podada():
+        return 0
+    eliminados = db.session.execute(delete(Cambio).where(Cambio.seq <= hasta)).rowcount
+    podada = db.session.get(Secuencia, 'cambios_podados')
+    if podada is None:
+        db.session.add(Secuencia(nombre='cambios_podados', valor=hasta))
+    else:
+        podada.valor = hasta
+    db.session.commit()
+    return eliminados
+
+def describir_cambios(cambios):
+    """
+    Convierte cambios (seq, entidad, entidad_id, operacion) en registros con el estado actual
+    de cada fila, en el mismo formato que los listados. Hace una consulta por tipo de entidad.
+    Una entidad que ya no existe se describe como eliminada.
+    """
+    cambios = list(cambios)
+    ids = {'articulo': set(), 'material': set(), 'movimiento': set()}
+    for _, entidad, entidad_id, operacion in cambios:
+        if operacion == 'upsert':
+            ids[entidad].add(entidad_id)
+    datos = {
+        'articulo': {r.id: fila_inventario(r) for r in filtrar_en_trozos(consulta_inventario(), Articulo.id, ids['articulo'])},
+        'material': {m.id: fila_material(m) for m in filtrar_en_trozos(Material.query, Material.id, ids['material'])},
+        'movimiento': {r.id: fila_historial(r) for r in filtrar_en_trozos(consulta_historial(), Movimiento.id, ids['movimiento'])},
+    }
+
+    registros = []
+    for seq, entidad, entidad_id, operacion in cambios:
+        fila = datos[entidad].get(entidad_id)
+        if operacion == 'upsert' and fila is not None:
+            registros.append({'seq': seq, 'entidad': entidad, 'operacion': 'upsert', 'id': entidad_id, 'datos': fila})
+        else:
+            registros.append({'seq': seq, 'entidad': entidad, 'operacion': 'delete', 'id': entidad_id})
+    return registros
+
+def ids_articulos_de_material(material_id):
+    """Ids de los artículos vinculados a un material (su unidad cambia con el material)."""
+    return [articulo_id for (articulo_id,) in db.session.query(Articulo.id).filter_by(material_id=material_id)]
+
+def version_de(*entidades):
+    """
+    Versión de un conjunto de tablas: la última secuencia en la que cambió alguna de ellas.
+    Si sus últimos cambios ya se podaron, vale la secuencia podada, que es posterior a ellos.
+    """
+    ultima = db.session.query(func.max(Cambio.seq)).filter(Cambio.entidad.in_(entidades)).scalar() or 0
+    return max(ultima, secuencia_podada())
+
+# --- CACHÉ HTTP (ETag) Y COMPRESIÓN ---
+# Tamaño mínimo (en bytes) a partir del cual se comprimen las respuestas
+TAMANO_MINIMO_COMPRESION = 1024
+# Sufijos que se añaden al ETag de cada representación comprimida
+SUFIJOS_ETAG = ('', '-gzip', '-br')
+
+def con_etag(*entidades):
+    """
+    Decorador para los listados: calcula un ETag fuerte a partir de la versión de las tablas
+    de las que depende la respuesta (y de los parámetros de la URL). Si el cliente ya tiene
+    esa versión (If-None-Match), responde 304 sin consultar los datos.
+    """
+    def decorador(vista):
+        @wraps(vista)
+        def envoltura(*args, **kwargs):
+            parametros = hashlib.sha1(request.query_string).hexdigest()[:12]
+            # La versión queda en `g` para la caché de respuestas (ver `con_cache_respuesta`)
+            g.version_tablas = version_de(*entidades)
+            etag = f"{request.path.strip('/').replace('/', '-')}-v{g.version_tablas}-{parametros}"
+            for sufijo in SUFIJOS_ETAG:
+                if request.if_none_match.contains(etag + sufijo):
+                    response = app.response_class(status=304)
+                    response.set_etag(etag + sufijo)
+                    response.vary.add('Accept-Encoding')
+                    return response
+
+            response = app.make_response(vista(*args, **kwargs))
+            if response.status_code == 200:
+                response.set_etag(etag)
+            return response
+        return envoltura
+    return decorador
+
+# --- CACHÉ DE RESPUESTAS ---
+# Los listados completos se guardan ya serializados (bytes JSON) con la versión de sus tablas
+# en la clave. Toda escritura pasa por `registrar_cambios`, que sube esa versión en la misma
+# transacción, así que una escritura deja de servir exactamente las respuestas a las que afecta
+# sin borrar nada a mano; las claves antiguas desaparecen por LRU o por caducidad.
+SEGUNDOS_CACHE_RESPUESTAS = 3600
+MAX_BYTES_CACHE_RESPUESTAS = 64 * 1024 * 1024
+# Segundos que una petición espera a que otra genere la misma respuesta antes de generarla ella
+ESPERA_MAXIMA_CACHE_RESPUESTAS = 5
+
+class CacheRespuestasMemoria:
+    """Backend en memoria del proceso (por defecto, y para pruebas): LRU limitado en bytes."""
+
+    def __init__(self, max_bytes=MAX_BYTES_CACHE_RESPUESTAS):
+        self.max_bytes = max_bytes
+        self.datos = OrderedDict()
+        self.bytes = 0
+        self.lock = threading.Lock()
+
+    def obtener(self, clave):
+        with self.lock:
+            valor = self.datos.get(clave)
+            if valor is not None:
+                self.datos.move_to_end(clave)
+            return valor
+
+    def guardar(self, clave, valor, segundos):
+        # Sin caducidad: las claves llevan la versión y las antiguas salen por LRU
+        with self.lock:
+            anterior = self.datos.pop(clave, None)
+            if anterior is not None:
+                self.bytes -= len(anterior)
+            self.datos[clave] = valor
+            self.bytes += len(valor)
+            while self.bytes > self.max_bytes and len(self.datos) > 1:
+                _, descartado = self.datos.popitem(last=False)
+                self.bytes -= len(descartado)
+
+    def bloquear(self, clave, segundos):
+        # Un solo proceso: las peticiones concurrentes ya las agrupa `VueloUnico`
+        return True
+
+    def desbloquear(self, clave):
+        pass
+
+class CacheRespuestasRedis:
+    """Backend compartido por todos los workers (CACHE_RESPUESTAS_URL=redis://...)."""
+
+    def __init__(self, url):
+        self.cliente = redis.Redis.from_url(url)
+
+    def obtener(self, clave):
+        return self.cliente.get(clave)
+
+    def guardar(self, clave, valor, segundos):
+        self.cliente.set(clave, valor, ex=segundos)
+
+    def bloquear(self, clave, segundos):
+        # Solo un worker genera cada respuesta; el bloqueo caduca solo si ese worker muere
+        return bool(self.cliente.set(f'{clave}:generando', b'1', nx=True, ex=segundos))
+
+    def desbloquear(self, clave):
+        self.cliente.delete(f'{clave}:generando')
+
+class VueloUnico:
+    """Agrupa las peticiones concurrentes con la misma clave: una hace el trabajo y las demás la esperan."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.en_curso = {} # clave -> threading.Event
+
+    @contextmanager
+    def turno(self, clave, espera_maxima):
+        """Da True a la primera petición con esa clave; las demás esperan a que termine y reciben False."""
+        with self.lock:
+            evento = self.en_curso.get(clave)
+            lider = evento is None
+            if lider:
+                evento = self.en_curso[clave] = threading.Event()
+        if not lider:
+            evento.wait(espera_maxima)
+            yield False
+            return
+        try:
+            yield True
+        finally:
+            with self.lock:
+                self.en_curso.pop(clave, None)
+            evento.set()
+
+def crear_cache_respuestas():
+    url = os.environ.get('CACHE_RESPUESTAS_URL')
+    if url and REDIS_AVAILABLE:
+        return CacheRespuestasRedis(url)
+    if url:
+        print('CACHE_RESPUESTAS_URL está definida pero la librería redis no está instalada: se usa la caché en memoria.')
+    return CacheRespuestasMemoria()
+
+cache_respuestas = crear_cache_respuestas()
+vuelo_unico = VueloUnico()
+
+def leer_cache_respuestas(clave):
+    """Lee de la caché; si el backend falla, se comporta como un fallo de caché (la BD sigue respondiendo)."""
+    try:
+        return cache_respuestas.obtener(clave)
+    except Exception as e:
+        print(f'Error al leer la caché de respuestas: {e}')
+        return None
+
+def con_cache_respuesta(vista):
+    """
+    Decorador para los listados completos; debe ir debajo de `con_etag`, que calcula la versión.
+    Sirve el JSON guardado para esa versión y esos parámetros o, si no está, lo genera una sola
+    vez aunque lleguen muchas peticiones a la vez (tras una notificación, todos los clientes
+    recargan al mismo tiempo): las demás esperan y reutilizan el resultado.
+    """
+    @wraps(vista)
+    def envoltura(*args, **kwargs):
+        clave = f"respuesta:{request.path}:{hashlib.sha1(request.query_string).hexdigest()[:12]}:v{g.version_tablas}"
+
+        def respuesta_guardada():
+            datos = leer_cache_respuestas(clave)
+            return None if datos is None else app.response_class(datos, mimetype='application/json')
+
+        response = respuesta_guardada()
+        if response is not None:
+            return response
+        with vuelo_unico.turno(clave, ESPERA_MAXIMA_CACHE_RESPUESTAS) as lider:
+            if not lider:
+                # Otra petición de este proceso acaba de generarla (si falló, se genera aquí)
+                response = respuesta_guardada()
+                if response is not None:
+                    return response
+            try:
+                bloqueado = cache_respuestas.bloquear(clave, ESPERA_MAXIMA_CACHE_RESPUESTAS)
+            except Exception:
+                bloqueado = True
+            if not bloqueado:
+                # Otro worker la está generando: se espera a que aparezca en la caché compartida
+                limite = time.monotonic() + ESPERA_MAXIMA_CACHE_RESPUESTAS
+                while time.monotonic() < limite:
+                    time.sleep(0.05)
+                    response = respuesta_guardada()
+                    if response is not None:
+                        return response
+            try:
+                response = app.make_response(vista(*args, **kwargs))
+                if response.status_code == 200:
+                    try:
+                        cache_respuestas.guardar(clave, response.get_data(), SEGUNDOS_CACHE_RESPUESTAS)
+                    except Exception as e:
+                        print(f'Error al guardar en la caché de respuestas: {e}')
+                return response
+            finally:
+                if bloqueado:
+                    try:
+                        cache_respuestas.desbloquear(clave)
+                    except Exception:
+                        pass
+    return envoltura
+
+@app.after_request
+def comprimir_respuesta(response):
+    """Comprime con brotli o gzip las respuestas grandes si el cliente lo admite."""
+    if (response.status_code != 200 or response.direct_passthrough or response.is_streamed
+            or 'Content-Encoding' in response.headers
+            or response.mimetype not in ('application/json', 'text/csv')):
+        return response
+
+    datos = response.get_data()
+    if len(datos) < TAMANO_MINIMO_COMPRESION:
+        return response
+
+    aceptadas = request.accept_encodings
+    if BROTLI_AVAILABLE and aceptadas['br']:
+        codificacion, datos = 'br', brotli.compress(datos, quality=5)
+    elif aceptadas['gzip']:
+        codificacion, datos = 'gzip', gzip.compress(datos, compresslevel=6)
+    else:
+        return response
+
+    response.set_data(datos)
+    response.headers['Content-Encoding'] = codificacion
+    response.vary.add('Accept-Encoding')
+    # Cada representación comprimida tiene su propio ETag fuerte
+    etag, debil = response.get_etag()
+    if etag:
+        response.set_etag(f'{etag}-{codificacion}', weak=debil)
+    return response
+
 # --- LÓGICA DE NOTIFICACIÓN ---
-def notificar_actualizacion():
-    """Emite eventos a todos los clientes para que recarguen sus datos."""
-    socketio.emit('actualizacion_servidor', {'data': 'updated'})
+# Tamaño máximo (en bytes de JSON) de los cambios enviados en una notificación. Si se supera,
+# la notificación solo pide a los clientes que se resincronicen a través de /cambios.
+LIMITE_BYTES_NOTIFICACION = 16 * 1024
+
+def notificar_actualizacion(seq=None, cambios=()):
+    """
+    Emite a todos los clientes los cambios confirmados con la secuencia `seq`, con el estado
+    actual de cada fila, para que actualicen sus vistas sin hacer peticiones adicionales.
+    `cambios` es la misma lista de tuplas (entidad, entidad_id, operacion) que se registró.
+    Se llama después del commit: nunca lanza excepciones, para que un fallo al notificar no
+    cambie la respuesta de una escritura ya confirmada. Si no se pueden describir los cambios,
+    se pide a los clientes que se resincronicen.
+    """
+    # 'data' se mantiene para los clientes anteriores, que recargan todo al recibir el evento
+    payload = {'data': 'updated', 'seq': seq}
+    try:
+        registros = []
+        masivo = any(operacion == 'resync' for _, _, operacion in cambios)
+        if seq is not None and not masivo:
+            registros = describir_cambios((seq, entidad, entidad_id, operacion) for entidad, entidad_id, operacion in cambios)
+        if seq is None or masivo or len(json.dumps(registros)) > LIMITE_BYTES_NOTIFICACION:
+            payload['resync'] = True
+        else:
+            payload['cambios'] = registros
+    except Exception:
+        app.logger.exception('No se pudieron describir los cambios de la secuencia %s', seq)
+        db.session.rollback()
+        payload = {'data': 'updated', 'seq': seq, 'resync': True}
+    try:
+        socketio.emit('actualizacion_servidor', payload)
+    except Exception:
+        app.logger.exception('No se pudo emitir la notificación de la secuencia %s', seq)
 
 # --- RUTAS DE LA API (ENDPOINTS) ---
 @app.route('/health')
@@ -67,16 +542,164 @@ def health_check():
     """Simple endpoint para que los servicios de monitoreo verifiquen que la app está viva."""
     return jsonify({"status": "ok"})
 
+# --- CONSULTAS COMPARTIDAS ---
+# Las usan los listados y /cambios, para que una fila tenga siempre el mismo formato.
+def consulta_inventario():
+    return db.session.query(
+        Articulo.id, Articulo.nombre, Articulo.cantidad, Material.unidad_medicion
+    ).outerjoin(Material, Articulo.material_id == Material.id)
+
+def fila_inventario(r):
+    return {'id': r.id, 'nombre': r.nombre, 'cantidad': r.cantidad, 'unidad_medicion': r.unidad_medicion}
+
+def consulta_historial():
+    return db.session.query(
+        Movimiento.id,
+        Articulo.nombre.label('articulo_nombre'),
+        Movimiento.tipo,
+        Movimiento.cantidad,
+        Material.unidad_medicion,
+        Movimiento.destino,
+        Movimiento.proveedor,
+        Movimiento.fecha
+    ).join(Articulo, Movimiento.articulo_id == Articulo.id).outerjoin(Material, Articulo.material_id == Material.id)
+
+def fila_historial(r):
+    # La cantidad se muestra sin signo; el tipo indica el sentido del movimiento
+    return {
+        'id': r.id, 'Articulo': r.articulo_nombre, 'Tipo': r.tipo, 'cantidad': abs(r.cantidad),
+        'Unidad': r.unidad_medicion, 'Ubicacion': r.destino,
+        'Proveedor': r.proveedor, 'fecha': r.fecha.isoformat()
+    }
+
+def fila_material(m):
+    return {'id': m.id, 'nombre': m.nombre, 'unidad_medicion': m.unidad_medicion, 'imagen_path': m.imagen_path}
+
+# --- FILTROS Y ORDENACIÓN ---
+# Valores aceptados por el parámetro 'sort' (un '-' delante indica orden descendente)
+ORDEN_INVENTARIO = {'nombre': Articulo.nombre, 'cantidad': Articulo.cantidad}
+ORDEN_HISTORIAL = {'fecha': Movimiento.fecha, 'articulo': Articulo.nombre, 'cantidad': func.abs(Movimiento.cantidad)}
+
+def parsear_orden(valor, columnas, por_defecto):
+    """Convierte un parámetro 'sort' como '-fecha' en (nombre, descendente). Lanza ValueError si no es válido."""
+    valor = (valor or por_defecto).strip()
+    descendente = valor.startswith('-')
+    nombre = valor.lstrip('-')
+    if nombre not in columnas:
+        raise ValueError(f"Orden no válido: '{valor}'. Opciones: {', '.join(sorted(columnas))}")
+    return nombre, descendente
+
+def rango_de_fecha(valor):
+    """
+    Convierte 'AAAA', 'AAAA-MM' o 'AAAA-MM-DD' en el intervalo [inicio, fin) que cubre ese periodo.
+    Lanza ValueError si el formato no es válido.
+    """
+    partes = valor.strip().split('-')
+    try:
+        numeros = [int(p) for p in partes]
+        if len(numeros) == 1:
+            inicio = datetime.datetime(numeros[0], 1, 1)
+            fin = datetime.datetime(numeros[0] + 1, 1, 1)
+        elif len(numeros) == 2:
+            inicio = datetime.datetime(numeros[0], numeros[1], 1)
+            fin = datetime.datetime(numeros[0] + numeros[1] // 12, numeros[1] % 12 + 1, 1)
+        elif len(numeros) == 3:
+            inicio = datetime.datetime(*numeros)
+            fin = inicio + datetime.timedelta(days=1)
+        else:
+            raise ValueError
+    except (ValueError, TypeError):
+        raise ValueError(f"Fecha no válida: '{valor}'. Use AAAA, AAAA-MM o AAAA-MM-DD.")
+    return inicio, fin
+
+def filtrar_inventario(query, args):
+    """Aplica a una consulta de inventario el filtro 'q' (texto contenido en el nombre)."""
+    q = (args.get('q') or '').strip()
+    if q:
+        query = query.filter(Articulo.nombre.icontains(q, autoescape=True))
+    return query
+
+def ordenar_inventario(query, orden, descendente):
+    columna = ORDEN_INVENTARIO[orden]
+    return query.order_by(columna.desc() if descendente else columna.asc(), Articulo.nombre)
+
+def ordenar_historial(query, orden, descendente):
+    # La fecha y el id desempatan, para que el orden sea estable entre páginas
+    columna = ORDEN_HISTORIAL[orden]
+    if descendente:
+        return query.order_by(columna.desc(), Movimiento.fecha.desc(), Movimiento.id.desc())
+    return query.order_by(columna.asc(), Movimiento.fecha.asc(), Movimiento.id.asc())
+
+def filtrar_historial(query, args):
+    """
+    Aplica a una consulta sobre Movimiento los filtros del historial recibidos en la URL:
+    q (texto contenido en el artículo), tipo, destino, proveedor, desde y hasta (ambos inclusive).
+    Lanza ValueError si algún parámetro no es válido.
+    """
+    q = (args.get('q') or '').strip()
+    if q:
+        # Los artículos son pocos: se resuelven primero sus ids y el historial se filtra
+        # por el índice (articulo_id, fecha) en lugar de comparar texto en cada movimiento.
+        articulos = select(Articulo.id).where(Articulo.nombre.icontains(q, autoescape=True))
+        query = query.filter(Movimiento.articulo_id.in_(articulos))
+
+    tipo = (args.get('tipo') or '').strip().capitalize()
+    if tipo:
+        if tipo not in ('Entrada', 'Salida'):
+            raise ValueError("El tipo debe ser 'Entrada' o 'Salida'.")
+        query = query.filter(Movimiento.tipo == tipo)
+
+    # Los valores se guardan normalizados en mayúsculas, así la comparación exacta usa el índice
+    destino = (args.get('destino') or '').strip().upper()
+    if destino:
+        query = query.filter(Movimiento.destino == destino)
+    proveedor = (args.get('proveedor') or '').strip().upper()
+    if proveedor:
+        query = query.filter(Movimiento.proveedor == proveedor)
+
+    if args.get('desde'):
+        query = query.filter(Movimiento.fecha >= rango_de_fecha(args['desde'])[0])
+    if args.get('hasta'):
+        query = query.filter(Movimiento.fecha < rango_de_fecha(args['hasta'])[1])
+    return query
+
 @app.route('/inventario', methods=['GET'])
+@con_etag('articulo', 'material')
+@con_cache_respuesta
 def get_inventario():
-    articulos = db.session.query(Articulo, Material.unidad_medicion).outerjoin(Material, Articulo.nombre == Material.nombre).all()
-    return jsonify([{'nombre': art.nombre, 'cantidad': art.cantidad, 'unidad_medicion': unidad} for art, unidad in articulos])
+    # Parámetros opcionales: q (texto contenido en el nombre) y sort (nombre, cantidad, -nombre, -cantidad)
+    try:
+        orden, descendente = parsear_orden(request.args.get('sort'), ORDEN_INVENTARIO, 'nombre')
+    except ValueError as e:
+        return jsonify({'status': 'error', 'message': str(e)}), 400
+
+    articulos = ordenar_inventario(filtrar_inventario(consulta_inventario(), request.args), orden, descendente).all()
+    return jsonify([fila_inventario(r) for r in articulos])
+
+# --- PAGINACIÓN POR CURSOR ---
+def codificar_cursor(fecha, movimiento_id):
+    """Convierte la posición (fecha, id) de un movimiento en un cursor opaco para la URL."""
+    crudo = json.dumps([fecha.isoformat(), movimiento_id])
+    return base64.urlsafe_b64encode(crudo.encode('utf-8')).decode('ascii')
+
+def decodificar_cursor(cursor):
+    """Operación inversa de `codificar_cursor`. Lanza ValueError si el cursor no es válido."""
+    try:
+        fecha, movimiento_id = json.loads(base64.urlsafe_b64decode(cursor.encode('ascii')))
+        return datetime.datetime.fromisoformat(fecha), int(movimiento_id)
+    except Exception as e:
+        raise ValueError(f'Cursor inválido: {e}')
 
 @app.route('/historial', methods=['GET'])
+@con_etag('movimiento', 'articulo', 'material')
 def get_historial():
     # --- MEJORA: Paginación ---
     # El cliente puede pasar 'page' y 'per_page' como parámetros en la URL
     # ej: /historial?page=1&per_page=50
+    # o, en modo cursor, 'after' con el cursor devuelto por la página anterior
+    # ej: /historial?after=&per_page=50  (la primera página usa un cursor vacío)
+    # Con un cursor vacío, 'page' salta a esa página (por OFFSET) y devuelve su cursor siguiente
+    # Filtros: q, tipo, destino, proveedor, desde, hasta y sort (ver `filtrar_historial`)
     try:
         page = request.args.get('page', 1, type=int)
         per_page = request.args.get('per_page', 50, type=int)
@@ -84,52 +707,274 @@ def get_historial():
         page = 1
         per_page = 50
 
-    # --- MEJORA: Paginación a nivel de base de datos con UNION ---
-    # Subconsulta para obtener las entradas en un formato común
-    entradas_subquery = db.session.query(
-        Articulo.nombre.label('articulo_nombre'),
-        literal_column("'Entrada'").label('tipo'),
-        Entrada.cantidad,
-        Material.unidad_medicion,
-        Entrada.destino.label('ubicacion'),
-        Entrada.proveedor,
-        Entrada.fecha
-    ).join(Articulo).outerjoin(Material, Articulo.nombre == Material.nombre)
+    after = request.args.get('after')
+    cursor = None
+    try:
+        orden, descendente = parsear_orden(request.args.get('sort'), ORDEN_HISTORIAL, '-fecha')
+        if after is not None and orden != 'fecha':
+            raise ValueError("La paginación por cursor solo admite ordenar por 'fecha' o '-fecha'.")
+        if after:
+            cursor = decodificar_cursor(after)
+    except ValueError as e:
+        return jsonify({'status': 'error', 'message': str(e)}), 400
 
-    # Subconsulta para obtener las salidas en el mismo formato común
-    salidas_subquery = db.session.query(
-        Articulo.nombre.label('articulo_nombre'),
-        literal_column("'Salida'").label('tipo'),
-        Salida.cantidad,
-        Material.unidad_medicion,
-        Salida.destino.label('ubicacion'),
-        literal_column("NULL").label('proveedor'), # Para que las columnas coincidan
-        Salida.fecha
-    ).join(Articulo).outerjoin(Material, Articulo.nombre == Material.nombre)
+    # --- MEJORA: Lectura directa del libro de movimientos ---
+    # Una sola consulta sobre Movimiento ordenada por su índice (fecha, id), sin UNION.
+    query = consulta_historial()
+
+    # --- MEJORA: Filtros en la base de datos ---
+    # El cliente solo recibe las filas que coinciden, en lugar de filtrar el historial completo.
+    try:
+        query = filtrar_historial(query, request.args)
+    except ValueError as e:
+        return jsonify({'status': 'error', 'message': str(e)}), 400
 
-    # Unir ambas subconsultas con UNION ALL
-    union_query = union_all(entradas_subquery, salidas_subquery).alias('historial')
+    query = ordenar_historial(query, orden, descendente)
 
-    # Construir la consulta final, ordenando y paginando a nivel de base de datos
-    paginated_query = db.session.query(union_query).order_by(union_query.c.fecha.desc()).offset((page - 1) * per_page).limit(per_page)
+    if after is not None:
+        # --- MEJORA: Paginación por cursor (keyset) ---
+        # El rango empieza en el cursor, así el coste de una página no depende de su profundidad.
+        if cursor:
+            fecha, id_cursor = cursor
+            if descendente:
+                query = query.filter(or_(Movimiento.fecha < fecha, and_(Movimiento.fecha == fecha, Movimiento.id < id_cursor)))
+            else:
+                query = query.filter(or_(Movimiento.fecha > fecha, and_(Movimiento.fecha == fecha, Movimiento.id > id_cursor)))
+        elif page > 1:
+            # Salto a una página sin cursor conocido: se paga el OFFSET una vez y se sigue por cursor
+            query = query.offset((page - 1) * per_page)
+        results = query.limit(per_page).all()
+    else:
+        results = query.offset((page - 1) * per_page).limit(per_page).all()
 
     # Ejecutar la consulta y formatear los resultados
-    results = paginated_query.all()
-    historial_paginado = [
-        {
-            'Articulo': r.articulo_nombre, 'Tipo': r.tipo, 'cantidad': r.cantidad,
-            'Unidad': r.unidad_medicion, 'Ubicacion': r.ubicacion,
-            'Proveedor': r.proveedor, 'fecha': r.fecha.isoformat()
-        } for r in results
-    ]
-    return jsonify(historial_paginado)
+    historial_paginado = [fila_historial(r) for r in results]
+    if after is None:
+        return jsonify(historial_paginado)
+
+    # En modo cursor se devuelve también el cursor de la página siguiente (None si no hay más)
+    next_cursor = None
+    if len(results) == per_page:
+        ultima = results[-1]
+        next_cursor = codificar_cursor(ultima.fecha, ultima.id)
+    return jsonify({'items': historial_paginado, 'next_cursor': next_cursor})
+
+@app.route('/historial/total', methods=['GET'])
+@con_etag('movimiento', 'articulo')
+def get_total_historial():
+    """Número de movimientos que coinciden con los filtros de /historial (para las listas virtuales del cliente)."""
+    try:
+        query = filtrar_historial(db.session.query(func.count(Movimiento.id)), request.args)
+    except ValueError as e:
+        return jsonify({'status': 'error', 'message': str(e)}), 400
+    return jsonify({'total': query.scalar()})
+
+# --- EXPORTACIÓN ---
+# Filas que se leen de la base de datos en cada bloque (cursor del servidor con yield_per)
+TAMANO_BLOQUE_EXPORTACION = 1000
+# Tamaño de los trozos en que se envía un archivo ya generado (xlsx)
+TAMANO_TROZO_EXPORTACION = 64 * 1024
+
+TIPOS_MIME_EXPORTACION = {
+    'csv': 'text/csv',
+    'xlsx': 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet',
+    'parquet': 'application/vnd.apache.parquet',
+}
+
+class SalidaPorBloques(io.RawIOBase):
+    """Archivo de solo escritura que acumula lo escrito hasta que se recoge con `vaciar`."""
+
+    def __init__(self):
+        super().__init__()
+        self.partes = []
+        self.posicion = 0
+
+    def writable(self):
+        return True
+
+    def write(self, datos):
+        datos = bytes(datos)
+        self.partes.append(datos)
+        self.posicion += len(datos)
+        return len(datos)
+
+    def tell(self):
+        return self.posicion
+
+    def vaciar(self):
+        datos = b''.join(self.partes)
+        self.partes = []
+        return datos
+
+def bloques_csv(cabecera, bloques, comprimir):
+    """Genera el CSV por bloques (con BOM para que Excel detecte UTF-8), opcionalmente en gzip."""
+    compresor = zlib.compressobj(6, zlib.DEFLATED, 31) if comprimir else None
+    texto = io.StringIO()
+    escritor = csv.writer(texto)
+    texto.write('\ufeff')
+    escritor.writerow(cabecera)
+    for filas in bloques:
+        escritor.writerows(filas)
+        datos = texto.getvalue().encode('utf-8')
+        texto.seek(0)
+        texto.truncate()
+        if compresor:
+            datos = compresor.compress(datos)
+        if datos:
+            yield datos
+    if compresor:
+        yield compresor.flush()
+
+def bloques_xlsx(cabecera, bloques):
+    """
+    Genera un .xlsx con el modo de solo escritura de openpyxl, que vuelca las filas a disco en
+    lugar de guardarlas en memoria, y envía el archivo resultante por trozos.
+    """
+    libro = openpyxl.Workbook(write_only=True)
+    hoja = libro.create_sheet()
+    hoja.append(cabecera)
+    for filas in bloques:
+        for fila in filas:
+            hoja.append(fila)
+    with tempfile.TemporaryFile() as archivo:
+        libro.save(archivo)
+        archivo.seek(0)
+        while True:
+            trozo = archivo.read(TAMANO_TROZO_EXPORTACION)
+            if not trozo:
+                break
+            yield trozo
+
+def bloques_parquet(cabecera, tipos, bloques):
+    """Genera un Parquet con un grupo de filas por bloque leído de la base de datos."""
+    tipos_arrow = {'texto': pa.string(), 'entero': pa.int64(), 'fecha': pa.timestamp('us')}
+    esquema = pa.schema([(nombre, tipos_arrow[tipo]) for nombre, tipo in zip(cabecera, tipos)])
+    salida = SalidaPorBloques()
+    escritor = pq.ParquetWriter(salida, esquema)
+    for filas in bloques:
+        columnas = list(zip(*filas))
+        escritor.write_batch(pa.record_batch([list(c) for c in columnas], schema=esquema))
+        yield salida.vaciar()
+    escritor.close()
+    yield salida.vaciar()
+
+def respuesta_exportacion(nombre, formato, cabecera, tipos, query, fila):
+    """
+    Devuelve una respuesta en streaming con el resultado de `query` en el formato pedido.
+    Las filas se leen con un cursor del servidor (`yield_per`) y se convierten con `fila`,
+    de modo que la memoria usada no depende del número de filas exportadas.
+    """
+    if formato not in TIPOS_MIME_EXPORTACION:
+        return jsonify({'status': 'error', 'message': f"Formato no válido: '{formato}'. Use csv, xlsx o parquet."}), 400
+    if formato == 'xlsx' and not OPENPYXL_AVAILABLE:
+        return jsonify({'status': 'error', 'message': 'La exportación a xlsx requiere openpyxl en el servidor.'}), 501
+    if formato == 'parquet' and not PYARROW_AVAILABLE:
+        return jsonify({'status': 'error', 'message': 'La exportación a parquet requiere pyarrow en el servidor.'}), 501
+
+    def bloques():
+        resultado = query.yield_per(TAMANO_BLOQUE_EXPORTACION)
+        lote = []
+        for r in resultado:
+            lote.append(fila(r))
+            if len(lote) >= TAMANO_BLOQUE_EXPORTACION:
+                yield lote
+                lote = []
+        if lote:
+            yield lote
+
+    cabeceras = {
+        'Content-Disposition': f'attachment; filename="{nombre}_{datetime.date.today():%Y%m%d}.{formato}"',
+    }
+    if formato == 'csv':
+        # El CSV se comprime al vuelo; xlsx y parquet ya van comprimidos
+        comprimir = bool(request.accept_encodings['gzip'])
+        if comprimir:
+            cabeceras['Content-Encoding'] = 'gzip'
+        cuerpo = bloques_csv(cabecera, bloques(), comprimir)
+    elif formato == 'xlsx':
+        cuerpo = bloques_xlsx(cabecera, bloques())
+    else:
+        cuerpo = bloques_parquet(cabecera, tipos, bloques())
+
+    response = Response(stream_with_context(cuerpo), mimetype=TIPOS_MIME_EXPORTACION[formato], headers=cabeceras)
+    response.vary.add('Accept-Encoding')
+    return response
+
+@app.route('/historial/export', methods=['GET'])
+def exportar_historial():
+    """
+    Exporta el historial completo (sin paginar) como csv, xlsx o parquet (parámetro 'format').
+    Admite los mismos filtros y orden que /historial. Las columnas coinciden con las que
+    espera /historial/importar.
+    """
+    try:
+        orden, descendente = parsear_orden(request.args.get('sort'), ORDEN_HISTORIAL, '-fecha')
+        query = ordenar_historial(filtrar_historial(consulta_historial(), request.args), orden, descendente)
+    except ValueError as e:
+        return jsonify({'status': 'error', 'message': str(e)}), 400
+
+    return respuesta_exportacion(
+        'historial', request.args.get('format', 'csv'),
+        ['Articulo', 'Tipo', 'Cantidad', 'Unidad', 'Ubicacion', 'Proveedor', 'Fecha'],
+        ['texto', 'texto', 'entero', 'texto', 'texto', 'texto', 'fecha'],
+        query,
+        lambda r: (r.articulo_nombre, r.tipo, abs(r.cantidad), r.unidad_medicion, r.destino, r.proveedor, r.fecha),
+    )
+
+@app.route('/inventario/export', methods=['GET'])
+def exportar_inventario():
+    """Exporta el inventario como csv, xlsx o parquet (parámetro 'format'), con los filtros de /inventario."""
+    try:
+        orden, descendente = parsear_orden(request.args.get('sort'), ORDEN_INVENTARIO, 'nombre')
+    except ValueError as e:
+        return jsonify({'status': 'error', 'message': str(e)}), 400
+    query = ordenar_inventario(filtrar_inventario(consulta_inventario(), request.args), orden, descendente)
+
+    return respuesta_exportacion(
+        'inventario', request.args.get('format', 'csv'),
+        ['Nombre', 'Cantidad', 'Unidad'], ['texto', 'entero', 'texto'],
+        query,
+        lambda r: (r.nombre, r.cantidad, r.unidad_medicion),
+    )
+
+@app.route('/cambios', methods=['GET'])
+def get_cambios():
+    """
+    Sincronización incremental: devuelve las filas insertadas, actualizadas o eliminadas
+    después de la secuencia `since`, con su estado actual. Sin `since`, solo devuelve la
+    secuencia actual (el cliente la guarda antes de hacer una carga completa).
+    Si hay demasiados cambios, `since` es posterior a la secuencia actual o anterior a los
+    cambios que aún se conservan (ver `podar_cambios`), responde `resync: true` y el cliente
+    debe recargar todo.
+    """
+    since = request.args.get('since', type=int)
+    seq = secuencia_actual()
+    if since is not None and since > seq:
+        # La secuencia del cliente no es de esta base de datos (p. ej. una caché local antigua)
+        return jsonify({'seq': seq, 'resync': True})
+    if since is not None and since < secuencia_podada():
+        # Parte de los cambios posteriores a `since` ya se eliminaron
+        return jsonify({'seq': seq, 'resync': True})
+    if since is None or since == seq:
+        return jsonify({'seq': seq, 'cambios': []})
+
+    # Solo interesa el último cambio de cada entidad
+    ultimos = {}
+    for c in Cambio.query.filter(Cambio.seq > since, Cambio.seq <= seq).order_by(Cambio.id):
+        ultimos.pop((c.entidad, c.entidad_id), None)
+        ultimos[(c.entidad, c.entidad_id)] = (c.seq, c.entidad, c.entidad_id, c.operacion)
+        if c.operacion == 'resync' or len(ultimos) > LIMITE_CAMBIOS:
+            return jsonify({'seq': seq, 'resync': True})
+    return jsonify({'seq': seq, 'cambios': describir_cambios(ultimos.values())})
 
 @app.route('/materiales', methods=['GET'])
+@con_etag('material')
+@con_cache_respuesta
 def get_materiales():
     """Devuelve una lista de todos los materiales registrados."""
     try:
         materiales = Material.query.order_by(Material.nombre).all()
-        return jsonify([{'nombre': m.nombre, 'unidad_medicion': m.unidad_medicion, 'imagen_path': m.imagen_path} for m in materiales])
+        return jsonify([fila_material(m) for m in materiales])
     except Exception as e:
         return jsonify({'status': 'error', 'message': f'Error de base de datos al obtener materiales: {e}'}), 500
 
@@ -151,13 +996,20 @@ def crear_material():
     
     try:
         db.session.add(nuevo_material)
+        db.session.flush()
+        # Los artículos ya registrados con este nombre quedan vinculados al nuevo material
+        vincular_articulos_con_materiales(nombre)
+        cambios = [('material', nuevo_material.id, 'upsert')] + \
+                  [('articulo', i, 'upsert') for i in ids_articulos_de_material(nuevo_material.id)]
+        seq = registrar_cambios(cambios)
         db.session.commit()
-        notificar_actualizacion() # Notifica a los clientes para que recarguen la lista de materiales
-        return jsonify({'status': 'success', 'message': f'Material "{nombre}" creado.'}), 201
     except Exception as e:
         db.session.rollback()
         return jsonify({'status': 'error', 'message': f'Error de base de datos al crear material: {e}'}), 500
 
+    notificar_actualizacion(seq, cambios) # Notifica a los clientes para que recarguen la lista de materiales
+    return jsonify({'status': 'success', 'message': f'Material "{nombre}" creado.'}), 201
+
 @app.route('/materiales/<int:material_id>', methods=['PUT'])
 def actualizar_material(material_id):
     """Actualiza un material existente."""
@@ -181,13 +1033,17 @@ def actualizar_material(material_id):
     material.unidad_medicion = nueva_unidad
 
     try:
+        cambios = [('material', material_id, 'upsert')] + \
+                  [('articulo', i, 'upsert') for i in ids_articulos_de_material(material_id)]
+        seq = registrar_cambios(cambios)
         db.session.commit()
-        notificar_actualizacion()
-        return jsonify({'status': 'success', 'message': 'Material actualizado.'})
     except Exception as e:
         db.session.rollback()
         return jsonify({'status': 'error', 'message': f'Error de base de datos al actualizar material: {e}'}), 500
 
+    notificar_actualizacion(seq, cambios)
+    return jsonify({'status': 'success', 'message': 'Material actualizado.'})
+
 @app.route('/materiales/<int:material_id>', methods=['DELETE'])
 def eliminar_material(material_id):
     """Elimina un material."""
@@ -196,14 +1052,18 @@ def eliminar_material(material_id):
         return jsonify({'status': 'error', 'message': 'Material no encontrado.'}), 404
 
     # Consideración: ¿Qué pasa si este material está en uso por un artículo?
-    # Por simplicidad, lo eliminamos. En una app más compleja, se podría prevenir la eliminación.
-    # Opcionalmente, se podría buscar si algún artículo usa este nombre y actuar en consecuencia.
+    # Por simplicidad, lo eliminamos y los artículos que lo usaban quedan sin material (sin unidad).
+    # SQLite no aplica el ON DELETE SET NULL si no están activadas las claves externas,
+    # por eso se desvinculan explícitamente.
 
     try:
+        articulos_afectados = ids_articulos_de_material(material_id)
+        Articulo.query.filter_by(material_id=material_id).update({'material_id': None})
         db.session.delete(material)
+        cambios = [('material', material_id, 'delete')] + \
+                  [('articulo', i, 'upsert') for i in articulos_afectados]
+        seq = registrar_cambios(cambios)
         db.session.commit()
-        notificar_actualizacion()
-        return jsonify({'status': 'success', 'message': 'Material eliminado.'})
     except Exception as e:
         db.session.rollback()
         # Esto puede ocurrir si hay una restricción de clave externa (foreign key)
@@ -213,6 +1073,298 @@ def eliminar_material(material_id):
             'message': f'Error de base de datos: Es posible que el material esté en uso y no se pueda eliminar. ({e})'
         }), 500
 
+    notificar_actualizacion(seq, cambios)
+    return jsonify({'status': 'success', 'message': 'Material eliminado.'})
+
+# --- IMÁGENES DE MATERIALES ---
+# Las imágenes se guardan por el hash SHA-256 de su contenido (<hash>.<ext>), así que la misma
+# foto subida para varios materiales ocupa un solo archivo. Material.imagen_path guarda ese
+# nombre, y junto a cada imagen se guarda su miniatura (<hash>_thumb.jpg), creada al subirla.
+IMAGENES_DIR = os.environ.get('IMAGENES_DIR', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'imagenes'))
+MAX_TAMANO_IMAGEN = 10 * 1024 * 1024 # bytes
+TAMANO_MINIATURA = (256, 256) # píxeles (máximos, se conserva la proporción)
+FORMATOS_IMAGEN = {
+    'JPEG': ('jpg', 'image/jpeg'), 'PNG': ('png', 'image/png'), 'GIF': ('gif', 'image/gif'),
+    'BMP': ('bmp', 'image/bmp'), 'WEBP': ('webp', 'image/webp'),
+}
+MIMETYPES_IMAGEN = dict(FORMATOS_IMAGEN.values())
+# Nombre de una imagen guardada por este servidor ('<sha256>.<ext>'); los valores heredados
+# de imagen_path (rutas locales de cada cliente) no lo cumplen y no se sirven
+PATRON_NOMBRE_IMAGEN = re.compile(r'[0-9a-f]{64}\.[a-z]+')
+
+def ruta_imagen(nombre, tamano='full'):
+    """Ruta en disco de la imagen `nombre` ('<hash>.<ext>') o, con tamano='thumb', de su miniatura."""
+    contenido = nombre.split('.')[0]
+    if tamano == 'thumb':
+        nombre = f'{contenido}_thumb.jpg'
+    # Subcarpetas por los dos primeros caracteres del hash para no acumular miles de archivos en una
+    return os.path.join(IMAGENES_DIR, contenido[:2], nombre)
+
+def escribir_archivo_atomico(ruta, datos):
+    """Escribe en un temporal y lo renombra: nunca queda a la vista un archivo a medio escribir."""
+    os.makedirs(os.path.dirname(ruta), exist_ok=True)
+    with tempfile.NamedTemporaryFile(dir=os.path.dirname(ruta), delete=False) as temporal:
+        temporal.write(datos)
+    os.replace(temporal.name, ruta)
+
+def crear_miniatura(imagen):
+    """Devuelve los bytes JPEG de una miniatura de `imagen` (orientada según su EXIF, fondo blanco si tiene transparencia)."""
+    imagen.draft('RGB', TAMANO_MINIATURA) # Con JPEG, decodifica directamente a menor resolución
+    imagen = ImageOps.exif_transpose(imagen)
+    imagen.thumbnail(TAMANO_MINIATURA)
+    if imagen.mode in ('RGBA', 'LA', 'P'):
+        imagen = imagen.convert('RGBA')
+        fondo = Image.new('RGB', imagen.size, 'white')
+        fondo.paste(imagen, mask=imagen.getchannel('A'))
+        imagen = fondo
+    salida = io.BytesIO()
+    imagen.convert('RGB').save(salida, 'JPEG', quality=85, optimize=True)
+    return salida.getvalue()
+
+def guardar_imagen(datos):
+    """
+    Guarda una imagen y su miniatura por el hash de su contenido. Si ya estaba guardada no se
+    escribe nada. Devuelve su nombre ('<hash>.<ext>'). Lanza ValueError si no es una imagen admitida.
+    """
+    try:
+        with Image.open(io.BytesIO(datos)) as imagen:
+            imagen.verify()
+        imagen = Image.open(io.BytesIO(datos)) # verify() deja la imagen inservible
+    except Exception:
+        raise ValueError('El archivo no es una imagen válida.')
+    if imagen.format not in FORMATOS_IMAGEN:
+        raise ValueError(f"Formato de imagen no admitido. Use uno de: {', '.join(FORMATOS_IMAGEN)}.")
+
+    nombre = f'{hashlib.sha256(datos).hexdigest()}.{FORMATOS_IMAGEN[imagen.format][0]}'
+    # La miniatura se escribe la última: si existe, la imagen completa también
+    if not os.path.exists(ruta_imagen(nombre, 'thumb')):
+        escribir_archivo_atomico(ruta_imagen(nombre), datos)
+        escribir_archivo_atomico(ruta_imagen(nombre, 'thumb'), crear_miniatura(imagen))
+    return nombre
+
+def respuesta_imagen_demasiado_grande():
+    return jsonify({'status': 'error', 'message': f'La imagen supera el máximo de {MAX_TAMANO_IMAGEN // (1024 * 1024)} MB.'}), 413
+
+def leer_como_maximo(flujo, limite):
+    """Lee de `flujo` hasta `limite` bytes o hasta el final, aunque cada lectura devuelva menos."""
+    trozos = []
+    leidos = 0
+    while leidos < limite:
+        trozo = flujo.read(min(limite - leidos, 1024 * 1024))
+        if not trozo:
+            break
+        trozos.append(trozo)
+        leidos += len(trozo)
+    return b''.join(trozos)
+
+@app.route('/materiales/<int:material_id>/imagen', methods=['POST'])
+def subir_imagen_material(material_id):
+    """
+    Asocia una imagen a un material. Acepta un formulario multipart con el campo 'imagen' o
+    la imagen como cuerpo de la petición. Responde con el nombre de la imagen guardada.
+    """
+    # Límite del cuerpo solo para esta petición (la importación de historial admite archivos
+    # grandes): Werkzeug corta la lectura con un 413 aunque el cuerpo venga sin Content-Length
+    # (chunked), también al procesar un multipart, que si no se volcaría entero a disco.
+    # Debe fijarse antes de tocar request.files o request.stream.
+    request.max_content_length = MAX_TAMANO_IMAGEN + 64 * 1024 # margen para el multipart
+    if not PIL_AVAILABLE:
+        return jsonify({'status': 'error', 'message': 'El servidor no tiene instalada la librería Pillow.'}), 501
+    material = db.session.get(Material, material_id)
+    if not material:
+        return jsonify({'status': 'error', 'message': 'Material no encontrado.'}), 404
+
+    try:
+        archivo = request.files.get('imagen')
+        datos = leer_como_maximo(archivo or request.stream, MAX_TAMANO_IMAGEN + 1)
+    except RequestEntityTooLarge:
+        return respuesta_imagen_demasiado_grande()
+    if not datos:
+        return jsonify({'status': 'error', 'message': 'No se recibió ninguna imagen.'}), 400
+    if len(datos) > MAX_TAMANO_IMAGEN:
+        return respuesta_imagen_demasiado_grande()
+
+    try:
+        nombre = guardar_imagen(datos)
+    except ValueError as e:
+        return jsonify({'status': 'error', 'message': str(e)}), 400
+    except OSError as e:
+        return jsonify({'status': 'error', 'message': f'No se pudo guardar la imagen: {e}'}), 500
+
+    try:
+        material.imagen_path = nombre
+        cambios = [('material', material_id, 'upsert')]
+        seq = registrar_cambios(cambios)
+        db.session.commit()
+    except Exception as e:
+        db.session.rollback()
+        return jsonify({'status': 'error', 'message': f'Error de base de datos: {e}'}), 500
+
+    notificar_actualizacion(seq, cambios)
+    return jsonify({'status': 'success', 'imagen': nombre}), 201
+
+@app.route('/materiales/<int:material_id>/imagen', methods=['GET'])
+def get_imagen_material(material_id):
+    """
+    Devuelve la imagen de un material: la miniatura (size=thumb, por defecto) o la original
+    (size=full). Si la URL lleva v=<nombre de la imagen actual> (el `imagen_path` del material),
+    la respuesta es inmutable y se puede guardar en caché para siempre; si no, el cliente debe
+    revalidarla con su ETag.
+    """
+    tamano = request.args.get('size', 'thumb')
+    if tamano not in ('thumb', 'full'):
+        return jsonify({'status': 'error', 'message': "El parámetro size debe ser 'thumb' o 'full'."}), 400
+    material = db.session.get(Material, material_id)
+    if not material or not material.imagen_path:
+        return jsonify({'status': 'error', 'message': 'El material no tiene imagen.'}), 404
+
+    nombre = material.imagen_path
+    ruta = ruta_imagen(nombre, tamano)
+    if not PATRON_NOMBRE_IMAGEN.fullmatch(nombre) or not os.path.exists(ruta):
+        return jsonify({'status': 'error', 'message': 'No se encuentra el archivo de la imagen.'}), 404
+    extension = 'jpg' if tamano == 'thumb' else nombre.rsplit('.', 1)[-1]
+    response = send_file(ruta, mimetype=MIMETYPES_IMAGEN.get(extension, 'application/octet-stream'),
+                         etag=f'{nombre.split(".")[0]}-{tamano}', last_modified=None)
+    if request.args.get('v') == nombre:
+        response.cache_control.no_cache = None # send_file la pone por defecto
+        response.cache_control.public = True
+        response.cache_control.max_age = 365 * 24 * 3600
+        response.cache_control.immutable = True
+    else:
+        response.cache_control.no_cache = True
+    return response
+
+# --- SUGERENCIAS ---
+COLUMNAS_SUGERENCIAS = ('articulo', 'proveedor', 'destino')
+# Número máximo de sugerencias por petición
+MAX_SUGERENCIAS = 1000
+
+def contar_sugerencias(movimientos):
+    """
+    Suma a la tabla de sugerencias los usos de artículo, proveedor y destino de `movimientos`
+    (diccionarios con 'nombre', 'proveedor', 'destino' y 'fecha'), con un upsert agregado por
+    valor. No hace commit.
+    """
+    usos = {}
+    for movimiento in movimientos:
+        fecha = movimiento['fecha']
+        for columna, valor in (('articulo', movimiento['nombre']), ('proveedor', movimiento.get('proveedor')),
+                               ('destino', movimiento.get('destino'))):
+            if valor:
+                frecuencia, ultimo_uso = usos.get((columna, valor), (0, fecha))
+                usos[(columna, valor)] = (frecuencia + 1, max(ultimo_uso, fecha))
+    # Orden fijo de las filas: dos transacciones concurrentes las bloquean en el mismo orden
+    filas = [
+        {'columna': columna, 'valor': valor, 'frecuencia': frecuencia, 'ultimo_uso': ultimo_uso}
+        for (columna, valor), (frecuencia, ultimo_uso) in sorted(usos.items())
+    ]
+    tamano = filas_por_sentencia(4)
+    for inicio in range(0, len(filas), tamano):
+        stmt = sentencia_upsert(Sugerencia).values(filas[inicio:inicio + tamano])
+        stmt = stmt.on_conflict_do_update(
+            index_elements=[Sugerencia.columna, Sugerencia.valor],
+            set_={
+                'frecuencia': Sugerencia.frecuencia + stmt.excluded.frecuencia,
+                'ultimo_uso': case(
+                    (Sugerencia.ultimo_uso.is_(None), stmt.excluded.ultimo_uso),
+                    (stmt.excluded.ultimo_uso > Sugerencia.ultimo_uso, stmt.excluded.ultimo_uso),
+                    else_=Sugerencia.ultimo_uso),
+            },
+        )
+        db.session.execute(stmt)
+
+def buscar_sugerencias(columna, texto, limite):
+    """
+    Devuelve hasta `limite` valores de `columna` que contienen `texto`: primero los que
+    empiezan por él y después el resto, cada grupo por frecuencia y uso más reciente.
+    Para 'articulo' se parte de la tabla de artículos, así se sugieren también los que aún no
+    tienen movimientos y nunca los borrados o renombrados.
+    """
+    if columna == 'articulo':
+        valor = Articulo.nombre
+        consulta = select(valor).outerjoin(
+            Sugerencia, and_(Sugerencia.columna == 'articulo', Sugerencia.valor == Articulo.nombre))
+        frecuencia = func.coalesce(Sugerencia.frecuencia, 0)
+    else:
+        valor = Sugerencia.valor
+        consulta = select(valor).where(Sugerencia.columna == columna)
+        frecuencia = Sugerencia.frecuencia
+    orden = [frecuencia.desc(), Sugerencia.ultimo_uso.desc().nulls_last(), valor]
+    if texto:
+        # La tabla tiene un valor por fila distinta (no por movimiento), así que recorrerla
+        # para buscar subcadenas es barato aunque el historial tenga millones de filas
+        consulta = consulta.where(valor.contains(texto, autoescape=True))
+        orden.insert(0, case((valor.startswith(texto, autoescape=True), 0), else_=1))
+    return db.session.scalars(consulta.order_by(*orden).limit(limite)).all()
+
+@app.route('/sugerencias/<columna>', methods=['GET'])
+@con_etag('movimiento', 'articulo')
+def get_sugerencias(columna):
+    """
+    Valores para autocompletar y filtrar una columna ('articulo', 'proveedor' o 'destino').
+    Parámetros: q (texto a buscar, sin distinguir mayúsculas) y limite (por defecto 20).
+    """
+    if columna not in COLUMNAS_SUGERENCIAS:
+        return jsonify({'status': 'error', 'message': f"Columna no válida. Use una de: {', '.join(COLUMNAS_SUGERENCIAS)}."}), 400
+    limite = max(1, min(request.args.get('limite', 20, type=int), MAX_SUGERENCIAS))
+    texto = (request.args.get('q') or '').strip().upper()
+    return jsonify(buscar_sugerencias(columna, texto, limite))
+
+# --- IDEMPOTENCIA ---
+LONGITUD_MAXIMA_CLAVE_IDEMPOTENCIA = 64
+
+def leer_clave_idempotencia():
+    """Devuelve la cabecera Idempotency-Key (o None si no viene). Lanza ValueError si no es válida."""
+    clave = (request.headers.get('Idempotency-Key') or '').strip()
+    if not clave:
+        return None
+    if len(clave) > LONGITUD_MAXIMA_CLAVE_IDEMPOTENCIA:
+        raise ValueError(f'La cabecera Idempotency-Key admite como máximo {LONGITUD_MAXIMA_CLAVE_IDEMPOTENCIA} caracteres.')
+    return clave
+
+def movimiento_con_clave(clave):
+    """Id del movimiento ya registrado con esa clave de idempotencia, o None."""
+    if clave is None:
+        return None
+    return db.session.query(Movimiento.id).filter_by(clave_idempotencia=clave).scalar()
+
+def respuesta_duplicada(movimiento_id):
+    # El reintento recibe la misma respuesta de éxito, sin volver a tocar el stock
+    return jsonify({'status': 'success', 'id': movimiento_id, 'duplicado': True}), 200
+
+# --- STOCK ATÓMICO ---
+# El stock se modifica con una única sentencia que la base de datos evalúa de forma atómica,
+# nunca leyendo la cantidad en Python y escribiéndola después: con varios workers dos
+# peticiones concurrentes podrían pasar la misma comprobación y perder una actualización.
+
+def sumar_stock(nombre, cantidad, proveedor):
+    """
+    Suma `cantidad` al artículo `nombre`, creándolo si no existe, con un solo
+    INSERT ... ON CONFLICT DO UPDATE. No hace commit. Devuelve el id del artículo.
+    """
+    material_id = db.session.query(Material.id).filter_by(nombre=nombre).scalar()
+    stmt = sentencia_upsert(Articulo).values(nombre=nombre, cantidad=cantidad, proveedor=proveedor, material_id=material_id)
+    stmt = stmt.on_conflict_do_update(
+        index_elements=[Articulo.nombre],
+        set_={'cantidad': Articulo.cantidad + stmt.excluded.cantidad},
+    ).returning(Articulo.id)
+    return db.session.execute(stmt).scalar()
+
+def restar_stock(nombre, cantidad):
+    """
+    Resta `cantidad` al artículo `nombre` solo si tiene stock suficiente, con un UPDATE
+    condicional (... WHERE cantidad >= :n RETURNING id). No hace commit.
+    Devuelve el id del artículo, o None si no existe o no hay stock suficiente.
+    """
+    tabla = Articulo.__table__
+    stmt = (
+        update(tabla)
+        .where(tabla.c.nombre == nombre, tabla.c.cantidad >= cantidad)
+        .values(cantidad=tabla.c.cantidad - cantidad)
+        .returning(tabla.c.id)
+    )
+    return db.session.execute(stmt).scalar()
+
 @app.route('/registrar_entrada', methods=['POST'])
 def registrar_entrada():
     data = request.get_json()
@@ -231,22 +1383,38 @@ def registrar_entrada():
     proveedor = (data.get('proveedor') or '').strip().upper()
     destino = (data.get('destino') or '').strip().upper()
 
-    articulo = Articulo.query.filter_by(nombre=nombre_articulo).first()
-    if not articulo:
-        articulo = Articulo(nombre=nombre_articulo, cantidad=0, proveedor=proveedor)
-        db.session.add(articulo)
-    
     try:
-        articulo.cantidad += cantidad
-        nueva_entrada = Entrada(articulo=articulo, cantidad=cantidad, proveedor=proveedor, destino=destino, fecha=datetime.datetime.utcnow())
+        clave = leer_clave_idempotencia()
+    except ValueError as e:
+        return jsonify({'status': 'error', 'message': str(e)}), 400
+    registrado = movimiento_con_clave(clave)
+    if registrado is not None:
+        return respuesta_duplicada(registrado)
+
+    try:
+        articulo_id = sumar_stock(nombre_articulo, cantidad, proveedor)
+        nueva_entrada = Movimiento(articulo_id=articulo_id, tipo='Entrada', cantidad=cantidad, proveedor=proveedor, destino=destino,
+                                   fecha=datetime.datetime.utcnow(), clave_idempotencia=clave)
         db.session.add(nueva_entrada)
+        contar_sugerencias([{'nombre': nombre_articulo, 'proveedor': proveedor, 'destino': destino, 'fecha': nueva_entrada.fecha}])
+        db.session.flush()
+        movimiento_id = nueva_entrada.id # Tras el commit, leer nueva_entrada.id volvería a consultar la base de datos
+        cambios = [('articulo', articulo_id, 'upsert'), ('movimiento', movimiento_id, 'upsert')]
+        seq = registrar_cambios(cambios)
         db.session.commit()
-        notificar_actualizacion()
+    except IntegrityError as e:
+        db.session.rollback()
+        # Otra petición con la misma clave se confirmó entre la comprobación y el commit
+        registrado = movimiento_con_clave(clave)
+        if registrado is not None:
+            return respuesta_duplicada(registrado)
+        return jsonify({'status': 'error', 'message': f'Error de base de datos: {e}'}), 500
     except Exception as e:
         db.session.rollback()
         return jsonify({'status': 'error', 'message': f'Error de base de datos: {e}'}), 500
 
-    return jsonify({'status': 'success'}), 201
+    notificar_actualizacion(seq, cambios)
+    return jsonify({'status': 'success', 'id': movimiento_id}), 201
 
 @app.route('/registrar_salida', methods=['POST'])
 def registrar_salida():
@@ -265,21 +1433,600 @@ def registrar_salida():
     nombre_articulo = data['nombre'].strip().upper()
     destino = (data.get('destino') or '').strip().upper()
 
-    articulo = Articulo.query.filter_by(nombre=nombre_articulo).first()
-    if not articulo or articulo.cantidad < cantidad:
-        return jsonify({'status': 'error', 'message': 'Stock insuficiente o artículo no existe'}), 400
-    
+    # Un reintento de una salida ya registrada no debe fallar por el stock que ella misma restó
     try:
-        articulo.cantidad -= cantidad
-        nueva_salida = Salida(articulo=articulo, cantidad=cantidad, destino=destino, fecha=datetime.datetime.utcnow())
+        clave = leer_clave_idempotencia()
+    except ValueError as e:
+        return jsonify({'status': 'error', 'message': str(e)}), 400
+    registrado = movimiento_con_clave(clave)
+    if registrado is not None:
+        return respuesta_duplicada(registrado)
+
+    try:
+        # La comprobación del stock y la resta son una sola sentencia: no hay carrera entre ambas
+        articulo_id = restar_stock(nombre_articulo, cantidad)
+        if articulo_id is None:
+            db.session.rollback()
+            return jsonify({'status': 'error', 'message': 'Stock insuficiente o artículo no existe'}), 400
+        # En el libro de movimientos las salidas se guardan con cantidad negativa
+        nueva_salida = Movimiento(articulo_id=articulo_id, tipo='Salida', cantidad=-cantidad, destino=destino,
+                                  fecha=datetime.datetime.utcnow(), clave_idempotencia=clave)
         db.session.add(nueva_salida)
+        contar_sugerencias([{'nombre': nombre_articulo, 'destino': destino, 'fecha': nueva_salida.fecha}])
+        db.session.flush()
+        movimiento_id = nueva_salida.id # Tras el commit, leer nueva_salida.id volvería a consultar la base de datos
+        cambios = [('articulo', articulo_id, 'upsert'), ('movimiento', movimiento_id, 'upsert')]
+        seq = registrar_cambios(cambios)
         db.session.commit()
-        notificar_actualizacion()
+    except IntegrityError as e:
+        db.session.rollback()
+        registrado = movimiento_con_clave(clave)
+        if registrado is not None:
+            return respuesta_duplicada(registrado)
+        return jsonify({'status': 'error', 'message': f'Error de base de datos: {e}'}), 500
     except Exception as e:
         db.session.rollback()
         return jsonify({'status': 'error', 'message': f'Error de base de datos: {e}'}), 500
 
-    return jsonify({'status': 'success'}), 201
+    notificar_actualizacion(seq, cambios)
+    return jsonify({'status': 'success', 'id': movimiento_id}), 201
+
+# --- IMPORTACIÓN MASIVA ---
+# Filas que se procesan y confirman en cada transacción durante una importación
+TAMANO_LOTE_IMPORTACION = 1000
+# Número máximo de errores de fila que se detallan en la respuesta
+MAX_ERRORES_DETALLADOS = 100
+
+def leer_filas_importacion():
+    """
+    Lee el cuerpo de la petición como un flujo, sin cargarlo entero en memoria, y devuelve
+    sus filas como diccionarios. Admite CSV (Content-Type text/csv), JSON Lines (un objeto
+    JSON por línea) o, para archivos pequeños, un array JSON (application/json).
+    Las filas JSON mal formadas se devuelven como la excepción ValueError.
+    """
+    if request.is_json:
+        datos = request.get_json(silent=True)
+        if not isinstance(datos, list):
+            yield ValueError('Se esperaba un array JSON de filas.')
+            return
+        yield from datos
+        return
+    flujo = io.TextIOWrapper(request.stream, encoding='utf-8-sig', newline='')
+    if request.mimetype in ('text/csv', 'application/csv'):
+        yield from csv.DictReader(flujo)
+        return
+    for linea in flujo:
+        linea = linea.strip()
+        if not linea:
+            continue
+        try:
+            yield json.loads(linea)
+        except ValueError as e:
+            yield ValueError(f'JSON no válido: {e}')
+
+def valor_de(fila, *claves):
+    """Devuelve el primer valor no vacío de `fila` para cualquiera de las claves (sin distinguir mayúsculas)."""
+    normalizada = {str(k).strip().lower(): v for k, v in fila.items()}
+    for clave in claves:
+        valor = normalizada.get(clave)
+        if valor not in (None, ''):
+            return valor
+    return None
+
+def normalizar_movimiento(fila):
+    """
+    Valida y normaliza una fila de importación de historial con las columnas
+    Articulo, Tipo, Cantidad, Ubicacion, Proveedor y Fecha. Lanza ValueError si no es válida.
+    """
+    if isinstance(fila, Exception):
+        raise fila
+    if not isinstance(fila, dict):
+        raise ValueError('Cada fila debe ser un objeto con las columnas del historial.')
+
+    nombre = str(valor_de(fila, 'articulo', 'artículo', 'nombre') or '').strip().upper()
+    if not nombre:
+        raise ValueError("Falta el artículo.")
+    tipo = str(valor_de(fila, 'tipo') or '').strip().capitalize()
+    if tipo not in ('Entrada', 'Salida'):
+        raise ValueError("El tipo debe ser 'Entrada' o 'Salida'.")
+    try:
+        cantidad = int(float(valor_de(fila, 'cantidad')))
+        if cantidad <= 0:
+            raise ValueError
+    except (ValueError, TypeError):
+        raise ValueError('La cantidad debe ser un número entero positivo.')
+
+    fecha = valor_de(fila, 'fecha')
+    try:
+        fecha = datetime.datetime.fromisoformat(str(fecha).strip()) if fecha else datetime.datetime.utcnow()
+    except ValueError:
+        raise ValueError(f"Fecha no válida: '{fecha}'.")
+
+    destino = str(valor_de(fila, 'ubicacion', 'ubicación', 'destino') or '').strip().upper()
+    proveedor = str(valor_de(fila, 'proveedor') or '').strip().upper() if tipo == 'Entrada' else None
+    return {
+        'nombre': nombre, 'tipo': tipo, 'cantidad': cantidad if tipo == 'Entrada' else -cantidad,
+        'destino': destino, 'proveedor': proveedor, 'fecha': fecha,
+    }
+
+def resolver_articulos(nombres, creables=None):
+    """
+    Devuelve {nombre: id} para los nombres dados, creando en bloque (con stock 0 y vinculados
+    a su material, si existe) los artículos que no existen. Si se indica `creables`, solo se
+    crean los que estén en ese conjunto y el resto de nombres inexistentes no aparece en el
+    resultado. No hace commit.
+    """
+    def buscar(modelo, nombres):
+        return dict(filtrar_en_trozos(db.session.query(modelo.nombre, modelo.id), modelo.nombre, nombres))
+
+    nombres = set(nombres)
+    ids = buscar(Articulo, nombres)
+    nuevos = nombres - ids.keys()
+    if creables is not None:
+        nuevos &= set(creables)
+    if nuevos:
+        materiales = buscar(Material, nuevos)
+        db.session.execute(insert(Articulo), [
+            {'nombre': nombre, 'cantidad': 0, 'material_id': materiales.get(nombre)} for nombre in nuevos
+        ])
+        ids.update(buscar(Articulo, nuevos))
+    return ids
+
+def aplicar_deltas_stock(deltas):
+    """Suma a cada artículo su variación de stock {articulo_id: delta} con un UPDATE por artículo (executemany)."""
+    tabla = Articulo.__table__
+    parametros = [{'b_id': articulo_id, 'b_delta': delta} for articulo_id, delta in deltas.items() if delta]
+    if not parametros:
+        return # Con una lista vacía, execute() no haría un executemany sino una sentencia sin parámetros
+    stmt = update(tabla).where(tabla.c.id == bindparam('b_id')).values(cantidad=tabla.c.cantidad + bindparam('b_delta'))
+    db.session.execute(stmt, parametros)
+
+def clave_lote_importacion(clave, numero):
+    """
+    Clave de idempotencia del lote `numero` de una importación enviada con la clave `clave`:
+    la propia clave para el primer lote y un resumen de ambas para los siguientes, de modo que
+    no pase de LONGITUD_MAXIMA_CLAVE_IDEMPOTENCIA.
+    """
+    if numero == 0:
+        return clave
+    return hashlib.sha256(f'{clave}:{numero}'.encode('utf-8')).hexdigest()[:LONGITUD_MAXIMA_CLAVE_IDEMPOTENCIA]
+
+def importar_lote_movimientos(lote, clave=None):
+    """
+    Inserta un lote de movimientos ya normalizados en una transacción: resuelve los artículos
+    con una consulta, inserta los movimientos con un executemany y aplica un UPDATE agregado
+    por artículo. Si se indica `clave`, se guarda como clave de idempotencia del primer
+    movimiento, así el mismo lote no puede confirmarse dos veces.
+    Devuelve el número de secuencia del lote.
+    """
+    ids = resolver_articulos(fila['nombre'] for fila in lote)
+    deltas = {}
+    movimientos = []
+    for fila in lote:
+        articulo_id = ids[fila['nombre']]
+        deltas[articulo_id] = deltas.get(articulo_id, 0) + fila['cantidad']
+        movimientos.append({
+            'tipo': fila['tipo'], 'articulo_id': articulo_id, 'cantidad': fila['cantidad'],
+            'destino': fila['destino'], 'proveedor': fila['proveedor'], 'fecha': fila['fecha'],
+            'clave_idempotencia': None,
+        })
+    movimientos[0]['clave_idempotencia'] = clave
+    # INSERT de Core con todas las columnas en cada fila: el ORM omite las que valen None
+    # (p. ej. el proveedor de las salidas) y partiría el executemany en varias sentencias
+    db.session.execute(insert(Movimiento.__table__), movimientos)
+    aplicar_deltas_stock(deltas)
+    contar_sugerencias(lote)
+    # Un lote puede tener miles de movimientos: se registran los artículos afectados y un
+    # cambio 'resync' del historial en lugar de un cambio por movimiento.
+    seq = registrar_cambios([('articulo', i, 'upsert') for i in deltas] + [('movimiento', 0, 'resync')])
+    db.session.commit()
+    return seq
+
+@app.route('/historial/importar', methods=['POST'])
+def importar_historial():
+    """
+    Importa movimientos en bloque desde un cuerpo CSV o JSON Lines enviado como flujo, con las
+    columnas Articulo, Tipo, Cantidad, Ubicacion, Proveedor y Fecha. Los artículos que no
+    existen se crean. El historial se aplica tal cual: las salidas no se validan contra el stock.
+    Las filas se confirman en lotes de TAMANO_LOTE_IMPORTACION; si falla un lote, los anteriores
+    quedan importados y la respuesta indica cuántos. Al final se emite una sola notificación.
+    Con la cabecera Idempotency-Key, reenviar el mismo cuerpo no vuelve a importar los lotes
+    ya confirmados: se cuentan como 'duplicados'.
+    """
+    try:
+        clave = leer_clave_idempotencia()
+    except ValueError as e:
+        return jsonify({'status': 'error', 'message': str(e)}), 400
+
+    importados = 0
+    duplicados = 0
+    rechazados = 0
+    errores = []
+    seq = None
+    lotes = 0
+    lote = []
+
+    def confirmar(lote):
+        nonlocal importados, duplicados, seq, lotes
+        clave_lote = clave_lote_importacion(clave, lotes) if clave else None
+        lotes += 1
+        if movimiento_con_clave(clave_lote) is not None:
+            duplicados += len(lote)
+            return
+        try:
+            seq = importar_lote_movimientos(lote, clave_lote)
+        except IntegrityError:
+            # Otra petición con la misma clave confirmó el lote entre la comprobación y el commit
+            db.session.rollback()
+            if movimiento_con_clave(clave_lote) is None:
+                raise
+            duplicados += len(lote)
+            return
+        importados += len(lote)
+
+    try:
+        for numero, fila in enumerate(leer_filas_importacion(), start=1):
+            try:
+                lote.append(normalizar_movimiento(fila))
+            except ValueError as e:
+                rechazados += 1
+                if len(errores) < MAX_ERRORES_DETALLADOS:
+                    errores.append({'fila': numero, 'message': str(e)})
+                continue
+            if len(lote) >= TAMANO_LOTE_IMPORTACION:
+                confirmar(lote)
+                lote = []
+        if lote:
+            confirmar(lote)
+    except Exception as e:
+        db.session.rollback()
+        if seq is not None:
+            notificar_actualizacion(seq, [('movimiento', 0, 'resync')])
+        return jsonify({
+            'status': 'error', 'message': f'Error de base de datos durante la importación: {e}',
+            'importados': importados, 'duplicados': duplicados, 'rechazados': rechazados, 'errores': errores
+        }), 500
+
+    if seq is not None:
+        notificar_actualizacion(seq, [('movimiento', 0, 'resync')])
+    return jsonify({'status': 'success', 'importados': importados, 'duplicados': duplicados,
+                    'rechazados': rechazados, 'errores': errores}), 201
+
+# --- MOVIMIENTOS EN LOTE ---
+# Número máximo de líneas que admite una petición a /movimientos/lote
+MAX_MOVIMIENTOS_POR_LOTE = 500
+# Antigüedad máxima de la fecha 'creado' que envía el cliente para un movimiento encolado sin conexión
+MAX_ANTIGUEDAD_CREADO = datetime.timedelta(days=30)
+
+def fecha_creado(valor, ahora):
+    """
+    Convierte la fecha 'creado' de una línea (ISO 8601; sin zona se toma como UTC) en UTC sin
+    zona horaria, como las demás fechas del libro. Devuelve None si no viene, no es válida,
+    es futura o es más antigua que MAX_ANTIGUEDAD_CREADO: entonces vale la hora del servidor.
+    """
+    if not valor:
+        return None
+    try:
+        fecha = datetime.datetime.fromisoformat(str(valor).strip())
+    except ValueError:
+        return None
+    if fecha.tzinfo is not None:
+        fecha = fecha.astimezone(datetime.timezone.utc).replace(tzinfo=None)
+    if not ahora - MAX_ANTIGUEDAD_CREADO <= fecha <= ahora:
+        return None
+    return fecha
+
+def normalizar_linea_lote(linea, ahora):
+    """
+    Valida una línea de /movimientos/lote (nombre, tipo, cantidad, destino, proveedor y,
+    opcionalmente, su clave de idempotencia y la fecha 'creado' en que se registró en el
+    cliente). Sin una fecha 'creado' aceptable, la fecha la pone el servidor al registrarla.
+    Lanza ValueError si no es válida.
+    """
+    movimiento = normalizar_movimiento(linea)
+    movimiento['fecha'] = fecha_creado(valor_de(linea, 'creado'), ahora)
+    clave = str(valor_de(linea, 'clave') or '').strip() or None
+    if clave is not None and len(clave) > LONGITUD_MAXIMA_CLAVE_IDEMPOTENCIA:
+        raise ValueError(f'La clave admite como máximo {LONGITUD_MAXIMA_CLAVE_IDEMPOTENCIA} caracteres.')
+    movimiento['clave'] = clave
+    return movimiento
+
+def registrar_lote_movimientos(lineas):
+    """
+    Registra en la transacción en curso las líneas ya normalizadas que no estén registradas
+    (por su clave): resuelve todos los artículos con una consulta, valida las salidas contra
+    la variación agregada de cada artículo y la aplica con un UPDATE condicional por artículo.
+    No hace commit. Devuelve (resultados, cambios, errores); si hay errores no se ha
+    escrito nada que deba confirmarse y la transacción debe deshacerse.
+    """
+    claves = [linea['clave'] for linea in lineas if linea['clave']]
+    registrados = dict(
+        db.session.query(Movimiento.clave_idempotencia, Movimiento.id)
+        .filter(Movimiento.clave_idempotencia.in_(claves))
+    ) if claves else {}
+    nuevas = [linea for linea in lineas if linea['clave'] not in registrados]
+
+    # Las entradas pueden crear el artículo; las salidas exigen que exista
+    ids = resolver_articulos((linea['nombre'] for linea in nuevas),
+                             creables={linea['nombre'] for linea in nuevas if linea['tipo'] == 'Entrada'})
+    errores = [
+        {'linea': numero, 'message': f"El artículo '{linea['nombre']}' no existe."}
+        for numero, linea in enumerate(lineas) if linea['clave'] not in registrados and linea['nombre'] not in ids
+    ]
+    if errores:
+        return None, None, errores
+
+    deltas = {}
+    for linea in nuevas:
+        articulo_id = ids[linea['nombre']]
+        deltas[articulo_id] = deltas.get(articulo_id, 0) + linea['cantidad']
+    aplicar_deltas_stock({i: d for i, d in deltas.items() if d > 0})
+    # Las restas llevan la comprobación en la propia sentencia, como en restar_stock
+    tabla = Articulo.__table__
+    sin_stock = set()
+    for articulo_id, delta in deltas.items():
+        if delta < 0 and db.session.execute(
+            update(tabla).where(tabla.c.id == articulo_id, tabla.c.cantidad >= -delta)
+            .values(cantidad=tabla.c.cantidad + delta).returning(tabla.c.id)
+        ).scalar() is None:
+            sin_stock.add(articulo_id)
+    if sin_stock:
+        errores = [
+            {'linea': numero, 'message': f"Stock insuficiente de '{linea['nombre']}' para el total de salidas del lote."}
+            for numero, linea in enumerate(lineas)
+            if linea['clave'] not in registrados and linea['tipo'] == 'Salida' and ids[linea['nombre']] in sin_stock
+        ]
+        return None, None, errores
+
+    # Los movimientos encolados sin conexión conservan la fecha en que se registraron
+    ahora = datetime.datetime.utcnow()
+    for linea in nuevas:
+        linea['fecha'] = linea['fecha'] or ahora
+    contar_sugerencias(nuevas)
+    movimientos = {}
+    for linea in nuevas:
+        movimientos[id(linea)] = Movimiento(
+            articulo_id=ids[linea['nombre']], tipo=linea['tipo'], cantidad=linea['cantidad'],
+            destino=linea['destino'], proveedor=linea['proveedor'], fecha=linea['fecha'], clave_idempotencia=linea['clave'])
+    db.session.add_all(movimientos.values())
+    db.session.flush()
+
+    resultados = []
+    for linea in lineas:
+        if linea['clave'] in registrados:
+            resultados.append({'id': registrados[linea['clave']], 'duplicado': True})
+        else:
+            resultados.append({'id': movimientos[id(linea)].id, 'duplicado': False})
+    cambios = [('articulo', i, 'upsert') for i in deltas]
+    cambios += [('movimiento', m.id, 'upsert') for m in movimientos.values()]
+    return resultados, cambios, []
+
+@app.route('/movimientos/lote', methods=['POST'])
+def registrar_movimientos_lote():
+    """
+    Registra varias entradas y salidas en una sola petición y una sola transacción: o se
+    registran todas o ninguna. Acepta un array JSON de líneas (o {"movimientos": [...]}) con
+    nombre, tipo ('Entrada' o 'Salida'), cantidad, destino, proveedor y una 'clave' de
+    idempotencia opcional por línea; las líneas cuya clave ya está registrada no se repiten.
+    Una línea puede traer la fecha 'creado' en que se registró en el cliente (ver `fecha_creado`).
+    Las salidas se validan contra la variación agregada del lote para cada artículo.
+    Responde con el id de cada línea, en el mismo orden, y emite una sola notificación.
+    """
+    data = request.get_json(silent=True)
+    if isinstance(data, dict):
+        data = data.get('movimientos')
+    if not isinstance(data, list) or not data:
+        return jsonify({'status': 'error', 'message': 'Se esperaba una lista de movimientos.'}), 400
+    if len(data) > MAX_MOVIMIENTOS_POR_LOTE:
+        return jsonify({'status': 'error', 'message': f'Un lote admite como máximo {MAX_MOVIMIENTOS_POR_LOTE} movimientos.'}), 400
+
+    lineas = []
+    errores = []
+    ahora = datetime.datetime.utcnow()
+    for numero, linea in enumerate(data):
+        try:
+            lineas.append(normalizar_linea_lote(linea, ahora))
+        except ValueError as e:
+            errores.append({'linea': numero, 'message': str(e)})
+    claves = [linea['clave'] for linea in lineas if linea['clave']]
+    if not errores and len(claves) != len(set(claves)):
+        errores.append({'linea': None, 'message': 'Hay claves de idempotencia repetidas en el lote.'})
+    if errores:
+        return jsonify({'status': 'error', 'message': 'El lote tiene líneas no válidas.', 'errores': errores[:MAX_ERRORES_DETALLADOS]}), 400
+
+    # Si otra petición registra a la vez alguna de las mismas claves, el índice único hace
+    # fallar el commit; al reintentar, esas líneas se reconocen como duplicadas.
+    for intento in range(2):
+        try:
+            resultados, cambios, errores = registrar_lote_movimientos(lineas)
+            if errores:
+                db.session.rollback()
+                return jsonify({'status': 'error', 'message': 'No se registró ningún movimiento del lote.', 'errores': errores[:MAX_ERRORES_DETALLADOS]}), 400
+            seq = registrar_cambios(cambios) if cambios else None
+            db.session.commit()
+            break
+        except IntegrityError as e:
+            db.session.rollback()
+            if not claves or intento:
+                return jsonify({'status': 'error', 'message': f'Error de base de datos: {e}'}), 500
+        except Exception as e:
+            db.session.rollback()
+            return jsonify({'status': 'error', 'message': f'Error de base de datos: {e}'}), 500
+
+    if seq is not None:
+        notificar_actualizacion(seq, cambios)
+    # Si todas las líneas ya estaban registradas, no se ha creado nada
+    return jsonify({'status': 'success', 'movimientos': resultados}), 201 if seq is not None else 200
+
+# Máximo de parámetros por sentencia: SQLite anterior a 3.32 no admite más de 999
+MAX_PARAMETROS_SENTENCIA = 999
+
+def filas_por_sentencia(columnas):
+    """Número de filas de `columnas` valores que caben en una sentencia de varias filas (VALUES o IN)."""
+    return max(1, MAX_PARAMETROS_SENTENCIA // columnas)
+
+def filtrar_en_trozos(consulta, columna, valores):
+    """
+    Devuelve las filas de `consulta` con `columna` en `valores`, consultando por trozos de
+    MAX_PARAMETROS_SENTENCIA valores: cada valor es un parámetro del IN.
+    """
+    valores = list(valores)
+    for inicio in range(0, len(valores), MAX_PARAMETROS_SENTENCIA):
+        yield from consulta.filter(columna.in_(valores[inicio:inicio + MAX_PARAMETROS_SENTENCIA]))
+
+def sentencia_upsert(modelo):
+    """
+    Devuelve un INSERT del dialecto activo (PostgreSQL o SQLite) que admite
+    `on_conflict_do_update`, es decir, un INSERT ... ON CONFLICT en una sola sentencia.
+    """
+    dialecto = postgresql if db.engine.dialect.name == 'postgresql' else sqlite
+    return dialecto.insert(modelo)
+
+def upsert_por_nombre(modelo, filas, columnas):
+    """
+    Inserta o actualiza `filas` (diccionarios con 'nombre' y `columnas`) por su nombre único,
+    con una sentencia por lote; cada lote lleva las filas que caben en MAX_PARAMETROS_SENTENCIA.
+    Solo se reescriben las filas cuyos valores cambian. No hace commit.
+    Devuelve (ids_insertados, ids_actualizados).
+    """
+    insertados, actualizados = [], []
+    if not filas:
+        return insertados, actualizados
+    tamano = filas_por_sentencia(len(filas[0]))
+    for inicio in range(0, len(filas), tamano):
+        lote = filas[inicio:inicio + tamano]
+        existentes = set(db.session.scalars(
+            select(modelo.id).where(modelo.nombre.in_([f['nombre'] for f in lote]))
+        ))
+        stmt = sentencia_upsert(modelo).values(lote)
+        stmt = stmt.on_conflict_do_update(
+            index_elements=[modelo.nombre],
+            set_={c: stmt.excluded[c] for c in columnas},
+            where=or_(*(getattr(modelo, c).is_distinct_from(stmt.excluded[c]) for c in columnas)),
+        ).returning(modelo.id)
+        for id_ in db.session.scalars(stmt):
+            (actualizados if id_ in existentes else insertados).append(id_)
+    return insertados, actualizados
+
+def leer_filas_normalizadas(normalizar):
+    """
+    Lee todo el archivo de importación y lo normaliza con `normalizar`, eliminando nombres
+    duplicados (gana la última aparición). Devuelve (filas, omitidas, errores).
+    """
+    filas = {}
+    omitidas = 0
+    errores = []
+    for numero, fila in enumerate(leer_filas_importacion(), start=1):
+        try:
+            normalizada = normalizar(fila)
+        except ValueError as e:
+            omitidas += 1
+            if len(errores) < MAX_ERRORES_DETALLADOS:
+                errores.append({'fila': numero, 'message': str(e)})
+            continue
+        if normalizada['nombre'] in filas:
+            omitidas += 1
+        filas[normalizada['nombre']] = normalizada
+    return list(filas.values()), omitidas, errores
+
+def normalizar_articulo(fila):
+    """Valida y normaliza una fila de inventario (Nombre, Cantidad, Proveedor). Lanza ValueError si no es válida."""
+    if isinstance(fila, Exception):
+        raise fila
+    if not isinstance(fila, dict):
+        raise ValueError('Cada fila debe ser un objeto con las columnas del inventario.')
+    nombre = str(valor_de(fila, 'nombre', 'articulo', 'artículo') or '').strip().upper()
+    if not nombre:
+        raise ValueError('Falta el nombre del artículo.')
+    try:
+        cantidad = int(float(valor_de(fila, 'cantidad')))
+        if cantidad < 0:
+            raise ValueError
+    except (ValueError, TypeError):
+        raise ValueError('La cantidad debe ser un número entero no negativo.')
+    proveedor = valor_de(fila, 'proveedor')
+    return {'nombre': nombre, 'cantidad': cantidad, 'proveedor': str(proveedor).strip().upper() if proveedor else None}
+
+def normalizar_material(fila):
+    """Valida y normaliza una fila de materiales (Nombre, Unidad). Lanza ValueError si no es válida."""
+    if isinstance(fila, Exception):
+        raise fila
+    if not isinstance(fila, dict):
+        raise ValueError('Cada fila debe ser un objeto con las columnas de materiales.')
+    nombre = str(valor_de(fila, 'nombre', 'material') or '').strip().upper()
+    if not nombre:
+        raise ValueError('El nombre del material es obligatorio.')
+    unidad = valor_de(fila, 'unidad_medicion', 'unidad', 'unidad de medición', 'unidad de medicion')
+    return {'nombre': nombre, 'unidad_medicion': str(unidad or '').strip().upper()}
+
+def respuesta_importacion(insertados, actualizados, omitidas, errores):
+    """Respuesta común de las importaciones con upsert."""
+    return jsonify({
+        'status': 'success', 'insertados': insertados, 'actualizados': actualizados,
+        'omitidos': omitidas, 'errores': errores
+    }), 200
+
+@app.route('/inventario/importar', methods=['POST'])
+def importar_inventario():
+    """
+    Importa un archivo de inventario completo (CSV, JSON Lines o array JSON con las columnas
+    Nombre, Cantidad y Proveedor). Los nombres se normalizan y se deduplican; los artículos
+    nuevos se crean y los existentes toman la cantidad del archivo (es un recuento de stock, no
+    un movimiento). El proveedor solo se sobrescribe si la fila lo trae. Todo el archivo se
+    aplica en una sola transacción. Las filas sin cambios, duplicadas o no válidas se cuentan
+    como omitidas.
+    """
+    filas, omitidas, errores = leer_filas_normalizadas(normalizar_articulo)
+    # Sin proveedor en el archivo se conserva el del artículo existente
+    con_proveedor = [f for f in filas if f['proveedor'] is not None]
+    sin_proveedor = [{'nombre': f['nombre'], 'cantidad': f['cantidad']} for f in filas if f['proveedor'] is None]
+    try:
+        insertados, actualizados = upsert_por_nombre(Articulo, con_proveedor, ['cantidad', 'proveedor'])
+        ins, act = upsert_por_nombre(Articulo, sin_proveedor, ['cantidad'])
+        insertados += ins
+        actualizados += act
+        omitidas += len(filas) - len(insertados) - len(actualizados)
+        if insertados:
+            vincular_articulos_con_materiales()
+        cambios = [('articulo', i, 'upsert') for i in insertados + actualizados]
+        seq = registrar_cambios(cambios) if cambios else None
+        db.session.commit()
+    except Exception as e:
+        db.session.rollback()
+        return jsonify({'status': 'error', 'message': f'Error de base de datos al importar el inventario: {e}'}), 500
+
+    if cambios:
+        notificar_actualizacion(seq, cambios)
+    return respuesta_importacion(len(insertados), len(actualizados), omitidas, errores)
+
+@app.route('/materiales/importar', methods=['POST'])
+def importar_materiales():
+    """
+    Importa un archivo de materiales completo (CSV, JSON Lines o array JSON con las columnas
+    Nombre y Unidad). Los nombres se normalizan como en `crear_material` y se deduplican; los
+    materiales nuevos se crean, los existentes actualizan su unidad y los artículos con el mismo
+    nombre quedan vinculados. Todo el archivo se aplica en una sola transacción.
+    """
+    filas, omitidas, errores = leer_filas_normalizadas(normalizar_material)
+    try:
+        insertados, actualizados = upsert_por_nombre(Material, filas, ['unidad_medicion'])
+        omitidas += len(filas) - len(insertados) - len(actualizados)
+        cambios = [('material', i, 'upsert') for i in insertados + actualizados]
+        if cambios:
+            if insertados:
+                vincular_articulos_con_materiales()
+            # La unidad se muestra junto a cada artículo, así que también cambian sus filas
+            articulos = filtrar_en_trozos(db.session.query(Articulo.id), Articulo.material_id, insertados + actualizados)
+            cambios += [('articulo', i, 'upsert') for i, in articulos]
+            seq = registrar_cambios(cambios)
+        db.session.commit()
+    except Exception as e:
+        db.session.rollback()
+        return jsonify({'status': 'error', 'message': f'Error de base de datos al importar materiales: {e}'}), 500
+
+    if cambios:
+        notificar_actualizacion(seq, cambios)
+    return respuesta_importacion(len(insertados), len(actualizados), omitidas, errores)
 
 # --- EVENTOS DE WEBSOCKET ---
 @socketio.on('connect')
@@ -290,8 +2037,136 @@ def handle_connect():
 def handle_disconnect():
     print('Cliente desconectado.')
 
+# --- MIGRACIONES ---
+def agregar_columnas_faltantes():
+    """
+    `db.create_all()` no modifica tablas existentes. Esta función añade con ALTER TABLE
+    las columnas declaradas en los modelos que aún no existen (siempre como NULL).
+    """
+    inspector = inspect(db.engine)
+    for tabla in db.metadata.sorted_tables:
+        if not inspector.has_table(tabla.name):
+            continue
+        existentes = {c['name'] for c in inspector.get_columns(tabla.name)}
+        for columna in tabla.columns:
+            if columna.name in existentes:
+                continue
+            ddl = f'ALTER TABLE {tabla.name} ADD COLUMN {columna.name} {columna.type.compile(dialect=db.engine.dialect)}'
+            for fk in columna.foreign_keys:
+                ddl += f' REFERENCES {fk.column.table.name} ({fk.column.name})'
+                if fk.ondelete:
+                    ddl += f' ON DELETE {fk.ondelete}'
+            with db.engine.begin() as conn:
+                conn.execute(text(ddl))
+
+# Índices que sustituyó otro con más columnas y que se eliminan al migrar
+INDICES_OBSOLETOS = ('ix_articulo_material_nombre_cantidad',)
+
+def crear_indices_faltantes():
+    """
+    `db.create_all()` solo crea los índices de las tablas nuevas. Esta función crea
+    los índices declarados en los modelos que aún no existen en tablas ya creadas
+    y elimina los de INDICES_OBSOLETOS.
+    """
+    with db.engine.begin() as conn:
+        for nombre in INDICES_OBSOLETOS:
+            conn.execute(text(f'DROP INDEX IF EXISTS {nombre}'))
+    for tabla in db.metadata.sorted_tables:
+        for indice in tabla.indexes:
+            indice.create(bind=db.engine, checkfirst=True)
+
+def vincular_articulos_con_materiales(nombre=None):
+    """
+    Rellena `Articulo.material_id` de los artículos sin material cuyo nombre coincide con
+    el de un material (opcionalmente solo para un nombre). No hace commit.
+    """
+    material_id = select(Material.id).where(Material.nombre == Articulo.nombre).scalar_subquery()
+    stmt = update(Articulo).where(Articulo.material_id.is_(None)).values(material_id=material_id)
+    if nombre is not None:
+        stmt = stmt.where(Articulo.nombre == nombre)
+    return db.session.execute(stmt.execution_options(synchronize_session=False)).rowcount
+
+def migrar_movimientos():
+    """
+    Copia, una sola vez, las tablas heredadas Entrada y Salida al libro Movimiento.
+    Solo actúa si Movimiento está vacío, así que volver a ejecutarla no duplica nada.
+    """
+    if db.session.query(Movimiento.id).first() is not None:
+        return 0
+
+    tipo = Movimiento.__table__.c.tipo.type
+    entradas = select(
+        cast(literal_column("'Entrada'"), tipo).label('tipo'), Entrada.articulo_id, Entrada.cantidad.label('cantidad'),
+        Entrada.destino, Entrada.proveedor, Entrada.fecha
+    )
+    salidas = select(
+        cast(literal_column("'Salida'"), tipo).label('tipo'), Salida.articulo_id, (-Salida.cantidad).label('cantidad'),
+        Salida.destino, literal_column("NULL").label('proveedor'), Salida.fecha
+    )
+    # Se insertan en orden cronológico para que los ids sigan el orden de las fechas
+    legado = union_all(entradas, salidas).subquery()
+    columnas = ['tipo', 'articulo_id', 'cantidad', 'destino', 'proveedor', 'fecha']
+    resultado = db.session.execute(
+        insert(Movimiento).from_select(columnas, select(*[legado.c[c] for c in columnas]).order_by(legado.c.fecha))
+    )
+    db.session.commit()
+    return resultado.rowcount
+
+def reconstruir_sugerencias():
+    """
+    Rellena la tabla de sugerencias a partir del historial si está vacía (bases de datos
+    anteriores a la tabla). Solo actúa si no hay ninguna sugerencia.
+    """
+    if db.session.query(Sugerencia.columna).first() is not None:
+        return 0
+    por_columna = [
+        select(literal_column("'articulo'"), Articulo.nombre, func.count(), func.max(Movimiento.fecha))
+        .join(Movimiento.articulo).group_by(Articulo.nombre),
+    ]
+    for columna in ('proveedor', 'destino'):
+        campo = getattr(Movimiento, columna)
+        por_columna.append(
+            select(literal_column(f"'{columna}'"), campo, func.count(), func.max(Movimiento.fecha))
+            .where(campo.is_not(None), campo != '').group_by(campo)
+        )
+    resultado = db.session.execute(
+        insert(Sugerencia).from_select(['columna', 'valor', 'frecuencia', 'ultimo_uso'], union_all(*por_columna))
+    )
+    db.session.commit()
+    return resultado.rowcount
+
+def migrar_base_de_datos():
+    """
+    Crea las tablas e índices que falten, migra los datos heredados y poda el registro de
+    cambios (ver `podar_cambios`). Es idempotente.
+    """
+    db.create_all()
+    agregar_columnas_faltantes()
+    crear_indices_faltantes()
+    vincular_articulos_con_materiales()
+    if db.session.get(Secuencia, 'cambios') is None:
+        db.session.add(Secuencia(nombre='cambios', valor=0))
+    db.session.commit()
+    migrados = migrar_movimientos()
+    if migrados:
+        print(f'Migrados {migrados} movimientos de Entrada/Salida a Movimiento.')
+    reconstruir_sugerencias()
+    podar_cambios()
+
+@app.cli.command('migrar')
+def migrar_command():
+    """Aplica las migraciones pendientes: flask --app server migrar"""
+    migrar_base_de_datos()
+    print('Migración completada.')
+
+@app.cli.command('podar-cambios')
+def podar_cambios_command():
+    """Elimina los cambios antiguos (para una tarea periódica): flask --app server podar-cambios"""
+    eliminados = podar_cambios()
+    print(f'Eliminados {eliminados} cambios de más de {DIAS_RETENCION_CAMBIOS} días.')
+
 # --- INICIO DEL SERVIDOR ---
 if __name__ == '__main__':
     with app.app_context():
-        db.create_all()
+        migrar_base_de_datos()
     socketio.run(app, debug=True)